@@ -1,6 +1,12 @@
 from annotator import authz, document, es
 
 TYPE = 'annotation'
+
+# Fields counted by Annotation.stats. Like every field without an analyzer of
+# its own, they are indexed whole (see Model.get_mapping), so their values
+# rather than their words are counted.
+STATS_FIELDS = ('tags', 'user', 'uri')
+
 MAPPING = {
     'id': {'type': 'string', 'index': 'no'},
     'annotator_schema_version': {'type': 'string'},
@@ -32,7 +38,8 @@ MAPPING = {
     },
     'document': {
         'properties': document.MAPPING
-    }
+    },
+    'readers': {'type': 'string', 'index': 'not_analyzed'}
 }
 
 
@@ -41,18 +48,28 @@ class Annotation(es.Model):
     __type__ = TYPE
     __mapping__ = MAPPING
 
+    # An optional annotator.document.MergeQueue. If set, document metadata is
+    # merged in the background instead of before the annotation is saved.
+    document_queue = None
+
     def save(self, *args, **kwargs):
-        _add_default_permissions(self)
+        self._prepare()
+        _save_documents([self], self.document_queue)
+        super(Annotation, self).save(*args, **kwargs)
 
-        # If the annotation includes document metadata look to see if we have
-        # the document modeled already. If we don't we'll create a new one
-        # If we do then we'll merge the supplied links into it.
+    @classmethod
+    def bulk(cls, operations, refresh=True):
+        saved = [ann for action, ann in operations if action != 'delete']
+        for ann in saved:
+            ann._prepare()
+        _save_documents(saved, cls.document_queue)
+        return super(Annotation, cls).bulk(operations, refresh=refresh)
 
-        if 'document' in self:
-            d = document.Document(self['document'])
-            d.save()
+    def _prepare(self):
+        _add_default_permissions(self)
 
-        super(Annotation, self).save(*args, **kwargs)
+        # Flatten the read permissions for searching (see authz)
+        self['readers'] = authz.annotation_readers(self)
 
     @classmethod
     def search_raw(cls, query=None, params=None, raw_result=False,
@@ -68,6 +85,99 @@ class Annotation(es.Model):
         user -- The user to filter the results for according to permissions
         authorization_enabled -- Overrides Annotation.es.authorization_enabled
         """
+        query = cls._filter_query(query, user, authorization_enabled)
+        res = super(Annotation, cls).search_raw(query=query, params=params,
+                                                raw_result=raw_result)
+        return res
+
+    @classmethod
+    def search_raw_many(cls, queries, raw_result=False, user=None,
+                        authorization_enabled=None):
+        """Perform several raw Elasticsearch queries with a single request
+
+        Keyword arguments:
+        queries -- A list of queries to send to Elasticsearch
+        raw_result -- Return Elasticsearch's responses as they are
+        user -- The user to filter the results for according to permissions
+        authorization_enabled -- Overrides Annotation.es.authorization_enabled
+        """
+        queries = [cls._filter_query(q, user, authorization_enabled)
+                   for q in queries]
+        return super(Annotation, cls).search_raw_many(queries,
+                                                      raw_result=raw_result)
+
+    @classmethod
+    def scan_raw(cls, query=None, user=None, authorization_enabled=None,
+                 **kwargs):
+        """Like search_raw, but yields every match using a scroll.
+
+        Keyword arguments:
+        query -- Query to send to Elasticsearch
+        user -- The user to filter the results for according to permissions
+        authorization_enabled -- Overrides Annotation.es.authorization_enabled
+        """
+        query = cls._filter_query(query, user, authorization_enabled)
+        return super(Annotation, cls).scan_raw(query=query, **kwargs)
+
+    @classmethod
+    def stats(cls, query=None, limit=10, interval='month', **kwargs):
+        """Count the annotations matching the query by tag, user and URI, and
+        by when they were created, with a single aggregation request.
+
+        Keyword arguments:
+        query -- A dict of field values to match, as for search
+        limit -- Number of most frequent tags, users and URIs to return
+        interval -- The date_histogram interval to count creation dates by
+        user -- The user to filter the annotations for according to
+                permissions
+
+        Returns a dict of the total number of matches, lists of
+        {'key': ..., 'count': ...} for each of STATS_FIELDS, most frequent
+        first, and a list of the same for 'created', in date order.
+        """
+        aggs = dict((field, {'terms': {'field': field, 'size': limit}})
+                    for field in STATS_FIELDS)
+        aggs['created'] = {'date_histogram': {'field': 'created',
+                                              'interval': interval}}
+        total, res = cls.aggregate(aggs, query=query, **kwargs)
+
+        stats = {'total': total}
+        for field in STATS_FIELDS:
+            stats[field] = [{'key': b['key'], 'count': b['doc_count']}
+                            for b in res[field]['buckets']]
+        stats['created'] = [{'key': b['key_as_string'],
+                             'count': b['doc_count']}
+                            for b in res['created']['buckets']]
+        return stats
+
+    @classmethod
+    def count_by_uri(cls, uris, **kwargs):
+        """Count the annotations of each of the given URIs, as
+        count(query={'uri': uri}) would, but with a single request.
+
+        The equivalent URIs of all of them are looked up together (see
+        Document.equivalent_uris_many), and the counts made by a filters
+        aggregation with one filter per URI. Other keyword arguments are
+        passed to search_raw, e.g. the user to count annotations for.
+
+        Returns a dict of the number of annotations by URI.
+        """
+        uris = list(set(uris))
+        if not uris:
+            return {}
+
+        equivalents = document.Document.equivalent_uris_many(uris)
+        filters = dict((str(i), {'query': _uri_clause(uri, equivalents[uri])})
+                       for i, uri in enumerate(uris))
+        aggs = {'uris': {'filters': {'filters': filters}}}
+        _, res = cls.aggregate(aggs, **kwargs)
+
+        buckets = res['uris']['buckets']
+        return dict((uri, buckets[str(i)]['doc_count'])
+                    for i, uri in enumerate(uris))
+
+    @classmethod
+    def _filter_query(cls, query, user, authorization_enabled):
         if query is None:
             query = {}
         if authorization_enabled is None:
@@ -86,10 +196,7 @@ class Annotation(es.Model):
                 filtered_query['filtered']['query'] = query['query']
             # Use the filtered query instead of the original
             query['query'] = filtered_query
-
-        res = super(Annotation, cls).search_raw(query=query, params=params,
-                                                raw_result=raw_result)
-        return res
+        return query
 
     @classmethod
     def _build_query(cls, query=None, offset=None, limit=None, sort=None, order=None):
@@ -124,23 +231,44 @@ class Annotation(es.Model):
         # using information we may have on hand about the Document
         if 'uri' in query:
             clauses = q['query']['bool']
-            doc = document.Document.get_by_uri(query['uri'])
-            if doc:
+            uris = document.Document.equivalent_uris(query['uri'])
+            if uris:
                 for clause in clauses['must']:
                     # Rewrite the 'uri' clause to match any of the document URIs
                     if 'match' in clause and 'uri' in clause['match']:
-                        uri_matchers = []
-                        for uri in doc.uris():
-                            uri_matchers.append({'match': {'uri': uri}})
                         del clause['match']
-                        clause['bool'] = {
-                            'should': uri_matchers,
-                            'minimum_should_match': 1
-                        }
+                        clause.update(_uri_clause(query['uri'], uris))
 
         return q
 
 
+def _uri_clause(uri, equivalents):
+    """Returns a query matching the URI, or any of its equivalent URIs."""
+    if not equivalents:
+        return {'match': {'uri': uri}}
+    return {'bool': {
+        'should': [{'match': {'uri': u}} for u in equivalents],
+        'minimum_should_match': 1
+    }}
+
+
 def _add_default_permissions(ann):
     if 'permissions' not in ann:
         ann['permissions'] = {'read': [authz.GROUP_CONSUMER]}
+
+
+def _save_documents(annotations, document_queue=None):
+    # If the annotations include document metadata look to see if we have the
+    # documents modeled already. If we don't we'll create new ones. If we do
+    # then we'll merge the supplied links into them.
+    #
+    # Documents sharing a URI are merged together first, so that each
+    # equivalence class is only looked up and saved once per batch.
+    docs = [document.Document(a['document'])
+            for a in annotations if 'document' in a]
+    if document_queue is not None:
+        for d in docs:
+            document_queue.put(d)
+    else:
+        for d in document.coalesce(docs):
+            d.save()
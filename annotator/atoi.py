@@ -1,5 +1,7 @@
 def atoi(v, default=0):
+    if v is None or v == '':
+        return default
     try:
-        return int(v or default)
-    except ValueError:
+        return int(v)
+    except (TypeError, ValueError):
         return default
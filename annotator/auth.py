@@ -1,15 +1,26 @@
 import datetime
+import json
+import logging
+import os
+import threading
+import time
 
 import iso8601
 import jwt
 import six
 
+from annotator.cache import LRUCache, MISSING
+
 DEFAULT_TTL = 86400
 
+log = logging.getLogger(__name__)
+
 
 class Consumer(object):
-    def __init__(self, key):
+    def __init__(self, key, secret=None, ttl=DEFAULT_TTL):
         self.key = key
+        self.secret = secret
+        self.ttl = ttl
 
 
 class User(object):
@@ -32,14 +43,18 @@ class Authenticator(object):
     formatted, invalid, or malicious tokens.
     """
 
-    def __init__(self, consumer_fetcher):
+    def __init__(self, consumer_fetcher, cache=None):
         """
         Arguments:
         consumer_fetcher -- a function which takes a consumer key and returns
                             an object with 'key', 'secret', and 'ttl'
                             attributes
+        cache -- an optional annotator.cache.LRUCache in which to keep the
+                 users of verified tokens until the tokens expire. It may be
+                 shared between Authenticator instances.
         """
         self.consumer_fetcher = consumer_fetcher
+        self.cache = cache
 
     def request_user(self, request):
         """
@@ -50,16 +65,33 @@ class Authenticator(object):
 
         Returns: a user object
         """
-        token = self._decode_request_token(request)
+        raw_token = request.headers.get('x-annotator-auth-token')
 
-        if token:
-            try:
-                return User.from_token(token)
-            except KeyError:
-                return None
-        else:
+        # A token which was verified before is valid until it expires, so
+        # there's no need to check its signature again
+        if raw_token is not None and self.cache is not None:
+            user = self.cache.get(raw_token)
+            if user is not MISSING:
+                return user
+
+        token, consumer = self._verify_request_token(request)
+
+        if not token:
             return None
 
+        try:
+            user = User.from_token(token)
+        except KeyError:
+            user = None
+
+        if self.cache is not None:
+            expires_in = _token_expiry(token, consumer.ttl) - _now()
+            ttl = expires_in.days * 86400 + expires_in.seconds
+            if ttl > 0:
+                self.cache.set(raw_token, user, ttl=ttl)
+
+        return user
+
     def _decode_request_token(self, request):
         """
         Retrieve any request token from the passed request, verify its
@@ -69,30 +101,134 @@ class Authenticator(object):
         Arguments:
         request -- a Flask Request object
         """
+        return self._verify_request_token(request)[0]
 
+    def _verify_request_token(self, request):
+        # As _decode_request_token, but returns the token's consumer as well
         token = request.headers.get('x-annotator-auth-token')
         if token is None:
-            return False
+            return False, None
 
         try:
             unsafe_token = decode_token(token, verify=False)
         except TokenInvalid:  # catch junk tokens
-            return False
+            return False, None
 
         key = unsafe_token.get('consumerKey')
         if not key:
-            return False
+            return False, None
 
         consumer = self.consumer_fetcher(key)
         if not consumer:
-            return False
+            return False, None
 
         try:
             return decode_token(token,
                                 secret=consumer.secret,
-                                ttl=consumer.ttl)
+                                ttl=consumer.ttl), consumer
         except TokenInvalid:  # catch inauthentic or expired tokens
-            return False
+            return False, None
+
+
+class ConsumerRegistry(object):
+    """
+    A consumer_fetcher for Authenticator which looks consumers up in a local
+    file and/or with another fetcher, remembering the results.
+
+    Found consumers are kept for ttl seconds, and keys which weren't found for
+    negative_ttl seconds, in separate caches, so that tokens with made up
+    consumer keys neither reach the wrapped fetcher repeatedly nor push real
+    consumers out of the cache.
+    """
+
+    def __init__(self, fetcher=None, path=None, ttl=300, negative_ttl=60,
+                 maxsize=1000, reload_interval=5, timer=time.time):
+        """
+        Arguments:
+        fetcher -- a function which takes a consumer key and returns an object
+                   with 'key', 'secret', and 'ttl' attributes, or None
+        path -- a JSON file mapping consumer keys to objects with 'secret' and
+                (optionally) 'ttl' properties. It is read again when it
+                changes, at most every reload_interval seconds.
+        ttl -- the number of seconds to remember a fetched consumer for
+        negative_ttl -- the number of seconds to remember a missing key for
+        maxsize -- the maximum number of keys to remember in each cache
+        timer -- a function returning the current time in seconds
+        """
+        self.fetcher = fetcher
+        self.path = path
+        self.reload_interval = reload_interval
+        self.timer = timer
+
+        self.found = LRUCache(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.missing = LRUCache(maxsize=maxsize, ttl=negative_ttl,
+                                timer=timer)
+
+        self._file_consumers = {}
+        self._file_mtime = None
+        self._file_checked = None
+        self._lock = threading.Lock()
+
+        if self.path is not None:
+            self.reload()
+
+    def __call__(self, key):
+        if self.path is not None:
+            if self.timer() - self._file_checked >= self.reload_interval:
+                self.reload()
+            consumer = self._file_consumers.get(key)
+            if consumer is not None:
+                return consumer
+
+        if self.fetcher is None:
+            return None
+
+        consumer = self.found.get(key)
+        if consumer is not MISSING:
+            return consumer
+        if self.missing.get(key) is not MISSING:
+            return None
+
+        consumer = self.fetcher(key)
+        if consumer:
+            self.found.set(key, consumer)
+        else:
+            self.missing.set(key, True)
+        return consumer
+
+    def invalidate(self, key):
+        """Forget anything remembered about the consumer with the given key."""
+        self.found.invalidate(key)
+        self.missing.invalidate(key)
+
+    def reload(self):
+        """Read the consumers file again if it has changed."""
+        with self._lock:
+            self._file_checked = self.timer()
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError as e:
+                log.warning("could not stat consumers file %s: %s",
+                            self.path, e)
+                return
+            if mtime == self._file_mtime:
+                return
+
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                consumers = dict(
+                    (key, Consumer(key, c['secret'], c.get('ttl', DEFAULT_TTL)))
+                    for key, c in six.iteritems(data))
+            except (IOError, ValueError, KeyError, TypeError,
+                    AttributeError) as e:
+                # Keep the consumers we have until the file is fixed
+                log.error("could not load consumers file %s: %s",
+                          self.path, e)
+                return
+
+            self._file_consumers = consumers
+            self._file_mtime = mtime
 
 
 class TokenInvalid(Exception):
@@ -137,5 +273,10 @@ def decode_token(token, secret='', ttl=DEFAULT_TTL, verify=True):
     return token
 
 
+def _token_expiry(token, ttl):
+    issue_time = iso8601.parse_date(token['issuedAt'])
+    return issue_time + datetime.timedelta(seconds=ttl)
+
+
 def _now():
     return datetime.datetime.now(iso8601.iso8601.UTC).replace(microsecond=0)
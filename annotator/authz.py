@@ -17,11 +17,29 @@
 #    permissions field for the specified action
 #
 # 6) the consumer matches that of the annotation and the user is an admin
+#
+# To search efficiently, each annotation's read permissions are also stored in
+# a flat 'readers' field (see annotation_readers) as a list of principals: the
+# magic values 'world' and 'authenticated', 'consumer:<key>', 'admin:<key>'
+# and 'user:["<key>","<id>"]' (JSON, as either part may contain a colon). A
+# user can read the annotation if one of their own principals (see
+# user_principals) is in the list.
+
+import json
+
+from six import string_types
+
+from annotator.cache import LRUCache, MISSING
 
 GROUP_WORLD = 'group:__world__'
 GROUP_AUTHENTICATED = 'group:__authenticated__'
 GROUP_CONSUMER = 'group:__consumer__'
 
+# The most recently used permissions filters, keyed by the user attributes
+# they depend on
+FILTER_CACHE_SIZE = 1000
+_filter_cache = LRUCache(maxsize=FILTER_CACHE_SIZE)
+
 
 def authorize(annotation, action, user=None):
     action_field = annotation.get('permissions', {}).get(action, [])
@@ -73,41 +91,80 @@ def _annotation_owner(annotation):
         return (user, consumer)
 
 
-def permissions_filter(user=None):
-    """Filter an ElasticSearch query by the permissions of the current user"""
+def annotation_readers(annotation):
+    """Returns the principals which may read the annotation, as a list"""
+    action_field = annotation.get('permissions', {}).get('read', [])
+    ann_uid, ann_ckey = _annotation_owner(annotation)
+    readers = []
 
     # Scenario 1
-    perm_f = {'term': {'permissions.read': GROUP_WORLD}}
-
-    if user is not None:
-        # Fail fast if this looks dodgy
-        if user.id.startswith('group:'):
-            return False
+    if GROUP_WORLD in action_field:
+        readers.append('world')
 
-        perm_f = {'or': [perm_f]}
+    # Scenario 3
+    if GROUP_AUTHENTICATED in action_field:
+        readers.append('authenticated')
 
+    if ann_ckey:
         # Scenario 2
-        perm_f['or'].append(
-            {'and': [{'term': {'consumer': user.consumer.key}},
-                     {'or': [{'term': {'user': user.id}},
-                             {'term': {'user.id': user.id}}]}]})
-
-        # Scenario 3
-        perm_f['or'].append(
-            {'term': {'permissions.read': GROUP_AUTHENTICATED}})
+        if ann_uid:
+            readers.append(_user_principal(ann_ckey, ann_uid))
 
         # Scenario 4
-        perm_f['or'].append(
-            {'and': [{'term': {'consumer': user.consumer.key}},
-                     {'term': {'permissions.read': GROUP_CONSUMER}}]})
+        if GROUP_CONSUMER in action_field:
+            readers.append('consumer:' + ann_ckey)
 
         # Scenario 5
-        perm_f['or'].append(
-            {'and': [{'term': {'consumer': user.consumer.key}},
-                     {'term': {'permissions.read': user.id}}]})
+        for principal in action_field:
+            if (isinstance(principal, string_types) and
+                    not principal.startswith('group:')):
+                readers.append(_user_principal(ann_ckey, principal))
 
         # Scenario 6
-        if user.is_admin:
-            perm_f['or'].append({'term': {'consumer': user.consumer.key}})
+        readers.append('admin:' + ann_ckey)
+
+    # Keep the order, for tidiness
+    seen = set()
+    return [r for r in readers if not (r in seen or seen.add(r))]
+
+
+def user_principals(user=None):
+    """Returns the principals the user holds, as a list"""
+    if user is None:
+        return ['world']
 
+    principals = ['world',
+                  'authenticated',
+                  'consumer:' + user.consumer.key,
+                  _user_principal(user.consumer.key, user.id)]
+    if user.is_admin:
+        principals.append('admin:' + user.consumer.key)
+    return principals
+
+
+def _user_principal(consumer_key, userid):
+    # Encode the pair so that 'a:b' and 'c' can't be confused with 'a' and 'b:c'
+    return 'user:' + json.dumps([consumer_key, userid], separators=(',', ':'))
+
+
+def permissions_filter(user=None):
+    """
+    Filter an ElasticSearch query by the permissions of the current user
+
+    The filter is a single terms filter on the 'readers' field, which
+    ElasticSearch can cache. Filters are memoized per user, and the same dict
+    may be returned to several callers: it must not be modified.
+    """
+    if user is None:
+        return {'terms': {'readers': user_principals()}}
+
+    # Fail fast if this looks dodgy
+    if user.id.startswith('group:'):
+        return False
+
+    key = (user.id, user.consumer.key, bool(user.is_admin))
+    perm_f = _filter_cache.get(key)
+    if perm_f is MISSING:
+        perm_f = {'terms': {'readers': user_principals(user)}}
+        _filter_cache.set(key, perm_f)
     return perm_f
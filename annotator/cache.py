@@ -0,0 +1,120 @@
+"""
+A small, thread-safe, in-process cache with LRU eviction and optional expiry,
+used to avoid repeated Elasticsearch round trips for hot data.
+"""
+import threading
+import time
+
+MISSING = object()
+
+# The fields of a linked list node
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """
+    A bounded mapping which evicts the least recently used entry once it holds
+    maxsize entries, and treats entries older than ttl seconds as absent.
+
+    Hit, miss and eviction counts are kept so the cache can be sized.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None, timer=time.time):
+        """
+        Arguments:
+        maxsize -- the maximum number of entries to keep
+        ttl -- the default number of seconds an entry is valid for (None means
+               entries never expire)
+        timer -- a function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Entries are kept in a dict of the nodes of a circular doubly linked
+        # list, ordered from least to most recently used. (OrderedDict would
+        # do, but isn't available on Python 2.6.)
+        self._data = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """
+        Return the value stored for key, or default if there is none or it has
+        expired. The default is a sentinel so that None can be cached.
+        """
+        with self._lock:
+            node = self._data.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+
+            if node[EXPIRES] is not None and node[EXPIRES] <= self.timer():
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            # Move to the end to mark the entry as most recently used
+            self._unlink(node)
+            self._append(node)
+            self.hits += 1
+            return node[VALUE]
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, expiring after ttl (or the default) seconds."""
+        if ttl is None:
+            ttl = self.ttl
+        expires = self.timer() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._remove(key)
+            node = [None, None, key, value, expires]
+            self._append(node)
+            self._data[key] = node
+            while len(self._data) > self.maxsize:
+                self._remove(self._root[NEXT][KEY])
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+
+    def stats(self):
+        """Return the cache counters and current size as a dict."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+    def _append(self, node):
+        last = self._root[PREV]
+        node[PREV] = last
+        node[NEXT] = self._root
+        last[NEXT] = node
+        self._root[PREV] = node
+
+    def _unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+
+    def _remove(self, key):
+        node = self._data.pop(key, None)
+        if node is not None:
+            self._unlink(node)
@@ -1,4 +1,13 @@
-from annotator import es
+import logging
+import threading
+import uuid
+
+from six.moves import queue
+
+from annotator import es, metrics
+from annotator.cache import MISSING
+
+log = logging.getLogger(__name__)
 
 TYPE = 'document'
 MAPPING = {
@@ -7,6 +16,7 @@ MAPPING = {
     'created': {'type': 'date'},
     'updated': {'type': 'date'},
     'title': {'type': 'string', 'analyzer': 'standard'},
+    'cluster': {'type': 'string'},
     'link': {
         'type': 'nested',
         'properties': {
@@ -24,13 +34,20 @@ MAPPING = {
         }
     }
 }
-MAX_ITERATIONS = 5
+
+# The most extra lookups made to follow the links of documents saved before
+# clusters existed, as the lookup of all equivalent documents used to
+MAX_LEGACY_ITERATIONS = 5
 
 
 class Document(es.Model):
     __type__ = TYPE
     __mapping__ = MAPPING
 
+    # An optional annotator.cache.LRUCache mapping a URI to the list of URIs
+    # of its document, used by equivalent_uris()
+    uri_cache = None
+
     @classmethod
     def get_by_uri(cls, uri):
         """Returns the first document match for a given URI."""
@@ -38,9 +55,75 @@ class Document(es.Model):
         return results[0] if len(results) > 0 else None
 
     @classmethod
-    def _get_all_by_uris(cls, uris):
+    def equivalent_uris(cls, uri):
+        """
+        Returns the URIs of the document matching the given URI, or an empty
+        list if there is no such document. Results are kept in uri_cache, if
+        one is set.
+        """
+        if cls.uri_cache is not None:
+            uris = cls.uri_cache.get(uri)
+            if uris is not MISSING:
+                return list(uris)
+
+        doc = cls.get_by_uri(uri)
+        uris = doc.uris() if doc else []
+
+        if cls.uri_cache is not None:
+            cls.uri_cache.set(uri, tuple(uris))
+        return uris
+
+    @classmethod
+    def equivalent_uris_many(cls, uris):
+        """
+        Like equivalent_uris, for several URIs at once. Returns a dict of the
+        URIs of the document matching each of the given URIs. Those not in
+        uri_cache are looked up with a single query.
         """
-        Returns a list of documents that have any of the supplied URIs.
+        results = {}
+        missing = []
+        for uri in uris:
+            if uri in results or uri in missing:
+                continue
+            cached = MISSING
+            if cls.uri_cache is not None:
+                cached = cls.uri_cache.get(uri)
+            if cached is MISSING:
+                missing.append(uri)
+            else:
+                results[uri] = list(cached)
+
+        if not missing:
+            return results
+
+        # Leave room for a URI to match a few documents
+        size = 2 * len(missing)
+        docs = cls._get_all_by_uris(missing, size=size)
+
+        found = {}
+        wanted = set(missing)
+        for doc in docs:
+            # Documents come oldest first, as for get_by_uri
+            doc_uris = doc.uris()
+            for uri in doc_uris:
+                if uri in wanted and uri not in found:
+                    found[uri] = doc_uris
+
+        for uri in missing:
+            if uri not in found and len(docs) >= size:
+                # Its document may not have made the cut
+                results[uri] = cls.equivalent_uris(uri)
+                continue
+            results[uri] = found.get(uri, [])
+            if cls.uri_cache is not None:
+                cls.uri_cache.set(uri, tuple(results[uri]))
+        return results
+
+    @classmethod
+    def _get_all_by_uris(cls, uris, size=None):
+        """
+        Returns a list of documents that have any of the supplied URIs, at
+        most size of them (Elasticsearch's default if None).
 
         It is only necessary for one of the supplied URIs to match.
         """
@@ -56,10 +139,13 @@ class Document(es.Model):
                                    # 'updated' appears unmapped due to an empty
                                    # index.
                                    'ignore_unmapped': True}}]}
+        if size is not None:
+            q['size'] = size
 
-        res = cls.es.conn.search(index=cls.es.index,
-                                 doc_type=cls.__type__,
-                                 body=q)
+        res = metrics.es_call('search', cls.es.conn.search,
+                              index=cls.es.index,
+                              doc_type=cls.__type__,
+                              body=q)
         return [cls(d['_source'], id=d['_id']) for d in res['hits']['hits']]
 
     def uris(self):
@@ -80,33 +166,31 @@ class Document(es.Model):
         return uris
 
     @classmethod
-    def _get_all_iterative_for_uris(cls, uris):
+    def _get_cluster_for_uris(cls, uris):
         """
-        Builds an equivalence class (Kleene-star of documents) based on
-        the supplied URIs as seed uris. It loads every document for
-        which at least one supplied URI matches and recursively checks
-        the uris of the retrieved documents and use the new URIs as
-        seed URIs for the next iteration.
-
-        Finally returns a list of documents that have any of the
-        collected URIs
+        Returns the equivalence class of documents for the supplied URIs.
+
+        Each save merges the documents of its cluster into a single document
+        holding every URI of the cluster, so one query on the URIs finds the
+        whole class. Documents saved before clusters were introduced may only
+        be linked through each other's URIs, so the links of those are
+        followed, a bounded number of times.
         """
-        documents = {}
-        all_uris = set(uris)
-        new_uris = list(uris)
+        documents = dict()
+        seen_uris = set(uris)
+
+        found = cls._get_all_by_uris(uris)
         iterations = 0
+        while True:
+            for d in found:
+                documents.setdefault(d['id'], d)
 
-        while len(new_uris) and iterations < MAX_ITERATIONS:
-            docs = cls._get_all_by_uris(new_uris)
-            new_uris = []
-            for doc in docs:
-                if doc['id'] not in documents:
-                    documents[doc['id']] = doc
-
-                    for uri in doc.uris():
-                        if uri not in all_uris:
-                            new_uris.append(uri)
-                            all_uris.add(uri)
+            legacy_uris = set(u for d in found if 'cluster' not in d
+                              for u in d.uris()) - seen_uris
+            if not legacy_uris or iterations >= MAX_LEGACY_ITERATIONS:
+                break
+            seen_uris.update(legacy_uris)
+            found = cls._get_all_by_uris(sorted(legacy_uris))
             iterations += 1
 
         return list(documents.values())
@@ -140,7 +224,14 @@ class Document(es.Model):
             bulk_list.append(bulk_item)
             bulk_list.append(index_item)
 
-        cls.es.conn.bulk(body=bulk_list, refresh=True)
+        metrics.es_call('bulk', cls.es.conn.bulk,
+                        body=bulk_list,
+                        refresh=True)
+
+        for doc in to_delete:
+            cls.invalidate(doc['id'])
+        for doc in to_index:
+            cls.invalidate(doc['id'])
 
     def save(self):
         """Saves document metadata, looks for existing documents and
@@ -149,13 +240,17 @@ class Document(es.Model):
         uris = self.uris()
 
         # Get existing documents
-        existing_docs = self._get_all_iterative_for_uris(uris)
+        existing_docs = self._get_cluster_for_uris(uris)
 
         # Create a new document if none existed for these uris
         if len(existing_docs) == 0:
+            self['cluster'] = uuid.uuid4().hex
             super(Document, self).save()
         # Merge links from all docs into this
         else:
+            # Union the clusters, keeping the smallest id so that concurrent
+            # merges of overlapping clusters agree on the result
+            self['cluster'] = min(_cluster_of(d) for d in existing_docs)
             for d in existing_docs:
                 links = d.get('link', [])
                 self.merge_links(links)
@@ -164,3 +259,144 @@ class Document(es.Model):
             # A separate operation because we want to save
             # the document id if it didn't have any before
             super(Document, self).save()
+
+        # Every URI of the merged document now resolves to the same document
+        if self.uri_cache is not None:
+            uris = tuple(self.uris())
+            for uri in uris:
+                self.uri_cache.set(uri, uris)
+
+
+class MergeQueue(object):
+    """
+    Saves (and so merges) documents in background threads rather than in the
+    request that supplied them.
+
+    Documents which share a URI with one that is still waiting in the queue
+    are coalesced into it, and documents sharing a URI are never saved
+    concurrently, so each equivalence class is merged by one thread at a time.
+    """
+
+    def __init__(self, workers=2):
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._active = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+        self._threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def put(self, doc):
+        """Queue a document to be saved."""
+        doc._remove_deficient_links()
+        uris = doc.uris()
+
+        with self._lock:
+            queued = None
+            for uri in uris:
+                if uri in self._pending:
+                    queued = self._pending[uri]
+                    break
+
+            if queued is None:
+                for uri in uris:
+                    self._pending[uri] = doc
+                self._queue.put(doc)
+                return
+
+            _merge_into(queued, doc)
+            for uri in uris:
+                self._pending.setdefault(uri, queued)
+
+    def join(self):
+        """Block until every queued document has been saved."""
+        self._queue.join()
+
+    def stop(self):
+        """Save the queued documents and stop the worker threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            doc = self._queue.get()
+            try:
+                if doc is None:
+                    return
+                self._save(doc)
+            finally:
+                self._queue.task_done()
+
+    def _save(self, doc):
+        with self._lock:
+            uris = set(doc.uris())
+            for uri in uris:
+                if self._pending.get(uri) is doc:
+                    del self._pending[uri]
+
+            while self._active & uris:
+                self._idle.wait()
+            self._active |= uris
+
+        try:
+            doc.save()
+        except Exception:
+            log.exception("Failed to save document for %s", sorted(uris))
+        finally:
+            with self._lock:
+                self._active -= uris
+                self._idle.notify_all()
+
+
+def coalesce(docs):
+    """
+    Merge the documents which share a URI, directly or through one another,
+    so that each equivalence class in a batch is saved only once. Returns the
+    merged documents.
+    """
+    merged = []
+    by_uri = {}
+    for doc in docs:
+        doc._remove_deficient_links()
+
+        targets = []
+        for uri in doc.uris():
+            target = by_uri.get(uri)
+            if target is not None and not any(t is target for t in targets):
+                targets.append(target)
+
+        if not targets:
+            merged.append(doc)
+            for uri in doc.uris():
+                by_uri[uri] = doc
+            continue
+
+        target = targets[0]
+        for other in targets[1:] + [doc]:
+            _merge_into(target, other)
+        merged = [d for d in merged if not any(d is t for t in targets[1:])]
+        for uri in target.uris():
+            by_uri[uri] = target
+
+    return merged
+
+
+def _merge_into(target, doc):
+    # The newer metadata wins, as it would if the documents were saved one
+    # after the other
+    links = target['link']
+    target.update(doc)
+    target['link'] = links
+    target.merge_links(doc['link'])
+
+
+def _cluster_of(doc):
+    return doc.get('cluster') or doc['id']
@@ -1,19 +1,32 @@
 from __future__ import absolute_import
 
+import copy
+import gzip
+import io
 import logging
 import datetime
+import threading
+import time
+import uuid
 
 import iso8601
 
 import elasticsearch
-from six import iteritems
+import urllib3
+from six import iteritems, string_types
 from six.moves.urllib.parse import urlparse
 
+from annotator import metrics
+from annotator.cache import MISSING
+
 log = logging.getLogger(__name__)
 
 RESULTS_MAX_SIZE = 200
 RESULTS_DEFAULT_SIZE = 20
 
+# The aggregation counting every match of a search paged with search_after
+TOTAL_AGGREGATION = 'total_matches'
+
 
 class ElasticSearch(object):
     """
@@ -22,40 +35,70 @@ class ElasticSearch(object):
 
     Settings for the ES host and index name etcetera can still be changed in
     the corresponding attributes before the connection (self.conn) is used.
+
+    The host may be a single URL or a list of URLs of nodes in the cluster.
+    The URL 'memory://' keeps documents in process instead, using
+    annotator.memory.MemoryElasticsearch in place of a client.
+    The remaining connection settings are:
+
+    maxsize -- Maximum number of connections kept open to each node
+    pool_block -- Wait for one of the maxsize connections to a node to be free
+                  rather than open a new one (which is closed after use). This
+                  bounds the number of concurrent requests to each node, e.g.
+                  when serving many requests with gevent.
+    sniff_on_start -- Discover the other cluster nodes when connecting
+    sniff_on_connection_fail -- Rediscover the cluster nodes when a node fails
+    sniffer_timeout -- Seconds between periodic node discovery (None disables)
+    dead_timeout -- Seconds a failed node is left out before being retried
+    keep_alive -- Reuse HTTP connections between requests
+    compress -- Gzip request bodies and accept gzipped responses
     """
 
     def __init__(self,
                  host='http://127.0.0.1:9200',
                  index='annotator',
-                 authorization_enabled=False):
+                 authorization_enabled=False,
+                 maxsize=10,
+                 pool_block=False,
+                 sniff_on_start=False,
+                 sniff_on_connection_fail=False,
+                 sniffer_timeout=None,
+                 dead_timeout=60,
+                 keep_alive=True,
+                 compress=False):
         self.host = host
         self.index = index
         self.authorization_enabled = authorization_enabled
+        self.maxsize = maxsize
+        self.pool_block = pool_block
+        self.sniff_on_start = sniff_on_start
+        self.sniff_on_connection_fail = sniff_on_connection_fail
+        self.sniffer_timeout = sniffer_timeout
+        self.dead_timeout = dead_timeout
+        self.keep_alive = keep_alive
+        self.compress = compress
 
         self.Model = make_model(self)
 
     def _connect(self):
-        host = self.host
-        parsed = urlparse(host)
-
-        connargs = {
-            'host': parsed.hostname,
-        }
-
-        username = parsed.username
-        password = parsed.password
-        if username is not None or password is not None:
-            connargs['http_auth'] = ((username or ''), (password or ''))
-
-        if parsed.port is not None:
-            connargs['port'] = parsed.port
-
-        if parsed.path:
-            connargs['url_prefix'] = parsed.path
+        hosts = self.host
+        if isinstance(hosts, string_types):
+            if hosts.startswith('memory:'):
+                from annotator.memory import MemoryElasticsearch
+                return MemoryElasticsearch()
+            hosts = [hosts]
 
         conn = elasticsearch.Elasticsearch(
-            hosts=[connargs],
-            connection_class=elasticsearch.Urllib3HttpConnection)
+            hosts=[_parse_host(h) for h in hosts],
+            connection_class=Urllib3HttpConnection,
+            maxsize=self.maxsize,
+            pool_block=self.pool_block,
+            sniff_on_start=self.sniff_on_start,
+            sniff_on_connection_fail=self.sniff_on_connection_fail,
+            sniffer_timeout=self.sniffer_timeout,
+            dead_timeout=self.dead_timeout,
+            keep_alive=self.keep_alive,
+            compress=self.compress)
         return conn
 
     @property
@@ -65,6 +108,70 @@ class ElasticSearch(object):
         return self._connection
 
 
+class Urllib3HttpConnection(elasticsearch.Urllib3HttpConnection):
+    """
+    Connection class which can optionally disable HTTP keep-alive, gzip
+    request bodies and block on a full connection pool.
+    """
+
+    def __init__(self, keep_alive=True, compress=False, pool_block=False,
+                 **kwargs):
+        self._local = threading.local()
+        super(Urllib3HttpConnection, self).__init__(**kwargs)
+        self.compress = compress
+        self.pool.block = pool_block
+        if not keep_alive:
+            self.headers['connection'] = 'close'
+        if compress:
+            self.headers.update(urllib3.make_headers(accept_encoding=True))
+
+    # Connections are shared between threads, so per-request headers are kept
+    # in a thread local rather than by modifying the shared headers.
+    @property
+    def headers(self):
+        return getattr(self._local, 'headers', None) or self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        if not self.compress or body is None:
+            return super(Urllib3HttpConnection, self).perform_request(
+                method, url, params=params, body=body, timeout=timeout,
+                ignore=ignore)
+
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        buf = io.BytesIO()
+        # GzipFile is only a context manager from Python 2.7
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(body)
+        f.close()
+
+        self._local.headers = dict(self._headers, **{'content-encoding': 'gzip'})
+        self._local.body = body
+        try:
+            return super(Urllib3HttpConnection, self).perform_request(
+                method, url, params=params, body=buf.getvalue(),
+                timeout=timeout, ignore=ignore)
+        finally:
+            self._local.headers = None
+            self._local.body = None
+
+    # Log the uncompressed body, as the base class expects it to be text.
+    def log_request_success(self, method, full_url, path, body, *args):
+        body = getattr(self._local, 'body', None) or body
+        return super(Urllib3HttpConnection, self).log_request_success(
+            method, full_url, path, body, *args)
+
+    def log_request_fail(self, method, full_url, body, *args, **kwargs):
+        body = getattr(self._local, 'body', None) or body
+        return super(Urllib3HttpConnection, self).log_request_fail(
+            method, full_url, body, *args, **kwargs)
+
+
 class _Model(dict):
     """Base class that represents a document type in an ElasticSearch index.
 
@@ -83,8 +190,20 @@ class _Model(dict):
        performed: searching for these fields will be exact and case sensitive.
        To make a field full-text searchable, its mapping should configure it
        with 'analyzer':'standard'.
+
+       Caching: if a child class sets the 'cache' attribute to an
+       annotator.cache.LRUCache, fetch() and fetch_many() read through it,
+       remembering documents that were not found as well. Writes made through
+       the model invalidate the cached entries.
+
+       Write buffering: if a child class sets the 'write_buffer' attribute to
+       a WriteBuffer, save() and delete() are sent to Elasticsearch in bulk
+       together with other buffered writes.
     """
 
+    cache = None
+    write_buffer = None
+
     @classmethod
     def create_all(cls):
         log.info("Creating index '%s'.", cls.es.index)
@@ -119,14 +238,106 @@ class _Model(dict):
     # It would be lovely if this were called 'get', but the dict semantics
     # already define that method name.
     @classmethod
-    def fetch(cls, docid):
-        doc = cls.es.conn.get(index=cls.es.index,
+    def fetch(cls, docid, fields=None):
+        """Fetch the document with the given id, or None if there is none.
+
+        Keyword arguments:
+        fields -- Only return these fields. Names prefixed with '-' are left
+                  out instead. Projected documents bypass the cache.
+        """
+        if fields is not None:
+            doc = metrics.es_call('fetch', cls.es.conn.get,
+                                  index=cls.es.index,
+                                  doc_type=cls.__type__,
+                                  ignore=404,
+                                  id=docid,
+                                  **_source_params(fields))
+            if doc.get('found', True):
+                return cls(doc.get('_source', {}), id=docid)
+            return None
+
+        if cls.cache is not None:
+            source = cls.cache.get(docid)
+            if source is not MISSING:
+                return cls._from_cache(source, docid)
+
+        doc = metrics.es_call('fetch', cls.es.conn.get,
+                              index=cls.es.index,
                               doc_type=cls.__type__,
                               ignore=404,
                               id=docid)
-        if doc.get('found', True):
+        found = doc.get('found', True)
+
+        if cls.cache is not None:
+            cls.cache.set(docid,
+                          copy.deepcopy(doc['_source']) if found else None)
+
+        if found:
             return cls(doc['_source'], id=docid)
 
+    @classmethod
+    def fetch_many(cls, docids, fields=None):
+        """Fetch several documents with a single request.
+
+        Keyword arguments:
+        fields -- Only return these fields, as for fetch. Projected documents
+                  bypass the cache.
+
+        Returns a list in the same order as docids, with None in place of any
+        document that could not be found.
+        """
+        docids = list(docids)
+        results = {}
+
+        if fields is not None:
+            if not docids:
+                return []
+            res = metrics.es_call('fetch_many', cls.es.conn.mget,
+                                  index=cls.es.index,
+                                  doc_type=cls.__type__,
+                                  body={'ids': docids},
+                                  **_source_params(fields))
+            return [cls(d.get('_source', {}), id=docid)
+                    if d.get('found', False) else None
+                    for docid, d in zip(docids, res['docs'])]
+
+        if cls.cache is not None:
+            for docid in docids:
+                source = cls.cache.get(docid)
+                if source is not MISSING:
+                    results[docid] = cls._from_cache(source, docid)
+
+        missing = [docid for docid in docids if docid not in results]
+        if missing:
+            res = metrics.es_call('fetch_many', cls.es.conn.mget,
+                                  index=cls.es.index,
+                                  doc_type=cls.__type__,
+                                  body={'ids': missing})
+            for docid, d in zip(missing, res['docs']):
+                found = d.get('found', False)
+                if cls.cache is not None:
+                    cls.cache.set(docid,
+                                  copy.deepcopy(d['_source']) if found else None)
+                if found:
+                    results[docid] = cls(d['_source'], id=d['_id'])
+                else:
+                    results[docid] = None
+
+        return [results[docid] for docid in docids]
+
+    @classmethod
+    def _from_cache(cls, source, docid):
+        # Cached sources are shared, so hand out copies that can be modified
+        if source is None:
+            return None
+        return cls(copy.deepcopy(source), id=docid)
+
+    @classmethod
+    def invalidate(cls, docid):
+        """Drop any cached copy of the document with the given id."""
+        if cls.cache is not None:
+            cls.cache.invalidate(docid)
+
     @classmethod
     def _build_query(cls, query=None, offset=None, limit=None, sort=None, order=None):
         if offset is None:
@@ -143,12 +354,70 @@ class _Model(dict):
 
     @classmethod
     def search(cls, query=None, offset=0, limit=RESULTS_DEFAULT_SIZE,
-               sort='updated', order='desc', **kwargs):
+               sort='updated', order='desc', fields=None, search_after=None,
+               **kwargs):
+        """Search for documents whose fields match the query
+
+        Keyword arguments:
+        query -- A dict of field values to match
+        offset -- Number of matches to skip
+        limit -- Maximum number of matches to return
+        sort -- The field to sort by
+        order -- The sort order, 'asc' or 'desc'
+        fields -- Only return these fields (see fetch)
+        search_after -- The 'last_sort' of a previous SearchResult for the
+                        same query. Returns the matches following it, which
+                        is cheaper than an offset however deep the page is.
+                        An empty list starts paging this way: it returns the
+                        first page, with a last_sort to continue from.
+        """
+        q = cls._search_query(query=query, offset=offset, limit=limit,
+                              sort=sort, order=order, fields=fields,
+                              search_after=search_after)
+        if not q:
+            return SearchResult()
+        return cls.search_raw(q, **kwargs)
+
+    @classmethod
+    def search_many(cls, searches, **kwargs):
+        """Run several searches with a single Elasticsearch request
+
+        Keyword arguments:
+        searches -- A list of dicts of the keyword arguments to search (query,
+                    offset, limit, sort, order, fields and search_after)
+
+        Other keyword arguments are passed to search_raw_many. Returns a
+        SearchResult for each search, in order.
+        """
+        queries = [cls._search_query(**search) for search in searches]
+        return cls.search_raw_many(queries, **kwargs)
+
+    @classmethod
+    def _search_query(cls, query=None, offset=0, limit=RESULTS_DEFAULT_SIZE,
+                      sort='updated', order='desc', fields=None,
+                      search_after=None):
         q = cls._build_query(query=query, offset=offset, limit=limit,
                              sort=sort, order=order)
         if not q:
-            return []
-        return cls.search_raw(q, **kwargs)
+            return q
+        if fields is not None:
+            q['_source'] = _source_filter(fields)
+        if search_after is not None:
+            # Break ties by id, so that every document has a distinct
+            # position and a page can be continued from its last hit. This is
+            # only done when paging this way, as sorting on _uid loads it for
+            # the whole index into memory.
+            q['sort'].append({'_uid': {'order': order or 'desc'}})
+        if search_after:
+            q['from'] = 0
+            q['post_filter'] = _search_after_filter(sort or 'updated',
+                                                    order or 'desc',
+                                                    search_after)
+            # The post filter narrows the hits and their total to the
+            # matches after the cursor, but not aggregations, which still
+            # count every match
+            q['aggs'] = {TOTAL_AGGREGATION: {'filter': {'match_all': {}}}}
+        return q
 
     @classmethod
     def search_raw(cls, query=None, params=None, raw_result=False):
@@ -160,20 +429,126 @@ class _Model(dict):
         query -- Query to send to Elasticsearch
         params -- Extra keyword arguments to pass to Elasticsearch.search
         raw_result -- Return Elasticsearch's response as is
+
+        Unless raw_result is set, returns a SearchResult which also carries the
+        total number of matches, so no separate count query is needed.
         """
         if query is None:
             query = {}
         if params is None:
             params = {}
-        res = cls.es.conn.search(index=cls.es.index,
-                                 doc_type=cls.__type__,
-                                 body=query,
-                                 **params)
+        operation = ('count' if params.get('search_type') == 'count'
+                     else 'search')
+        res = metrics.es_call(operation, cls.es.conn.search,
+                              index=cls.es.index,
+                              doc_type=cls.__type__,
+                              body=query,
+                              **params)
         if not raw_result:
-            docs = res['hits']['hits']
-            res = [cls(d['_source'], id=d['_id']) for d in docs]
+            res = cls._search_result(res)
         return res
 
+    @classmethod
+    def search_raw_many(cls, queries, raw_result=False):
+        """Perform several raw Elasticsearch queries with a single multi
+        search request
+
+        Keyword arguments:
+        queries -- A list of queries to send to Elasticsearch
+        raw_result -- Return Elasticsearch's responses as they are
+
+        Returns a response (or SearchResult) for each query, in order. If any
+        of the queries fails, a TransportError is raised for the first.
+        """
+        body = []
+        for query in queries:
+            body.append({})
+            body.append(query)
+        res = metrics.es_call('msearch', cls.es.conn.msearch,
+                              index=cls.es.index,
+                              doc_type=cls.__type__,
+                              body=body)
+
+        responses = res['responses']
+        for r in responses:
+            if 'error' in r:
+                raise elasticsearch.TransportError(r.get('status', 400),
+                                                   r['error'])
+        if not raw_result:
+            responses = [cls._search_result(r) for r in responses]
+        return responses
+
+    @classmethod
+    def _search_result(cls, res):
+        docs = res['hits']['hits']
+        total = res['hits']['total']
+        matches = res.get('aggregations', {}).get(TOTAL_AGGREGATION)
+        if matches is not None:
+            total = matches['doc_count']
+        return SearchResult([cls(d.get('_source', {}), id=d['_id'])
+                             for d in docs],
+                            total=total,
+                            took=res.get('took'),
+                            last_sort=docs[-1].get('sort') if docs else None)
+
+    @classmethod
+    def scan(cls, query=None, **kwargs):
+        """Like search, but yields every match rather than a page of them.
+
+        Matches are fetched in batches using a scroll, so memory use does not
+        grow with the number of matches. They are yielded in no set order.
+        """
+        q = cls._build_query(query=query)
+        return cls.scan_raw({'query': q['query']}, **kwargs)
+
+    @classmethod
+    def scan_raw(cls, query=None, scroll='1m', size=RESULTS_MAX_SIZE):
+        """Yield every document matching a raw Elasticsearch query
+
+        Keyword arguments:
+        query -- Query to send to Elasticsearch
+        scroll -- How long Elasticsearch should keep the scroll open between
+                  batches
+        size -- Number of documents to fetch per shard in each batch
+        """
+        # The same calls as elasticsearch.helpers.scan, made through es_call
+        # so that they are counted and logged like any other
+        res = metrics.es_call('search', cls.es.conn.search,
+                              index=cls.es.index,
+                              doc_type=cls.__type__,
+                              body=query,
+                              search_type='scan',
+                              scroll=scroll,
+                              size=size)
+        scroll_id = res.get('_scroll_id')
+        while scroll_id is not None:
+            res = metrics.es_call('scroll', cls.es.conn.scroll,
+                                  scroll_id=scroll_id,
+                                  scroll=scroll)
+            hits = res['hits']['hits']
+            if not hits:
+                break
+            for d in hits:
+                yield cls(d['_source'], id=d['_id'])
+            scroll_id = res.get('_scroll_id')
+
+    @classmethod
+    def aggregate(cls, aggs, query=None, **kwargs):
+        """Run Elasticsearch aggregations over the documents matching the
+        query, without fetching any of the documents themselves.
+
+        Keyword arguments:
+        aggs -- The aggregations to run, as in an Elasticsearch request
+        query -- A dict of field values to match, as for search
+
+        Other keyword arguments are passed to search_raw. Returns the total
+        number of matches and the aggregation results, by name.
+        """
+        q = cls._build_query(query=query)
+        body = {'query': q['query'], 'aggs': aggs, 'size': 0}
+        res = cls.search_raw(body, raw_result=True, **kwargs)
+        return res['hits']['total'], res.get('aggregations', {})
+
     @classmethod
     def count(cls, **kwargs):
         """Like search, but only count the number of matches."""
@@ -186,29 +561,283 @@ class _Model(dict):
         _add_created(self)
         _add_updated(self)
 
+        if self.write_buffer is not None:
+            self.write_buffer.save(self, refresh=refresh)
+            return
+
         if 'id' not in self:
             op_type = 'create'
         else:
             op_type = 'index'
 
-        res = self.es.conn.index(index=self.es.index,
-                                 doc_type=self.__type__,
-                                 body=self,
-                                 op_type=op_type,
-                                 refresh=refresh)
+        res = metrics.es_call('index', self.es.conn.index,
+                              index=self.es.index,
+                              doc_type=self.__type__,
+                              body=self,
+                              op_type=op_type,
+                              refresh=refresh)
         self['id'] = res['_id']
+        self.invalidate(self['id'])
+
+    @classmethod
+    def bulk(cls, operations, refresh=True):
+        """Perform several write operations with a single bulk request
+
+        Keyword arguments:
+        operations -- A list of (action, document) pairs, where action is one
+                      of 'create', 'index' or 'delete'
+        refresh -- Force an index refresh after the bulk request
+
+        Returns the per-item results reported by Elasticsearch, in the order of
+        the supplied operations. Documents created successfully have their id
+        set.
+        """
+        for action, doc in operations:
+            if action != 'delete':
+                _add_created(doc)
+                _add_updated(doc)
+        return _bulk(cls.es.conn, operations, refresh)
 
     def delete(self):
         if 'id' in self:
-            self.es.conn.delete(index=self.es.index,
-                                doc_type=self.__type__,
-                                id=self['id'])
+            if self.write_buffer is not None:
+                self.write_buffer.delete(self)
+                return
+            metrics.es_call('delete', self.es.conn.delete,
+                            index=self.es.index,
+                            doc_type=self.__type__,
+                            id=self['id'])
+            self.invalidate(self['id'])
+
+
+class SearchResult(list):
+    """A list of search hits which also records the total number of matches,
+    the time Elasticsearch took to find them and the sort values of the last
+    hit."""
+
+    def __init__(self, hits=(), total=0, took=None, last_sort=None):
+        super(SearchResult, self).__init__(hits)
+        self.total = total
+        self.took = took
+        self.last_sort = last_sort
+
+
+class WriteBuffer(object):
+    """
+    Collects the writes of many model instances and sends them to
+    Elasticsearch as a single bulk request, refreshing the index at most once
+    per request.
+
+    A request is sent once max_size writes are waiting, or window seconds after
+    the first of them arrived. Saves which ask for a refresh, and deletes, block
+    until their request has completed and raise any error it reported. Other
+    saves return as soon as they are buffered, so they are written at most
+    once: if such a write fails it is not retried, but logged at error level
+    with its document and counted in the write_buffer_lost metric.
+
+    Cached copies of a document are invalidated when a write to it is
+    buffered, and again once it is written, so reads in between see the
+    document as Elasticsearch still has it.
+
+    To use it, set the 'write_buffer' attribute of a model class.
+    """
+
+    def __init__(self, es, window=0.05, max_size=500):
+        self.es = es
+        self.window = window
+        self.max_size = max_size
+
+        self._ops = []
+        self._started = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, doc, refresh=True):
+        if 'id' not in doc:
+            # The id is needed before the document is written, so generate it
+            # here rather than leaving it to Elasticsearch
+            doc['id'] = uuid.uuid4().hex
+            action = 'create'
+        else:
+            action = 'index'
+        self._add(action, doc, refresh=refresh, wait=refresh)
+
+    def delete(self, doc):
+        self._add('delete', doc, refresh=False, wait=True)
+
+    def flush(self):
+        """Send any buffered writes now, and wait for them to complete."""
+        with self._lock:
+            if not self._ops:
+                return
+            op = self._ops[-1]
+            self._started = 0
+            self._wakeup.notify()
+        op.done.wait()
+
+    def stop(self):
+        """Send any buffered writes and stop the background thread."""
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join()
+
+    def _add(self, action, doc, refresh, wait):
+        # Copy the document, as the caller may modify it before it is sent
+        op = _BufferedWrite(action, copy.deepcopy(doc), refresh, wait)
+        doc.invalidate(doc['id'])
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Write buffer has been stopped")
+            if not self._ops:
+                self._started = time.time()
+            self._ops.append(op)
+            self._wakeup.notify()
+
+        if wait:
+            op.done.wait()
+            if op.error is not None:
+                raise op.error
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._ops:
+                        remaining = self._started + self.window - time.time()
+                        if (remaining <= 0 or len(self._ops) >= self.max_size
+                                or self._stopped):
+                            break
+                        self._wakeup.wait(remaining)
+                    elif self._stopped:
+                        return
+                    else:
+                        self._wakeup.wait()
+
+                ops = self._ops[:self.max_size]
+                self._ops = self._ops[self.max_size:]
+                self._started = time.time()
+
+            self._flush(ops)
+
+    def _flush(self, ops):
+        refresh = any(op.refresh for op in ops)
+        try:
+            items = _bulk(self.es.conn,
+                          [(op.action, op.doc) for op in ops],
+                          refresh)
+        except Exception as e:
+            log.exception("Bulk write of %d documents failed", len(ops))
+            for op in ops:
+                self._fail(op, e)
+                op.done.set()
+            return
+
+        for op, item in zip(ops, items):
+            result = item[op.action]
+            status = result.get('status', 500)
+            if status >= 300:
+                self._fail(op, elasticsearch.TransportError(
+                    status, result.get('error')))
+            op.done.set()
+
+    def _fail(self, op, error):
+        op.error = error
+        if op.wait:
+            # The caller raises the error
+            log.error("Failed to %s document %s: %s",
+                      op.action, op.doc.get('id'), error)
+            return
+
+        # The caller has already been told the write succeeded, so keep the
+        # document where it can be recovered from
+        log.error("Lost buffered %s of document %s: %s. Document: %s",
+                  op.action, op.doc.get('id'), error, dict(op.doc))
+        if metrics.enabled:
+            metrics.write_buffer_lost.inc((op.action,))
+
+
+class _BufferedWrite(object):
+    def __init__(self, action, doc, refresh, wait):
+        self.action = action
+        self.doc = doc
+        self.refresh = refresh
+        self.wait = wait
+        self.error = None
+        self.done = threading.Event()
 
 
 def make_model(es):
     return type('Model', (_Model,), {'es': es})
 
 
+def _bulk(conn, operations, refresh):
+    if not operations:
+        return []
+
+    body = []
+    for action, doc in operations:
+        header = {'_index': doc.es.index, '_type': doc.__type__}
+        if 'id' in doc:
+            header['_id'] = doc['id']
+        body.append({action: header})
+        if action != 'delete':
+            body.append(doc)
+
+    res = metrics.es_call('bulk', conn.bulk, body=body, refresh=refresh)
+
+    items = res['items']
+    for (action, doc), item in zip(operations, items):
+        result = item[action]
+        if action != 'delete' and result.get('status', 500) < 300:
+            doc['id'] = result['_id']
+        if 'id' in doc:
+            doc.invalidate(doc['id'])
+    return items
+
+
+def _source_filter(fields):
+    """
+    Turn a list of field names into an Elasticsearch _source filter. Names
+    prefixed with '-' are excluded, the others included.
+    """
+    includes = [f for f in fields if not f.startswith('-')]
+    excludes = [f[1:] for f in fields if f.startswith('-')]
+
+    source = {}
+    if includes:
+        source['includes'] = includes
+    if excludes:
+        source['excludes'] = excludes
+    return source
+
+
+def _parse_host(host):
+    parsed = urlparse(host)
+
+    connargs = {
+        'host': parsed.hostname,
+    }
+
+    username = parsed.username
+    password = parsed.password
+    if username is not None or password is not None:
+        connargs['http_auth'] = ((username or ''), (password or ''))
+
+    if parsed.port is not None:
+        connargs['port'] = parsed.port
+
+    if parsed.path:
+        connargs['url_prefix'] = parsed.path
+
+    return connargs
+
+
 def _build_query(query, offset, limit, sort, order):
     # Create a match query for each keyword
     match_clauses = [{'match': {k: v}} for k, v in iteritems(query)]
@@ -234,6 +863,36 @@ def _build_query(query, offset, limit, sort, order):
     }
 
 
+def _source_params(fields):
+    # The get and mget parameters equivalent to a _source_filter
+    source = _source_filter(fields)
+    params = {}
+    if 'includes' in source:
+        params['_source_include'] = source['includes']
+    if 'excludes' in source:
+        params['_source_exclude'] = source['excludes']
+    return params
+
+
+def _search_after_filter(sort, order, search_after):
+    # Matches every document which sorts after the one with the given sort
+    # values: those past it on the sort field, or level with it and past it
+    # on the tiebreaker.
+    value, uid = search_after
+    op = 'lt' if order == 'desc' else 'gt'
+    after_uid = {'range': {'_uid': {op: uid}}}
+
+    if value is None:
+        # Documents without the field sort last
+        return {'and': [{'missing': {'field': sort}}, after_uid]}
+
+    return {'or': [
+        {'range': {sort: {op: value}}},
+        {'missing': {'field': sort}},
+        {'and': [{'range': {sort: {'gte': value, 'lte': value}}}, after_uid]}
+    ]}
+
+
 def _add_created(ann):
     if 'created' not in ann:
         ann['created'] = datetime.datetime.now(iso8601.iso8601.UTC).isoformat()
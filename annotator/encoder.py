@@ -0,0 +1,104 @@
+"""
+JSON encoding for store responses.
+
+Output is compact by default. Lists and dicts are encoded one item at a time,
+so large responses can be streamed rather than built in memory as a whole.
+Items are encoded with ujson if it is installed, or the standard library json
+module otherwise. A different backend can be plugged in with set_backend().
+"""
+from __future__ import absolute_import
+
+import json
+
+from six import iteritems, text_type
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Encoded items are yielded in chunks of (at least) this many characters
+CHUNK_SIZE = 16384
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+
+_dumps = _ujson_dumps if ujson is not None else _json_dumps
+
+
+def set_backend(dumps):
+    """
+    Use the given function to encode JSON. It must take a single object and
+    return its compact JSON encoding as a string.
+    """
+    global _dumps
+    _dumps = dumps
+
+
+def dumps(obj, pretty=False):
+    """Return the JSON encoding of obj as a string."""
+    if pretty:
+        return json.dumps(obj, indent=2)
+    return _dumps(obj)
+
+
+def iterencode(obj, pretty=False):
+    """Yield the JSON encoding of obj in chunks."""
+    if pretty:
+        # The standard library's pretty printer can already stream
+        pieces = json.JSONEncoder(indent=2).iterencode(obj)
+    else:
+        pieces = _iterencode(obj)
+
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _iterencode(obj):
+    # Only the outer list or dict (e.g. search results) is taken apart; the
+    # items themselves are small enough to encode in one go.
+    if isinstance(obj, (list, tuple)):
+        return _iterencode_list(obj)
+    elif isinstance(obj, dict):
+        return _iterencode_dict(obj)
+    else:
+        return iter([_dumps(obj)])
+
+
+def _iterencode_list(obj):
+    yield '['
+    for i, item in enumerate(obj):
+        if i:
+            yield ','
+        yield _dumps(item)
+    yield ']'
+
+
+def _iterencode_dict(obj):
+    yield '{'
+    for i, (k, v) in enumerate(iteritems(obj)):
+        if i:
+            yield ','
+        yield _dumps(text_type(k))
+        yield ':'
+        if isinstance(v, (list, tuple)):
+            for piece in _iterencode_list(v):
+                yield piece
+        else:
+            yield _dumps(v)
+    yield '}'
@@ -0,0 +1,948 @@
+"""
+An in-memory storage backend, for local testing and small deployments which
+don't need an Elasticsearch cluster.
+
+Models talk to their storage through the handful of client methods they call
+on ElasticSearch.conn: get, mget, index, delete, bulk, search, msearch, scroll,
+count and a few index management calls. That subset of the elasticsearch-py client
+API is the backend interface, and MemoryElasticsearch implements it by keeping
+documents in process, so that ElasticSearch can use it in place of a client:
+
+    es.host = 'memory://'
+
+Documents are indexed by their id and by the values of the fields listed in
+HASH_FIELDS, and kept sorted by their SORTED_FIELDS, so the queries the store
+itself builds are answered without scanning every document. The query DSL
+supported is the part the store uses: match_all, match, term, terms, ids,
+range, missing, prefix, bool, filtered, and, or, not, nested and simple
+query_string queries, with sort, from, size, post_filter and _source
+filtering, and terms, filter, filters and date_histogram aggregations.
+Anything else is rejected with a RequestError, as Elasticsearch rejects a bad
+query.
+
+Data lives only as long as the process, and is not shared between processes.
+"""
+from __future__ import absolute_import
+
+import bisect
+import calendar
+import datetime
+import itertools
+import re
+import threading
+import uuid
+
+import iso8601
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from elasticsearch.exceptions import RequestError
+from six import iteritems, itervalues, string_types, text_type
+
+# Fields with an index from each of their values to the documents having it
+HASH_FIELDS = ('uri', 'user', 'user.id', 'consumer', 'tags', 'readers',
+               'link.href', 'permissions.read')
+
+# Fields by which documents are also kept in order
+SORTED_FIELDS = ('created', 'updated')
+
+_EMPTY = frozenset()
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_SHARDS = {'total': 1, 'successful': 1, 'failed': 0}
+_INTERVAL_RE = re.compile(r'^(\d+)(ms|s|m|h|d|w)$')
+_INTERVAL_MILLIS = {'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000,
+                    'd': 86400000, 'w': 604800000}
+
+
+class MemoryElasticsearch(object):
+    """Keeps documents in memory and answers queries on them like an
+    elasticsearch.Elasticsearch client."""
+
+    def __init__(self):
+        self._indices = {}
+        self._scrolls = {}
+        self._lock = threading.RLock()
+
+        self.indices = _IndicesClient(self)
+        self.cluster = _ClusterClient()
+
+    def get(self, index, id, doc_type='_all', ignore=(), **params):
+        with self._lock:
+            source = self._collection(index, doc_type).get(id)
+            if source is None:
+                return _not_found(index, doc_type, id, ignore)
+            return {'_index': index,
+                    '_type': doc_type,
+                    '_id': id,
+                    'found': True,
+                    '_source': _filter_source(
+                        source,
+                        params.get('_source_include'),
+                        params.get('_source_exclude'))}
+
+    def mget(self, body, index=None, doc_type=None, **params):
+        with self._lock:
+            collection = self._collection(index, doc_type)
+            docs = []
+            for docid in body['ids']:
+                source = collection.get(docid)
+                if source is None:
+                    docs.append({'_index': index, '_type': doc_type,
+                                 '_id': docid, 'found': False})
+                else:
+                    docs.append({'_index': index, '_type': doc_type,
+                                 '_id': docid, 'found': True,
+                                 '_source': _filter_source(
+                                     source,
+                                     params.get('_source_include'),
+                                     params.get('_source_exclude'))})
+            return {'docs': docs}
+
+    def index(self, index, doc_type, body, id=None, op_type='index',
+              **params):
+        with self._lock:
+            body = dict(body)
+            if id is None:
+                id = body.get('id')
+            created = self._collection(index, doc_type).put(id, body,
+                                                            op_type == 'create')
+            if created is None:
+                raise ConflictError(409,
+                                    'DocumentAlreadyExistsException',
+                                    {'_id': id})
+            id, created = created
+            return {'_index': index, '_type': doc_type, '_id': id,
+                    '_version': 1, 'created': created}
+
+    def create(self, index, doc_type, body, id=None, **params):
+        return self.index(index, doc_type, body, id=id, op_type='create',
+                          **params)
+
+    def delete(self, index, doc_type, id, ignore=(), **params):
+        with self._lock:
+            if not self._collection(index, doc_type).remove(id):
+                return _not_found(index, doc_type, id, ignore)
+            return {'_index': index, '_type': doc_type, '_id': id,
+                    'found': True}
+
+    def bulk(self, body, index=None, doc_type=None, **params):
+        items = []
+        errors = False
+        lines = iter(body)
+        with self._lock:
+            for header in lines:
+                (action, meta), = header.items()
+                item_index = meta.get('_index', index)
+                item_type = meta.get('_type', doc_type)
+                docid = meta.get('_id')
+                try:
+                    if action == 'delete':
+                        self.delete(item_index, item_type, docid)
+                        status = 200
+                    else:
+                        res = self.index(item_index, item_type, next(lines),
+                                         id=docid,
+                                         op_type=('create'
+                                                  if action == 'create'
+                                                  else 'index'))
+                        docid = res['_id']
+                        status = 201 if res['created'] else 200
+                    item = {'_index': item_index, '_type': item_type,
+                            '_id': docid, 'status': status}
+                except (ConflictError, NotFoundError) as e:
+                    errors = True
+                    item = {'_index': item_index, '_type': item_type,
+                            '_id': docid, 'status': e.status_code,
+                            'error': e.error}
+                items.append({action: item})
+        return {'took': 0, 'errors': errors, 'items': items}
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        body = body or {}
+        with self._lock:
+            collection = self._collection(index, doc_type)
+            ids = collection.query(body.get('query', {'match_all': {}}))
+
+            aggs = body.get('aggs', body.get('aggregations'))
+            aggregations = None
+            if aggs is not None:
+                aggregations = collection.aggregate(ids, aggs)
+
+            # A post filter applies to the hits and their total, but not to
+            # the aggregations
+            if 'post_filter' in body:
+                ids = _intersect(ids, collection.query(body['post_filter'],
+                                                       True))
+            total = len(ids)
+
+            search_type = params.get('search_type')
+            if search_type == 'count':
+                return _search_response(total, [], aggregations)
+
+            sort = _sort_spec(body.get('sort', params.get('sort')))
+            offset = int(params.get('from_', body.get('from', 0)))
+            size = int(params.get('size', body.get('size', 10)))
+
+            if 'scroll' in params:
+                ordered = collection.sort(ids, sort)
+                scroll_id = uuid.uuid4().hex
+                self._scrolls[scroll_id] = (collection, index, doc_type,
+                                            body.get('_source'), ordered, size)
+                if search_type == 'scan':
+                    # The first page of a scan has no hits
+                    hits = []
+                else:
+                    hits = self._scroll_page(scroll_id)
+                res = _search_response(total, hits)
+                res['_scroll_id'] = scroll_id
+                return res
+
+            ordered = collection.sort(ids, sort, limit=offset + size)
+            hits = [collection.hit(index, doc_type, docid, sort,
+                                   body.get('_source'))
+                    for docid in ordered[offset:offset + size]]
+            return _search_response(total, hits, aggregations)
+
+    def msearch(self, body, index=None, doc_type=None, **params):
+        responses = []
+        for header, query in zip(body[::2], body[1::2]):
+            try:
+                res = self.search(index=header.get('index', index),
+                                  doc_type=header.get('type', doc_type),
+                                  body=query,
+                                  **params)
+            except RequestError as e:
+                res = {'error': e.error, 'status': e.status_code}
+            responses.append(res)
+        return {'responses': responses}
+
+    def scroll(self, scroll_id=None, body=None, **params):
+        with self._lock:
+            if scroll_id not in self._scrolls:
+                raise NotFoundError(404, 'SearchContextMissingException',
+                                    {'_scroll_id': scroll_id})
+            res = _search_response(len(self._scrolls[scroll_id][4]),
+                                   self._scroll_page(scroll_id))
+            res['_scroll_id'] = scroll_id
+            return res
+
+    def clear_scroll(self, scroll_id=None, body=None, **params):
+        with self._lock:
+            self._scrolls.pop(scroll_id, None)
+        return {}
+
+    def count(self, index=None, doc_type=None, body=None, **params):
+        res = self.search(index=index, doc_type=doc_type, body=body,
+                          search_type='count')
+        return {'count': res['hits']['total'], '_shards': _SHARDS}
+
+    def _scroll_page(self, scroll_id):
+        collection, index, doc_type, source, ordered, size = \
+            self._scrolls[scroll_id]
+        page, rest = ordered[:size], ordered[size:]
+        self._scrolls[scroll_id] = (collection, index, doc_type, source, rest,
+                                    size)
+        if not page:
+            del self._scrolls[scroll_id]
+        return [collection.hit(index, doc_type, docid, None, source)
+                for docid in page if collection.get(docid) is not None]
+
+    def _collection(self, index, doc_type):
+        try:
+            return self._indices[index][doc_type]
+        except KeyError:
+            return self._indices.setdefault(index, {}).setdefault(
+                doc_type, _Collection(doc_type))
+
+
+class _IndicesClient(object):
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index, body=None, ignore=(), **params):
+        with self.client._lock:
+            if index in self.client._indices:
+                if 400 in _as_tuple(ignore):
+                    return {'status': 400,
+                            'error': 'IndexAlreadyExistsException'}
+                raise RequestError(400, 'IndexAlreadyExistsException',
+                                   {'index': index})
+            self.client._indices[index] = {}
+            for doc_type, mapping in iteritems((body or {}).get('mappings',
+                                                                {})):
+                self.client._collection(index, doc_type).set_mapping(mapping)
+            return {'acknowledged': True}
+
+    def put_mapping(self, doc_type, body, index=None, **params):
+        with self.client._lock:
+            collection = self.client._collection(index, doc_type)
+            collection.set_mapping(body.get(doc_type, body))
+            return {'acknowledged': True}
+
+    def exists(self, index, **params):
+        return index in self.client._indices
+
+    def delete(self, index, ignore=(), **params):
+        with self.client._lock:
+            if self.client._indices.pop(index, None) is None:
+                if 404 in _as_tuple(ignore):
+                    return {'status': 404, 'error': 'IndexMissingException'}
+                raise NotFoundError(404, 'IndexMissingException',
+                                    {'index': index})
+            return {'acknowledged': True}
+
+    def close(self, index, **params):
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **params):
+        # Writes are visible as soon as they are made
+        return {'_shards': _SHARDS}
+
+
+class _ClusterClient(object):
+    def health(self, **params):
+        return {'status': 'green'}
+
+
+class _Collection(object):
+    """The documents of one type in one index, with their field indexes."""
+
+    def __init__(self, doc_type):
+        self.doc_type = doc_type
+        self.docs = {}
+        self.analyzed = set()
+        self.dates = set(SORTED_FIELDS)
+        self._hash = dict((f, {}) for f in HASH_FIELDS)
+        self._sorted = dict((f, []) for f in SORTED_FIELDS)
+        self._keys = {}
+
+    def set_mapping(self, mapping):
+        for field, props in _walk_properties(mapping.get('properties', {})):
+            if props.get('analyzer') == 'standard':
+                self.analyzed.add(field)
+            if props.get('type') == 'date':
+                self.dates.add(field)
+
+    def get(self, docid):
+        return self.docs.get(_docid(docid))
+
+    def put(self, docid, source, create_only=False):
+        """
+        Stores the source under docid (or a new id), and returns the id and
+        whether the document is new, or None if create_only is set and a
+        document with the id exists.
+        """
+        if docid is None:
+            docid = uuid.uuid4().hex
+        docid = _docid(docid)
+        created = docid not in self.docs
+        if not created and create_only:
+            return None
+
+        source = _copy(source)
+        # The id is stored as the document's _id only
+        source.pop('id', None)
+
+        self.remove(docid)
+        self.docs[docid] = source
+        for field, index in iteritems(self._hash):
+            for value in _hashable(_values(source, field)):
+                index.setdefault(value, set()).add(docid)
+        keys = {}
+        for field, index in iteritems(self._sorted):
+            key = _sort_key(self, field, source)
+            if key is not None:
+                bisect.insort(index, (key, docid))
+                keys[field] = key
+        self._keys[docid] = keys
+        return docid, created
+
+    def remove(self, docid):
+        docid = _docid(docid)
+        source = self.docs.pop(docid, None)
+        if source is None:
+            return False
+        for field, index in iteritems(self._hash):
+            for value in _hashable(_values(source, field)):
+                ids = index.get(value)
+                if ids is not None:
+                    ids.discard(docid)
+                    if not ids:
+                        del index[value]
+        for field, key in iteritems(self._keys.pop(docid)):
+            index = self._sorted[field]
+            i = bisect.bisect_left(index, (key, docid))
+            del index[i]
+        return True
+
+    def hit(self, index, doc_type, docid, sort, source_filter):
+        source = self.docs[docid]
+        includes = excludes = None
+        if source_filter is False:
+            includes = []
+        elif isinstance(source_filter, (list, string_types)):
+            includes = source_filter
+        elif isinstance(source_filter, dict):
+            includes = source_filter.get('includes',
+                                         source_filter.get('include'))
+            excludes = source_filter.get('excludes',
+                                         source_filter.get('exclude'))
+        hit = {'_index': index,
+               '_type': doc_type,
+               '_id': docid,
+               '_score': None,
+               '_source': _filter_source(source, includes, excludes)}
+        if sort:
+            hit['sort'] = [self._sort_value(docid, f, o) for f, o in sort]
+        return hit
+
+    # Queries
+
+    def query(self, node, filter_context=False):
+        """
+        Returns the set of ids of the documents matching a query or filter.
+
+        The set may be one of the collection's own indexes, so it must not be
+        modified.
+        """
+        if not isinstance(node, dict) or len(node) != 1:
+            raise _bad_query(node)
+        (kind, args), = node.items()
+        method = getattr(self, '_q_' + kind, None)
+        if method is None:
+            raise _bad_query(node)
+        return method(args, filter_context)
+
+    def _q_match_all(self, args, filter_context):
+        return set(self.docs)
+
+    def _q_match(self, args, filter_context):
+        field, value = _field_args(args, 'query')
+        if field in self.analyzed:
+            terms = _tokens(value)
+            return self._ids_where(field, lambda v: bool(
+                set(_tokens(v)) & set(terms)))
+        return self._term(field, value)
+
+    def _q_term(self, args, filter_context):
+        field, value = _field_args(args, 'value')
+        return self._term(field, value)
+
+    def _q_terms(self, args, filter_context):
+        args = dict((k, v) for k, v in iteritems(args)
+                    if k not in ('execution', '_cache', 'minimum_should_match'))
+        field, values = _field_args(args, None)
+        if len(values) == 1:
+            return self._term(field, values[0])
+        ids = set()
+        for value in values:
+            ids |= self._term(field, value)
+        return ids
+
+    def _q_ids(self, args, filter_context):
+        return set(_docid(v) for v in args.get('values', [])
+                   if _docid(v) in self.docs)
+
+    def _q_prefix(self, args, filter_context):
+        field, value = _field_args(args, 'value')
+        return self._ids_where(field, lambda v: (
+            isinstance(v, string_types) and v.startswith(value)))
+
+    def _q_missing(self, args, filter_context):
+        field = args['field']
+        return set(docid for docid, source in iteritems(self.docs)
+                   if not _values(source, field))
+
+    def _q_exists(self, args, filter_context):
+        return set(self.docs) - self._q_missing(args, filter_context)
+
+    def _q_range(self, args, filter_context):
+        args = dict((k, v) for k, v in iteritems(args) if k != '_cache')
+        field, bounds = _field_args(args, None)
+        bounds = dict((op, self._coerce(field, v))
+                      for op, v in iteritems(bounds)
+                      if op in ('gt', 'gte', 'lt', 'lte'))
+
+        if field in self._sorted:
+            index = self._sorted[field]
+            lo, hi = 0, len(index)
+            if 'gte' in bounds:
+                lo = max(lo, _bisect_key(index, bounds['gte'], False))
+            if 'gt' in bounds:
+                lo = max(lo, _bisect_key(index, bounds['gt'], True))
+            if 'lte' in bounds:
+                hi = min(hi, _bisect_key(index, bounds['lte'], True))
+            if 'lt' in bounds:
+                hi = min(hi, _bisect_key(index, bounds['lt'], False))
+            return set(docid for _, docid in index[lo:hi])
+
+        def in_range(v):
+            v = self._coerce(field, v)
+            try:
+                return (('gt' not in bounds or v > bounds['gt']) and
+                        ('gte' not in bounds or v >= bounds['gte']) and
+                        ('lt' not in bounds or v < bounds['lt']) and
+                        ('lte' not in bounds or v <= bounds['lte']))
+            except TypeError:
+                return False
+        return self._ids_where(field, in_range)
+
+    def _q_bool(self, args, filter_context):
+        ids = None
+        for node in _as_list(args.get('must', [])):
+            ids = _intersect(ids, self.query(node, filter_context))
+
+        should = _as_list(args.get('should', []))
+        required = args.get('minimum_should_match')
+        if required is None:
+            required = 1 if (filter_context or ids is None) and should else 0
+        required = int(required)
+        if required:
+            counts = {}
+            for node in should:
+                for docid in self.query(node, filter_context):
+                    counts[docid] = counts.get(docid, 0) + 1
+            ids = _intersect(ids, set(d for d, n in iteritems(counts)
+                                      if n >= required))
+
+        if ids is None:
+            ids = set(self.docs)
+        for node in _as_list(args.get('must_not', [])):
+            ids = ids - self.query(node, filter_context)
+        return ids
+
+    def _q_filtered(self, args, filter_context):
+        ids = self.query(args.get('query', {'match_all': {}}), filter_context)
+        if 'filter' in args:
+            ids = _intersect(ids, self.query(args['filter'], True))
+        return ids
+
+    def _q_and(self, args, filter_context):
+        ids = None
+        for node in _filter_list(args):
+            ids = _intersect(ids, self.query(node, True))
+        return ids if ids is not None else set(self.docs)
+
+    def _q_or(self, args, filter_context):
+        ids = set()
+        for node in _filter_list(args):
+            ids |= self.query(node, True)
+        return ids
+
+    def _q_not(self, args, filter_context):
+        node = args.get('filter', args) if isinstance(args, dict) else args
+        return set(self.docs) - self.query(node, True)
+
+    def _q_nested(self, args, filter_context):
+        # Nested documents are matched field by field, which is the same as
+        # long as the inner query tests a single field
+        return self.query(args.get('query', args.get('filter')),
+                          filter_context)
+
+    def _q_query(self, args, filter_context):
+        # A query wrapped to be used as a filter
+        return self.query(args, filter_context)
+
+    def _q_query_string(self, args, filter_context):
+        # Only space separated 'field:value' terms, any of which must match
+        text = args.get('query', '*').strip()
+        default_field = args.get('default_field', '_all')
+        if text in ('', '*', '*:*'):
+            return set(self.docs)
+
+        ids = set()
+        for term in text.split():
+            field, sep, value = term.partition(':')
+            if not sep:
+                field, value = default_field, term
+            if field == '_all':
+                ids |= self._ids_where_any(value)
+            else:
+                ids |= self.query({'match': {field: value}}, filter_context)
+        return ids
+
+    def _term(self, field, value):
+        if field == '_id':
+            value = _docid(value)
+            return set([value]) if value in self.docs else set()
+        if field in self._hash:
+            try:
+                return self._hash[field].get(value, _EMPTY)
+            except TypeError:
+                return _EMPTY
+        if field in self.analyzed:
+            return self._ids_where(field, lambda v: value in _tokens(v))
+        value = self._coerce(field, value)
+        return self._ids_where(field,
+                               lambda v: self._coerce(field, v) == value)
+
+    def _ids_where(self, field, predicate):
+        return set(docid for docid, source in iteritems(self.docs)
+                   if any(predicate(v)
+                          for v in self._field_values(docid, source, field)))
+
+    def _field_values(self, docid, source, field):
+        if field in ('_uid', '_id'):
+            return [self._sort_value(docid, field)]
+        return _values(source, field)
+
+    def _ids_where_any(self, value):
+        # For queries on _all: any field containing the word
+        value = value.lower()
+        return set(docid for docid, source in iteritems(self.docs)
+                   if any(value in _tokens(v) for v in _all_values(source)))
+
+    def _coerce(self, field, value):
+        if field in self.dates:
+            return _date_millis(value)
+        return value
+
+    # Aggregations
+
+    def aggregate(self, ids, aggs):
+        """Returns the results of the aggregations over the given ids."""
+        results = {}
+        for name, node in iteritems(aggs):
+            if not isinstance(node, dict) or len(node) != 1:
+                # Sub-aggregations are not supported
+                raise _bad_query(node)
+            (kind, args), = node.items()
+            method = getattr(self, '_agg_' + kind, None)
+            if method is None:
+                raise _bad_query(node)
+            results[name] = method(ids, args)
+        return results
+
+    def _agg_terms(self, ids, args):
+        field = args['field']
+        counts = {}
+        for docid in ids:
+            for value in set(_hashable(_values(self.docs[docid], field))):
+                counts[value] = counts.get(value, 0) + 1
+        ordered = sorted(iteritems(counts), key=lambda kv: (-kv[1], kv[0]))
+        size = args.get('size', 10) or len(ordered)
+        return {'doc_count_error_upper_bound': 0,
+                'sum_other_doc_count': sum(n for _, n in ordered[size:]),
+                'buckets': [{'key': k, 'doc_count': n}
+                            for k, n in ordered[:size]]}
+
+    def _agg_filter(self, ids, args):
+        return {'doc_count': len(_intersect(ids, self.query(args, True)))}
+
+    def _agg_filters(self, ids, args):
+        def bucket(node):
+            return {'doc_count': len(_intersect(ids, self.query(node, True)))}
+
+        filters = args['filters']
+        if isinstance(filters, dict):
+            return {'buckets': dict((name, bucket(node))
+                                    for name, node in iteritems(filters))}
+        return {'buckets': [bucket(node) for node in filters]}
+
+    def _agg_date_histogram(self, ids, args):
+        field = args['field']
+        floor = _date_floor(args.get('interval'))
+        counts = {}
+        for docid in ids:
+            keys = set(floor(_date_millis(v))
+                       for v in _values(self.docs[docid], field))
+            for key in keys:
+                if key is not None:
+                    counts[key] = counts.get(key, 0) + 1
+        min_doc_count = args.get('min_doc_count', 1)
+        return {'buckets': [{'key': k,
+                             'key_as_string': _format_millis(k),
+                             'doc_count': n}
+                            for k, n in sorted(iteritems(counts))
+                            if n >= min_doc_count]}
+
+    # Sorting
+
+    def sort(self, ids, sort, limit=None):
+        """Returns the ids in the given order, or only the first limit of
+        them."""
+        if not sort:
+            # Without scores to sort by, keep the order of insertion
+            return [docid for docid in self.docs if docid in ids]
+
+        field, order = sort[0]
+        index = self._sorted.get(field)
+        if (len(sort) <= 2 and index is not None and limit is not None and
+                len(ids) * 8 >= len(index)):
+            # Walk the sorted index, which is already in order of the field.
+            # Only worth it when a good part of the documents match, or the
+            # walk is longer than sorting the matches.
+            walk = reversed(index) if order == 'desc' else iter(index)
+            tie = sort[1] if len(sort) > 1 else ('_uid', order)
+            result = []
+            for _, group in itertools.groupby(walk, key=lambda k: k[0]):
+                matched = [docid for _, docid in group if docid in ids]
+                matched.sort(reverse=tie[1] == 'desc',
+                             key=lambda d: self._sort_value(d, tie[0]))
+                result.extend(matched)
+                if len(result) >= limit:
+                    return result[:limit]
+            # Documents without the field come last
+            keyed = set(docid for _, docid in index)
+            result.extend(sorted((d for d in ids if d not in keyed),
+                                 key=lambda d: self._sort_value(d, tie[0]),
+                                 reverse=tie[1] == 'desc'))
+            return result[:limit]
+
+        result = list(ids)
+        # Sort by the least significant field first, as sorts are stable
+        for field, order in reversed(sort):
+            keys = dict((d, self._sort_value(d, field, order)) for d in result)
+            present = [d for d in result if keys[d] is not None]
+            absent = [d for d in result if keys[d] is None]
+            present.sort(key=keys.get, reverse=order == 'desc')
+            result = present + absent
+        return result if limit is None else result[:limit]
+
+    def _sort_value(self, docid, field, order='asc'):
+        if field == '_uid':
+            return '{0}#{1}'.format(self.doc_type, docid)
+        if field == '_id':
+            return docid
+        keys = self._keys.get(docid, {})
+        if field in keys:
+            return keys[field]
+        return _sort_key(self, field, self.docs[docid], order)
+
+
+def _bisect_key(index, key, right):
+    """
+    Returns where key would be inserted in a sorted list of (key, id) pairs:
+    after any pairs with that key if right is set, before them otherwise.
+    """
+    lo, hi = 0, len(index)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        k = index[mid][0]
+        if k < key or (right and k == key):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _sort_key(collection, field, source, order='asc'):
+    # Fields with several values (or analyzed into several terms) sort by
+    # their least value ascending, and by their greatest descending
+    values = _values(source, field)
+    if field in collection.analyzed:
+        values = [t for v in values for t in _tokens(v)]
+    values = [collection._coerce(field, v) for v in values]
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    try:
+        return max(values) if order == 'desc' else min(values)
+    except TypeError:
+        return None
+
+
+def _sort_spec(sort):
+    """Returns the sort as a list of (field, order) pairs."""
+    spec = []
+    for item in _as_list(sort or []):
+        if isinstance(item, string_types):
+            field, _, order = item.partition(':')
+            spec.append((field, order or 'asc'))
+        else:
+            for field, opts in iteritems(item):
+                if isinstance(opts, dict):
+                    order = opts.get('order', 'asc')
+                else:
+                    order = opts
+                spec.append((field, order))
+    # There are no scores to sort by
+    return [(f, o) for f, o in spec if f != '_score']
+
+
+def _search_response(total, hits, aggregations=None):
+    res = {'took': 0,
+           'timed_out': False,
+           '_shards': _SHARDS,
+           'hits': {'total': total, 'max_score': None, 'hits': hits}}
+    if aggregations is not None:
+        res['aggregations'] = aggregations
+    return res
+
+
+def _not_found(index, doc_type, docid, ignore):
+    res = {'_index': index, '_type': doc_type, '_id': docid, 'found': False}
+    if 404 in _as_tuple(ignore):
+        return res
+    raise NotFoundError(404, 'DocumentMissingException', res)
+
+
+def _bad_query(node):
+    return RequestError(400, 'SearchParseException',
+                        {'error': 'unsupported query: {0!r}'.format(node)})
+
+
+def _field_args(args, value_key):
+    """Splits {field: value} or {field: {value_key: value}} arguments."""
+    if len(args) != 1:
+        raise _bad_query(args)
+    (field, value), = args.items()
+    if value_key is not None and isinstance(value, dict):
+        value = value.get(value_key)
+    return field, value
+
+
+def _filter_list(args):
+    if isinstance(args, dict):
+        return args.get('filters', [])
+    return args
+
+
+def _docid(value):
+    # Ids are always strings, as in Elasticsearch
+    return value if isinstance(value, string_types) else text_type(value)
+
+
+def _values(source, path):
+    """Returns the leaf values at a dotted path, flattening lists."""
+    values = [source]
+    for part in path.split('.'):
+        found = []
+        for v in values:
+            if isinstance(v, dict) and part in v:
+                found.extend(_as_list(v[part]))
+        values = found
+    return [v for v in values if v is not None and not isinstance(v, dict)]
+
+
+def _all_values(source):
+    if isinstance(source, dict):
+        for v in itervalues(source):
+            for leaf in _all_values(v):
+                yield leaf
+    elif isinstance(source, list):
+        for v in source:
+            for leaf in _all_values(v):
+                yield leaf
+    elif source is not None:
+        yield source
+
+
+def _hashable(values):
+    for v in values:
+        try:
+            hash(v)
+        except TypeError:
+            continue
+        yield v
+
+
+def _tokens(value):
+    if not isinstance(value, string_types):
+        return [value]
+    return _TOKEN_RE.findall(value.lower())
+
+
+def _date_millis(value):
+    # Dates are compared as milliseconds since the epoch, as in Elasticsearch,
+    # but keep their microseconds: without network round trips, documents are
+    # easily saved within the same millisecond.
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        date = iso8601.parse_date(value)
+    except (iso8601.ParseError, TypeError):
+        return None
+    return calendar.timegm(date.utctimetuple()) * 1000 + \
+        date.microsecond / 1000.0
+
+
+def _date_floor(interval):
+    """
+    Returns a function rounding dates in milliseconds down to the start of
+    their date_histogram interval: a calendar unit (year to minute, in UTC,
+    with weeks starting on Monday) or a fixed length such as '12h'.
+    """
+    match = _INTERVAL_RE.match(interval or '')
+    if match:
+        length = int(match.group(1)) * _INTERVAL_MILLIS[match.group(2)]
+        if not length:
+            raise _bad_query({'interval': interval})
+        return lambda ms: None if ms is None else int(ms - ms % length)
+
+    def floor(ms):
+        if ms is None:
+            return None
+        date = datetime.datetime.utcfromtimestamp(ms // 1000)
+        if interval == 'year':
+            date = date.replace(month=1, day=1, hour=0, minute=0, second=0)
+        elif interval == 'quarter':
+            date = date.replace(month=date.month - (date.month - 1) % 3,
+                                day=1, hour=0, minute=0, second=0)
+        elif interval == 'month':
+            date = date.replace(day=1, hour=0, minute=0, second=0)
+        elif interval == 'week':
+            date = (date - datetime.timedelta(days=date.weekday())).replace(
+                hour=0, minute=0, second=0)
+        elif interval == 'day':
+            date = date.replace(hour=0, minute=0, second=0)
+        elif interval == 'hour':
+            date = date.replace(minute=0, second=0)
+        elif interval == 'minute':
+            date = date.replace(second=0)
+        elif interval != 'second':
+            raise _bad_query({'interval': interval})
+        return calendar.timegm(date.utctimetuple()) * 1000
+
+    floor(0)  # Reject a bad interval even if there is nothing to count
+    return floor
+
+
+def _format_millis(ms):
+    date = datetime.datetime.utcfromtimestamp(ms // 1000)
+    return date.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (ms % 1000)
+
+
+def _copy(value):
+    # Documents hold only JSON types, which this copies much faster than
+    # copy.deepcopy does
+    if isinstance(value, dict):
+        return dict((k, _copy(v)) for k, v in iteritems(value))
+    if isinstance(value, (list, tuple)):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _filter_source(source, includes=None, excludes=None):
+    if isinstance(includes, string_types):
+        includes = includes.split(',')
+    if isinstance(excludes, string_types):
+        excludes = excludes.split(',')
+    if includes is not None:
+        source = dict((k, v) for k, v in iteritems(source) if k in includes)
+    source = _copy(source)
+    for field in excludes or ():
+        source.pop(field, None)
+    return source
+
+
+def _walk_properties(properties, prefix=''):
+    for name, props in iteritems(properties):
+        yield prefix + name, props
+        if 'properties' in props:
+            for item in _walk_properties(props['properties'],
+                                         prefix + name + '.'):
+                yield item
+
+
+def _intersect(ids, other):
+    if ids is None:
+        return other
+    # Iterate over the smaller set
+    return other & ids if len(other) < len(ids) else ids & other
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _as_tuple(value):
+    return value if isinstance(value, (list, tuple)) else (value,)
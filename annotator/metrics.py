@@ -0,0 +1,277 @@
+"""
+Request and Elasticsearch call metrics, exposed in the Prometheus text format
+by the store's /metrics endpoint.
+
+Metrics are only recorded once enabled, by setting annotator.metrics.enabled
+to True. The store then records the count and latency of requests per
+endpoint, and the models record the count, latency and reported 'took' time of
+Elasticsearch calls per operation, as well as the number of calls made while
+handling each request.
+
+Independently, Elasticsearch calls taking longer than slow_query_threshold
+seconds are logged to the 'annotator.slow_queries' logger, with the request
+body sent, the 'took' time and the store endpoint being handled.
+"""
+import json
+import logging
+import random
+import threading
+import time
+
+from six import iteritems
+
+slow_log = logging.getLogger('annotator.slow_queries')
+
+# Whether to record metrics (and serve /metrics)
+enabled = False
+
+# Log Elasticsearch calls taking at least this many seconds (None disables
+# the slow query log)
+slow_query_threshold = None
+# Log only this fraction of the slow calls, picked at random
+slow_query_sample_rate = 1.0
+# Truncate logged request bodies to this many characters
+slow_query_max_body = 2000
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    """A count per combination of label values."""
+
+    type = 'counter'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        labels = tuple(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(iteritems(self._values))
+        for labels, value in values:
+            yield self.name, self._labels(labels), value
+
+    def _labels(self, values, extra=()):
+        return tuple(zip(self.labelnames, values)) + tuple(extra)
+
+
+class Histogram(Counter):
+    """Counts of observations in cumulative buckets, with their sum, per
+    combination of label values."""
+
+    type = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                labels, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[labels] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count)
+                            in iteritems(self._values))
+        for labels, (counts, total, count) in values:
+            for bound, n in zip(self.buckets, counts):
+                yield (self.name + '_bucket',
+                       self._labels(labels, [('le', _format_value(bound))]),
+                       n)
+            yield (self.name + '_bucket',
+                   self._labels(labels, [('le', '+Inf')]),
+                   count)
+            yield self.name + '_sum', self._labels(labels), total
+            yield self.name + '_count', self._labels(labels), count
+
+
+class Registry(object):
+    """A set of metrics, rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.doc))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name,
+                                                 _format_labels(labels),
+                                                 _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    'annotator_requests_total',
+    'Requests handled by the store.',
+    ('endpoint', 'method', 'status')))
+request_duration = registry.register(Histogram(
+    'annotator_request_duration_seconds',
+    'Time taken to handle store requests.',
+    ('endpoint',)))
+request_es_calls = registry.register(Histogram(
+    'annotator_request_es_calls',
+    'Elasticsearch calls made while handling a store request.',
+    ('endpoint',),
+    buckets=ROUND_TRIP_BUCKETS))
+es_calls_total = registry.register(Counter(
+    'annotator_es_calls_total',
+    'Calls made to Elasticsearch.',
+    ('operation', 'outcome')))
+es_call_duration = registry.register(Histogram(
+    'annotator_es_call_duration_seconds',
+    'Time taken by Elasticsearch calls, as seen by the store.',
+    ('operation',)))
+es_took = registry.register(Histogram(
+    'annotator_es_took_seconds',
+    'Time Elasticsearch reported taking to answer a call.',
+    ('operation',)))
+write_buffer_lost = registry.register(Counter(
+    'annotator_write_buffer_lost_total',
+    'Buffered writes which failed after the store had reported success.',
+    ('action',)))
+
+_local = threading.local()
+
+
+def es_call(operation, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs), which makes an Elasticsearch request, and
+    records it as the given operation. Returns what func returns.
+    """
+    if not enabled and slow_query_threshold is None:
+        return func(*args, **kwargs)
+
+    if enabled and getattr(_local, 'es_calls', None) is not None:
+        _local.es_calls += 1
+
+    outcome = 'error'
+    took = None
+    start = time.time()
+    try:
+        res = func(*args, **kwargs)
+        outcome = 'ok'
+        took = res.get('took') if isinstance(res, dict) else None
+        return res
+    finally:
+        elapsed = time.time() - start
+        if enabled:
+            es_calls_total.inc((operation, outcome))
+            es_call_duration.observe(elapsed, (operation,))
+            if took is not None:
+                es_took.observe(took / 1000.0, (operation,))
+        if (slow_query_threshold is not None and
+                elapsed >= slow_query_threshold and
+                random.random() < slow_query_sample_rate):
+            _log_slow_query(operation, outcome, elapsed, took, kwargs)
+
+
+def _log_slow_query(operation, outcome, elapsed, took, kwargs):
+    endpoint = _request_endpoint()
+    params = dict((k, v) for k, v in iteritems(kwargs)
+                  if k not in ('index', 'body'))
+    slow_log.warning("Slow Elasticsearch %s call (%s) in endpoint %s: "
+                     "%.3fs, took %s ms, params %s, body %s",
+                     operation,
+                     outcome,
+                     endpoint,
+                     elapsed,
+                     took,
+                     _truncate(params, slow_query_max_body),
+                     _truncate(kwargs.get('body'), slow_query_max_body))
+
+
+def _request_endpoint():
+    # The models don't need Flask, so neither does the slow query log
+    try:
+        from flask import has_request_context, request
+    except ImportError:
+        return None
+    if has_request_context():
+        return request.endpoint
+    return None
+
+
+def _truncate(obj, size):
+    """
+    Returns the JSON encoding of obj, cut to size characters. The items of a
+    list (e.g. a bulk request body) are only encoded until there are enough.
+    """
+    if isinstance(obj, list):
+        pieces = []
+        length = 0
+        for item in obj:
+            piece = json.dumps(item, default=str)
+            pieces.append(piece)
+            length += len(piece) + 1
+            if length > size:
+                break
+        text = '[' + ','.join(pieces) + ']'
+    else:
+        text = json.dumps(obj, default=str)
+    if len(text) > size:
+        return text[:size] + '...'
+    return text
+
+
+def start_request():
+    """Start counting the Elasticsearch calls made by the current thread."""
+    _local.es_calls = 0
+    _local.start = time.time()
+
+
+def finish_request(endpoint, method, status):
+    """Record the request started by start_request() in this thread."""
+    start = getattr(_local, 'start', None)
+    if start is None:
+        return
+    endpoint = endpoint or 'none'
+    requests_total.inc((endpoint, method, str(status)))
+    request_duration.observe(time.time() - start, (endpoint,))
+    request_es_calls.observe(_local.es_calls, (endpoint,))
+    _local.start = None
+    _local.es_calls = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v))
+                          for k, v in labels) + '}'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+            .replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_value(value):
+    return repr(value)
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 from elasticsearch import helpers
 
+from . import authz
 from .annotation import Annotation
 from .document import Document
 
@@ -34,9 +35,19 @@ class Reindexer(object):
 
         # Do the actual reindexing.
         self._print("Reindexing {0} to {1}...".format(old_index, new_index))
-        helpers.reindex(conn, old_index, new_index)
+        docs = helpers.scan(conn, index=old_index, scroll='5m')
+        helpers.bulk(conn, (self._migrate(d, new_index) for d in docs),
+                     chunk_size=500)
         self._print("Reindexing done.")
 
+    def _migrate(self, doc, new_index):
+        """Bring a document from the old index up to date for the new one."""
+        doc['_index'] = new_index
+        if doc['_type'] == Annotation.__type__:
+            # Annotations saved before the readers field existed
+            doc['_source']['readers'] = authz.annotation_readers(doc['_source'])
+        return doc
+
     def alias(self, index, alias):
         conn = self.conn
         # Remove the alias's current targets.
@@ -6,15 +6,24 @@ It defines these routes:
   * Index
   * Create
   * Read
+  * Read many
   * Update
   * Delete
+  * Bulk
   * Search
+  * Batch search
+  * Stats
+  * Counts
+  * Export
   * Raw ElasticSearch search
+  * Metrics
 See their descriptions in `root`'s definition for more detail.
 """
 from __future__ import absolute_import
 
+import base64
 import csv
+import itertools
 import json
 
 from elasticsearch.exceptions import TransportError
@@ -22,27 +31,47 @@ from flask import Blueprint, Response
 from flask import current_app, g
 from flask import request
 from flask import url_for
-from six import iteritems
+from six import integer_types, iteritems, string_types
 
+from annotator import encoder, metrics
 from annotator.atoi import atoi
 from annotator.annotation import Annotation
-from annotator.elasticsearch import RESULTS_MAX_SIZE
+from annotator.elasticsearch import RESULTS_DEFAULT_SIZE, RESULTS_MAX_SIZE
 
 store = Blueprint('store', __name__)
 
 CREATE_FILTER_FIELDS = ('updated', 'created', 'consumer', 'id')
 UPDATE_FILTER_FIELDS = ('updated', 'created', 'user', 'consumer')
+BULK_ACTIONS = ('create', 'update', 'delete')
+BULK_MAX_SIZE = 1000
+STATS_DEFAULT_LIMIT = 10
+STATS_MAX_LIMIT = 1000
+COUNTS_MAX_URIS = 1000
+SEARCH_BATCH_MAX_SIZE = 20
+READ_MANY_MAX_IDS = 1000
+AUTHZ_FIELDS = ('permissions', 'user', 'consumer')
+
+FIELDS_QUERY_DESC = {
+    'type': 'string',
+    'desc': ("Comma-separated list of fields to return. Fields prefixed "
+             "with '-' are left out instead (default: all fields)")
+}
 
 
 # We define our own jsonify rather than using flask.jsonify because we wish
 # to jsonify arbitrary objects (e.g. index returns a list) rather than kwargs.
+# The response is streamed, and is only pretty-printed if asked for with
+# the 'pretty' query parameter.
 def jsonify(obj, *args, **kwargs):
-    res = json.dumps(obj, indent=None if request.is_xhr else 2)
+    res = encoder.iterencode(obj, pretty='pretty' in request.args)
     return Response(res, mimetype='application/json', *args, **kwargs)
 
 
 @store.before_request
 def before_request():
+    if metrics.enabled:
+        metrics.start_request()
+
     if not hasattr(g, 'annotation_class'):
         g.annotation_class = Annotation
 
@@ -67,6 +96,10 @@ def after_request(response):
         rh[ac + 'Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
         rh[ac + 'Max-Age'] = '86400'
 
+    if metrics.enabled:
+        metrics.finish_request(request.endpoint, request.method,
+                               response.status_code)
+
     return response
 
 
@@ -94,8 +127,27 @@ def root():
                     'url': url_for('.read_annotation',
                                    docid=':id',
                                    _external=True),
+                    'query': {
+                        'fields': FIELDS_QUERY_DESC
+                    },
                     'desc': "Get an existing annotation"
                 },
+                'read_many': {
+                    'method': 'GET/POST',
+                    'url': url_for('.read_annotations', _external=True),
+                    'query': {
+                        'ids': {
+                            'type': 'string',
+                            'desc': ("Comma-separated list of the ids of the "
+                                     "annotations to get. For long lists, "
+                                     "POST a JSON list of ids instead")
+                        },
+                        'fields': FIELDS_QUERY_DESC
+                    },
+                    'desc': ("Get several existing annotations, leaving out "
+                             "those which are missing or may not be read "
+                             "(at most {0})".format(READ_MANY_MAX_IDS))
+                },
                 'update': {
                     'method': 'PUT',
                     'url':
@@ -118,19 +170,89 @@ def root():
                                    docid=':id',
                                    _external=True),
                     'desc': "Delete an annotation"
+                },
+                'bulk': {
+                    'method': 'POST',
+                    'url': url_for('.bulk_annotations', _external=True),
+                    'query': {
+                        'refresh': {
+                            'type': 'bool',
+                            'desc': ("Force an index refresh after the bulk "
+                                     "operation (default: true)")
+                        }
+                    },
+                    'desc': ("Create, update and delete several annotations "
+                             "(at most {0}) in one request"
+                             .format(BULK_MAX_SIZE))
                 }
             },
             'search': {
                 'method': 'GET',
                 'url': url_for('.search_annotations', _external=True),
+                'query': {
+                    'fields': FIELDS_QUERY_DESC,
+                    'cursor': {
+                        'type': 'string',
+                        'desc': ("Empty to page through results with "
+                                 "cursors, which replace 'offset' for deep "
+                                 "paging: each full page then has a "
+                                 "'next' value. Passing that as 'cursor' "
+                                 "returns the page following it")
+                    }
+                },
                 'desc': 'Basic search API'
             },
+            'search_batch': {
+                'method': 'POST',
+                'url': url_for('.search_annotations_batch', _external=True),
+                'desc': ('Run a JSON list of searches (objects of search '
+                         'parameters, at most {0}) at once, and return their '
+                         'results in order'.format(SEARCH_BATCH_MAX_SIZE))
+            },
+            'stats': {
+                'method': 'GET',
+                'url': url_for('.annotation_stats', _external=True),
+                'query': {
+                    'limit': {
+                        'type': 'int',
+                        'desc': ("Number of most frequent tags, users and "
+                                 "URIs to return (default: {0})"
+                                 .format(STATS_DEFAULT_LIMIT))
+                    },
+                    'interval': {
+                        'type': 'string',
+                        'desc': ("Count annotations created per year, "
+                                 "quarter, month, week, day or hour "
+                                 "(default: month)")
+                    }
+                },
+                'desc': ('Count the annotations matching a search by tag, '
+                         'user, URI and creation date')
+            },
+            'counts': {
+                'method': 'POST',
+                'url': url_for('.annotation_counts', _external=True),
+                'desc': ('Count the annotations of each of a JSON list of '
+                         'URIs (at most {0})'.format(COUNTS_MAX_URIS))
+            },
+            'export': {
+                'method': 'GET',
+                'url': url_for('.export_annotations', _external=True),
+                'desc': ('Stream every annotation matching a search as '
+                         'newline-delimited JSON')
+            },
             'search_raw': {
                 'method': 'GET/POST',
                 'url': url_for('.search_annotations_raw', _external=True),
                 'desc': ('Advanced search API -- direct access to '
                          'ElasticSearch. Uses the same API as the '
                          'ElasticSearch query endpoint.')
+            },
+            'metrics': {
+                'method': 'GET',
+                'url': url_for('.metrics_endpoint', _external=True),
+                'desc': ('Request and ElasticSearch call metrics in the '
+                         'Prometheus text format, if enabled')
             }
         }
     })
@@ -139,13 +261,17 @@ def root():
 # INDEX
 @store.route('/annotations')
 def index():
+    if 'ids' in request.args:
+        return read_annotations()
+
     if current_app.config.get('AUTHZ_ON'):
         # Pass the current user to do permission filtering on results
         user = g.user
     else:
         user = None
 
-    annotations = g.annotation_class.search(user=user)
+    annotations = g.annotation_class.search(user=user,
+                                            fields=_get_fields(request.args))
     return jsonify(annotations)
 
 # CREATE
@@ -186,7 +312,12 @@ def create_annotation():
 # READ
 @store.route('/annotations/<docid>')
 def read_annotation(docid):
-    annotation = g.annotation_class.fetch(docid)
+    fields = _get_fields(request.args)
+    if fields is None:
+        annotation = g.annotation_class.fetch(docid)
+    else:
+        annotation = g.annotation_class.fetch(docid,
+                                              fields=_with_authz_fields(fields))
     if not annotation:
         return jsonify('Annotation not found!', status=404)
 
@@ -194,9 +325,57 @@ def read_annotation(docid):
     if failure:
         return failure
 
+    if fields is not None:
+        _strip_authz_fields(annotation, fields)
+
     return jsonify(annotation)
 
 
+# READ MANY
+@store.route('/annotations/_mget', methods=['GET', 'POST'])
+def read_annotations():
+    """
+    Get the annotations with the given ids, in the order of the ids. They are
+    either given as the comma-separated 'ids' parameter or, for long lists,
+    POSTed as a JSON list. Annotations which are missing, or which the user
+    may not read, are left out.
+    """
+    if request.method == 'POST':
+        docids = request.json
+        if (not isinstance(docids, list) or
+                not all(isinstance(i, string_types) for i in docids)):
+            return jsonify('No JSON list of ids sent!', status=400)
+    else:
+        docids = [i.strip() for i in _csv_split(request.args.get('ids', ''))
+                  if i.strip()]
+
+    # Each id is only fetched once
+    seen = set()
+    docids = [i for i in docids if not (i in seen or seen.add(i))]
+    if len(docids) > READ_MANY_MAX_IDS:
+        return jsonify('Too many ids sent, the most is {0}!'
+                       .format(READ_MANY_MAX_IDS), status=400)
+
+    fields = _get_fields(request.args)
+    if fields is None:
+        annotations = g.annotation_class.fetch_many(docids)
+    else:
+        annotations = g.annotation_class.fetch_many(
+            docids, fields=_with_authz_fields(fields))
+
+    results = []
+    for annotation in annotations:
+        if annotation is None:
+            continue
+        if not g.authorize(annotation, 'read', g.user):
+            continue
+        if fields is not None:
+            _strip_authz_fields(annotation, fields)
+        results.append(annotation)
+
+    return jsonify(results)
+
+
 # UPDATE
 @store.route('/annotations/<docid>', methods=['POST', 'PUT'])
 def update_annotation(docid):
@@ -263,21 +442,230 @@ def delete_annotation(docid):
     return '', 204
 
 
+# BULK
+@store.route('/annotations/_bulk', methods=['POST'])
+def bulk_annotations():
+    """
+    Perform a list of create, update and delete operations. Each item of the
+    JSON payload is an object with a single key naming the action, e.g.
+
+        [{"create": {"text": "Foo"}},
+         {"update": {"id": "123", "text": "Bar"}},
+         {"delete": {"id": "456"}}]
+
+    The response lists the outcome of each item in the same order.
+    """
+    items = request.json
+    if not isinstance(items, list):
+        return jsonify('No JSON list sent. No bulk operation performed.',
+                       status=400)
+    if len(items) > BULK_MAX_SIZE:
+        return jsonify('Too many operations sent, the most is {0}!'
+                       .format(BULK_MAX_SIZE), status=400)
+
+    results = [None] * len(items)
+    parsed = []
+
+    for i, item in enumerate(items):
+        try:
+            (action, obj), = iteritems(item)
+        except (AttributeError, ValueError):
+            action, obj = None, None
+        if action not in BULK_ACTIONS or not isinstance(obj, dict):
+            results[i] = _bulk_result('error', None, 400,
+                                      'Malformed bulk item.')
+            continue
+        if action != 'create' and 'id' not in obj:
+            results[i] = _bulk_result(action, None, 400, 'No id supplied.')
+            continue
+        if action != 'create' and not isinstance(obj['id'], string_types):
+            results[i] = _bulk_result(action, None, 400, 'Invalid id.')
+            continue
+        parsed.append((i, action, obj))
+
+    # Fetch every annotation that is to be updated or deleted in one go
+    docids = [obj['id'] for _, action, obj in parsed if action != 'create']
+    existing = dict(zip(docids, g.annotation_class.fetch_many(docids)))
+
+    operations = []
+    positions = []
+
+    for i, action, obj in parsed:
+        if action == 'create':
+            if g.user is None:
+                results[i] = _bulk_failed_authz(action, None)
+                continue
+
+            annotation = g.annotation_class(
+                _filter_input(obj, CREATE_FILTER_FIELDS))
+
+            annotation['consumer'] = g.user.consumer.key
+            if _get_annotation_user(annotation) != g.user.id:
+                annotation['user'] = g.user.id
+
+            if hasattr(g, 'before_annotation_create'):
+                g.before_annotation_create(annotation)
+
+            operations.append(('create', annotation))
+
+        else:
+            docid = obj['id']
+            annotation = existing.get(docid)
+            if not annotation:
+                results[i] = _bulk_result(action, docid, 404,
+                                          'Annotation not found!')
+                continue
+
+            # Items are independent, so don't share state between several
+            # operations on the same annotation
+            annotation = g.annotation_class(annotation)
+
+            if not g.authorize(annotation, action, g.user):
+                results[i] = _bulk_failed_authz(action, docid)
+                continue
+
+            if action == 'update':
+                updated = _filter_input(obj, UPDATE_FILTER_FIELDS)
+                updated['id'] = docid
+
+                changing_permissions = (
+                    'permissions' in updated and
+                    updated['permissions'] != annotation.get('permissions',
+                                                             {}))
+                if (changing_permissions and
+                        not g.authorize(annotation, 'admin', g.user)):
+                    results[i] = _bulk_failed_authz(action, docid)
+                    continue
+
+                annotation.update(updated)
+
+                if hasattr(g, 'before_annotation_update'):
+                    g.before_annotation_update(annotation)
+
+                operations.append(('index', annotation))
+            else:
+                if hasattr(g, 'before_annotation_delete'):
+                    g.before_annotation_delete(annotation)
+
+                operations.append(('delete', annotation))
+
+        positions.append((i, action))
+
+    refresh = request.args.get('refresh') != 'false'
+    after_create = hasattr(g, 'after_annotation_create')
+    resave = after_create and any(op == 'create' for op, _ in operations)
+
+    try:
+        es_items = g.annotation_class.bulk(operations,
+                                           refresh=refresh and not resave)
+    except TransportError as err:
+        return _transport_error_response(err)
+
+    created = []
+    for (i, action), (op_type, annotation), es_item in zip(positions,
+                                                           operations,
+                                                           es_items):
+        res = es_item[op_type]
+        status = res.get('status', 500)
+        if status >= 300:
+            results[i] = _bulk_result(action, annotation.get('id'), status,
+                                      res.get('error'))
+            continue
+
+        if action == 'create':
+            results[i] = _bulk_result(action, annotation['id'], 201)
+            if after_create:
+                g.after_annotation_create(annotation)
+                created.append(('index', annotation))
+        elif action == 'update':
+            results[i] = _bulk_result(action, annotation['id'], 200)
+            if hasattr(g, 'after_annotation_update'):
+                g.after_annotation_update(annotation)
+        else:
+            results[i] = _bulk_result(action, annotation['id'], 204)
+            if hasattr(g, 'after_annotation_delete'):
+                g.after_annotation_delete(annotation)
+
+    # Persist any changes made by the after_annotation_create hooks, as the
+    # single create endpoint does
+    if created:
+        try:
+            g.annotation_class.bulk(created, refresh=refresh)
+        except TransportError as err:
+            return _transport_error_response(err)
+
+    return jsonify(results)
+
+
 # SEARCH
 @store.route('/search')
 def search_annotations():
+    try:
+        kwargs = _search_kwargs(dict(request.args.items()))
+    except ValueError:
+        return jsonify('Invalid cursor!', status=400)
+
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    results = g.annotation_class.search(**kwargs)
+    return jsonify(_search_body(results, kwargs))
+
+
+# BATCH SEARCH
+@store.route('/search/batch', methods=['POST'])
+def search_annotations_batch():
+    """
+    Run a list of searches with a single Elasticsearch request. Each item of
+    the JSON payload is an object of the parameters /search takes, e.g.
+
+        [{"user": "alice", "limit": 10},
+         {"uri": "http://example.com", "sort": "created"}]
+
+    The response lists the results of each search in the same order.
+    """
+    items = request.json
+    if (not isinstance(items, list) or
+            not all(isinstance(item, dict) for item in items)):
+        return jsonify('No JSON list of searches sent!', status=400)
+    if len(items) > SEARCH_BATCH_MAX_SIZE:
+        return jsonify('Too many searches sent, the most is {0}!'
+                       .format(SEARCH_BATCH_MAX_SIZE), status=400)
+    if not all(_valid_search_params(item) for item in items):
+        return jsonify('Invalid search parameters!', status=400)
+
+    try:
+        searches = [_search_kwargs(dict(item)) for item in items]
+    except ValueError:
+        return jsonify('Invalid cursor!', status=400)
+
+    kwargs = dict()
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    try:
+        results = g.annotation_class.search_many(searches, **kwargs)
+    except TransportError as err:
+        return _transport_error_response(err)
+
+    return jsonify([_search_body(r, s) for r, s in zip(results, searches)])
+
+
+# STATS
+@store.route('/stats')
+def annotation_stats():
     params = dict(request.args.items())
     kwargs = dict()
 
-    # Take limit and offset out of the parameters
-    if 'offset' in params:
-        kwargs['offset'] = atoi(params.pop('offset'), default=None)
-    if 'limit' in params:
-        kwargs['limit'] = atoi(params.pop('limit'), default=None)
-    if 'sort' in params:
-        kwargs['sort'] = params.pop('sort')
-    if 'order' in params:
-        kwargs['order'] = params.pop('order')
+    limit = atoi(params.pop('limit', None), default=STATS_DEFAULT_LIMIT)
+    kwargs['limit'] = min(STATS_MAX_LIMIT, max(1, limit))
+    kwargs['interval'] = params.pop('interval', 'month')
+
+    # Paging and sorting don't apply
+    for k in ('offset', 'sort', 'order', 'fields', 'cursor'):
+        params.pop(k, None)
 
     # All remaining parameters are considered searched fields.
     kwargs['query'] = params
@@ -286,11 +674,74 @@ def search_annotations():
         # Pass the current user to do permission filtering on results
         kwargs['user'] = g.user
 
-    results = g.annotation_class.search(**kwargs)
-    total = g.annotation_class.count(**kwargs)
+    try:
+        stats = g.annotation_class.stats(**kwargs)
+    except TransportError as err:
+        return _transport_error_response(err)
+    return jsonify(stats)
+
+
+# COUNTS
+@store.route('/counts', methods=['POST'])
+def annotation_counts():
+    """
+    Count the annotations of each URI in the JSON list sent, as a search for
+    the URI would. The response maps each URI to its count.
+    """
+    uris = request.json
+    if (not isinstance(uris, list) or
+            not all(isinstance(uri, string_types) for uri in uris)):
+        return jsonify('No JSON list of URIs sent!', status=400)
+    if len(uris) > COUNTS_MAX_URIS:
+        return jsonify('Too many URIs sent, the most is {0}!'
+                       .format(COUNTS_MAX_URIS), status=400)
+
+    kwargs = dict()
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
 
-    return jsonify({'total': total,
-                    'rows': results})
+    try:
+        counts = g.annotation_class.count_by_uri(uris, **kwargs)
+    except TransportError as err:
+        return _transport_error_response(err)
+    return jsonify(counts)
+
+
+# EXPORT
+@store.route('/annotations/export')
+def export_annotations():
+    params = dict(request.args.items())
+    kwargs = dict()
+
+    # Paging, sorting and field selection don't apply: every match is returned
+    # whole, in no set order
+    for k in ('offset', 'limit', 'sort', 'order', 'fields', 'cursor'):
+        params.pop(k, None)
+
+    # All remaining parameters are considered searched fields.
+    kwargs['query'] = params
+
+    if current_app.config.get('AUTHZ_ON'):
+        # Pass the current user to do permission filtering on results
+        kwargs['user'] = g.user
+
+    annotations = g.annotation_class.scan(**kwargs)
+
+    # Fetch the first batch before responding, so that an error gets its own
+    # status rather than cutting a 200 response short
+    try:
+        first = next(annotations, None)
+    except TransportError as err:
+        return _transport_error_response(err)
+    if first is not None:
+        annotations = itertools.chain([first], annotations)
+
+    def generate():
+        for annotation in annotations:
+            yield encoder.dumps(annotation) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
 
 
 # RAW ES SEARCH
@@ -312,15 +763,19 @@ def search_annotations_raw():
         res = g.annotation_class.search_raw(query, params, raw_result=True,
                                             user=user)
     except TransportError as err:
-        if err.status_code is not 'N/A':
-            status_code = err.status_code
-        else:
-            status_code = 500
-        return jsonify(err.error,
-                       status=status_code)
+        return _transport_error_response(err)
     return jsonify(res, status=res.get('status', 200))
 
 
+# METRICS
+@store.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify('Metrics are not enabled!', status=404)
+    return Response(metrics.registry.render(),
+                    content_type=metrics.CONTENT_TYPE)
+
+
 def _filter_input(obj, fields):
     for field in fields:
         obj.pop(field, None)
@@ -341,6 +796,119 @@ def _get_annotation_user(ann):
         return user
 
 
+def _search_kwargs(params):
+    """
+    Returns the keyword arguments to Annotation.search for the parameters of
+    a /search request. Raises ValueError if the cursor is invalid.
+    """
+    kwargs = dict()
+
+    # Take limit and offset out of the parameters
+    if 'offset' in params:
+        kwargs['offset'] = atoi(params.pop('offset'), default=None)
+    if 'limit' in params:
+        kwargs['limit'] = atoi(params.pop('limit'), default=None)
+    if 'sort' in params:
+        kwargs['sort'] = params.pop('sort')
+    if 'order' in params:
+        kwargs['order'] = params.pop('order')
+    if 'fields' in params:
+        kwargs['fields'] = _get_fields(params)
+        params.pop('fields')
+    if 'cursor' in params:
+        # An empty cursor starts paging with cursors
+        cursor = params.pop('cursor')
+        kwargs['search_after'] = _decode_cursor(cursor) if cursor else []
+
+    # All remaining parameters are considered searched fields.
+    kwargs['query'] = params
+    return kwargs
+
+
+def _valid_search_params(params):
+    """
+    Returns whether the JSON parameters of a search have the types the query
+    string of a /search request would give them: an integer limit and offset,
+    strings for the other options, and a string or number for each field.
+    """
+    for key, value in iteritems(params):
+        if isinstance(value, bool):
+            return False
+        if key in ('limit', 'offset'):
+            if not isinstance(value, integer_types):
+                return False
+        elif key in ('sort', 'order', 'fields', 'cursor'):
+            if not isinstance(value, string_types):
+                return False
+        elif not isinstance(value, string_types + integer_types + (float,)):
+            return False
+    return True
+
+
+def _search_body(results, kwargs):
+    body = {'total': results.total,
+            'rows': results}
+
+    if kwargs.get('search_after') is None:
+        return body
+
+    # A full page may be followed by another one
+    limit = kwargs.get('limit')
+    if limit is None:
+        limit = RESULTS_DEFAULT_SIZE
+    limit = min(RESULTS_MAX_SIZE, max(0, limit))
+    if limit and len(results) == limit and results.last_sort is not None:
+        body['next'] = _encode_cursor(results.last_sort)
+    return body
+
+
+def _encode_cursor(sort_values):
+    data = json.dumps(sort_values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """
+    Returns the sort values encoded in a cursor made by _encode_cursor, or
+    raises ValueError if it isn't one.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        values = json.loads(data.decode('utf-8'))
+    except (AttributeError, TypeError, UnicodeError, ValueError):
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('invalid cursor')
+    return values
+
+
+def _get_fields(args):
+    """
+    Returns the list of fields requested with the 'fields' parameter, or None
+    if all fields should be returned.
+    """
+    if not args.get('fields'):
+        return None
+    return [f.strip() for f in _csv_split(args['fields']) if f.strip()]
+
+
+def _with_authz_fields(fields):
+    # Authorization checks need these fields, whatever the client asked for
+    includes = [f for f in fields if not f.startswith('-')]
+    res = [f for f in fields
+           if not (f.startswith('-') and f[1:] in AUTHZ_FIELDS)]
+    if includes:
+        res.extend(f for f in AUTHZ_FIELDS if f not in includes)
+    return res
+
+
+def _strip_authz_fields(annotation, fields):
+    includes = [f for f in fields if not f.startswith('-')]
+    for f in AUTHZ_FIELDS:
+        if (includes and f not in includes) or '-' + f in fields:
+            annotation.pop(f, None)
+
+
 def _check_action(annotation, action, message=''):
     if not g.authorize(annotation, action, g.user):
         return _failed_authz_response(message)
@@ -370,6 +938,32 @@ def _failed_authz_response(msg=''):
                     status=401)
 
 
+def _transport_error_response(err):
+    if err.status_code is not 'N/A':
+        status_code = err.status_code
+    else:
+        status_code = 500
+    return jsonify(err.error,
+                   status=status_code)
+
+
+def _bulk_result(action, docid, status, error=None):
+    res = {'id': docid, 'status': status}
+    if error is not None:
+        res['error'] = error
+    return {action: res}
+
+
+def _bulk_failed_authz(action, docid):
+    if g.user:
+        return _bulk_result(action, docid, 403,
+                            "You aren't authorized to make this request.")
+    return _bulk_result(action, docid, 401,
+                        "Cannot authorize request. Perhaps you're not logged "
+                        "in as a user with appropriate permissions on this "
+                        "annotation?")
+
+
 def _build_query_raw(request):
     query = {}
     params = {}
@@ -14,13 +14,24 @@ INTENDED FOR PRODUCTION USE.
 from __future__ import print_function
 
 import os
+
+# Serve each request in a greenlet rather than a thread if GEVENT is set in the
+# environment, so that a process can wait on many slow Elasticsearch requests
+# at once. Patching has to happen before anything else creates sockets, locks
+# or threads.
+if os.environ.get('GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
+
 import logging
 import sys
 import time
 
 from flask import Flask, g, current_app
 import elasticsearch
-from annotator import es, annotation, auth, authz, document, store
+from annotator import es, annotation, auth, authz, cache, document, metrics
+from annotator import store
+from annotator.elasticsearch import WriteBuffer
 from tests.helpers import MockUser, MockConsumer, MockAuthenticator
 from tests.helpers import mock_authorizer
 
@@ -55,6 +66,19 @@ def main(argv):
     if app.config.get('ELASTICSEARCH_HOST') is not None:
         es.host = app.config['ELASTICSEARCH_HOST']
 
+    # Connection pool settings
+    for key, attr in (('ELASTICSEARCH_POOL_MAXSIZE', 'maxsize'),
+                      ('ELASTICSEARCH_POOL_BLOCK', 'pool_block'),
+                      ('ELASTICSEARCH_SNIFF_ON_START', 'sniff_on_start'),
+                      ('ELASTICSEARCH_SNIFF_ON_CONNECTION_FAIL',
+                       'sniff_on_connection_fail'),
+                      ('ELASTICSEARCH_SNIFFER_TIMEOUT', 'sniffer_timeout'),
+                      ('ELASTICSEARCH_DEAD_TIMEOUT', 'dead_timeout'),
+                      ('ELASTICSEARCH_KEEP_ALIVE', 'keep_alive'),
+                      ('ELASTICSEARCH_COMPRESS', 'compress')):
+        if app.config.get(key) is not None:
+            setattr(es, attr, app.config[key])
+
     # We do need to set this one (the other settings have fine defaults)
     default_index = app.name
     es.index = app.config.get('ELASTICSEARCH_INDEX', default_index)
@@ -62,6 +86,43 @@ def main(argv):
     if app.config.get('AUTHZ_ON') is not None:
         es.authorization_enabled = app.config['AUTHZ_ON']
 
+    if app.config.get('FETCH_CACHE_SIZE'):
+        annotation.Annotation.cache = cache.LRUCache(
+            maxsize=app.config['FETCH_CACHE_SIZE'],
+            ttl=app.config.get('FETCH_CACHE_TTL'))
+
+    if app.config.get('WRITE_BUFFER_WINDOW'):
+        annotation.Annotation.write_buffer = WriteBuffer(
+            es,
+            window=app.config['WRITE_BUFFER_WINDOW'],
+            max_size=app.config.get('WRITE_BUFFER_SIZE', 500))
+
+    if app.config.get('DOCUMENT_MERGE_WORKERS'):
+        annotation.Annotation.document_queue = document.MergeQueue(
+            workers=app.config['DOCUMENT_MERGE_WORKERS'])
+
+    if app.config.get('URI_CACHE_SIZE'):
+        document.Document.uri_cache = cache.LRUCache(
+            maxsize=app.config['URI_CACHE_SIZE'],
+            ttl=app.config.get('URI_CACHE_TTL'))
+
+    if app.config.get('METRICS_ON'):
+        metrics.enabled = True
+
+    if app.config.get('SLOW_QUERY_THRESHOLD') is not None:
+        metrics.slow_query_threshold = app.config['SLOW_QUERY_THRESHOLD']
+        metrics.slow_query_sample_rate = app.config.get(
+            'SLOW_QUERY_SAMPLE_RATE', 1.0)
+        metrics.slow_query_max_body = app.config.get(
+            'SLOW_QUERY_MAX_BODY', 2000)
+
+    consumers = auth.ConsumerRegistry(lambda x: MockConsumer('annotateit'),
+                                      path=app.config.get('CONSUMERS_FILE'))
+
+    token_cache = None
+    if app.config.get('TOKEN_CACHE_SIZE'):
+        token_cache = cache.LRUCache(maxsize=app.config['TOKEN_CACHE_SIZE'])
+
     with app.test_request_context():
         try:
             annotation.Annotation.create_all()
@@ -91,7 +152,7 @@ def main(argv):
         # tests. Set AUTH_ON to True in the config file to enable (limited)
         # authentication testing.
         if current_app.config['AUTH_ON']:
-            g.auth = auth.Authenticator(lambda x: MockConsumer('annotateit'))
+            g.auth = auth.Authenticator(consumers, cache=token_cache)
         else:
             g.auth = MockAuthenticator()
 
@@ -108,7 +169,12 @@ def main(argv):
 
     host = os.environ.get('HOST', '127.0.0.1')
     port = int(os.environ.get('PORT', 5000))
-    app.run(host=host, port=port)
+    if os.environ.get('GEVENT'):
+        from gevent.pywsgi import WSGIServer
+        log.info("Serving on http://%s:%s/ with gevent", host, port)
+        WSGIServer((host, port), app).serve_forever()
+    else:
+        app.run(host=host, port=port)
 
 if __name__ == '__main__':
     main(sys.argv)
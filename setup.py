@@ -23,6 +23,8 @@ setup(
         'docs': ['Sphinx'],
         'testing': ['Flask>=0.9,<2', 'mock', 'nose', 'coverage'],
         'flask': ['Flask>=0.9,<2'],
+        'speedups': ['ujson'],
+        'gevent': ['gevent'],
     },
 
     # metadata for upload to PyPI
@@ -12,7 +12,10 @@ def create_app():
     app = Flask(__name__)
     app.config.from_pyfile(os.path.join(here, 'test.cfg'))
 
-    es.host = app.config['ELASTICSEARCH_HOST']
+    # ELASTICSEARCH_HOST=memory:// in the environment runs the tests against
+    # the in-memory backend instead
+    es.host = os.environ.get('ELASTICSEARCH_HOST',
+                             app.config['ELASTICSEARCH_HOST'])
     es.index = app.config['ELASTICSEARCH_INDEX']
     es.authorization_enabled = app.config['AUTHZ_ON']
 
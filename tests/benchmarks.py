@@ -0,0 +1,355 @@
+"""
+Benchmarks for the store's hot paths.
+
+Elasticsearch is replaced by FakeElasticsearch, which answers the calls the
+store makes with canned responses, so the benchmarks run offline and measure
+the store itself rather than the network or the cluster.
+
+Usage:
+
+    python -m tests.benchmarks run [--save FILE] [--bench NAME ...]
+    python -m tests.benchmarks compare BASELINE [--max-slowdown 0.25]
+                                                [--bench NAME ...]
+
+'run' prints the time per call of each benchmark and optionally saves the
+results as a baseline. 'compare' runs the benchmarks again and exits with
+status 1 if any is more than max-slowdown (a fraction) slower than in the
+baseline. Timings are only comparable between runs on the same machine.
+"""
+from __future__ import print_function
+
+import json
+import optparse
+import platform
+import sys
+import timeit
+import uuid
+
+from flask import g
+from six.moves import xrange
+
+from annotator import annotation, auth, authz, document, elasticsearch, es
+from annotator import store
+
+from . import create_app
+from .helpers import MockUser
+
+# Each benchmark is repeated this many times, and the fastest run is kept
+REPEAT = 5
+# Each run lasts at least this many seconds
+MIN_RUN_TIME = 0.2
+
+
+def _annotation_hit(i):
+    return {
+        '_id': 'annotation-%d' % i,
+        '_source': {
+            'annotator_schema_version': 'v1.0',
+            'created': '2015-07-17T12:00:00+00:00',
+            'updated': '2015-07-17T12:00:00+00:00',
+            'user': 'alice',
+            'consumer': 'mockconsumer',
+            'uri': 'http://example.com/%d' % (i % 5),
+            'quote': 'Lorem ipsum dolor sit amet ' * 4,
+            'text': 'Consectetur adipiscing elit ' * 8,
+            'tags': ['foo', 'bar'],
+            'ranges': [{'start': '/p[1]', 'end': '/p[1]',
+                        'startOffset': 0, 'endOffset': 100}],
+            'permissions': {'read': ['group:__world__'],
+                            'update': ['alice'],
+                            'delete': ['alice'],
+                            'admin': ['alice']},
+        },
+        'sort': [1437134400000 - i, 'annotation#annotation-%d' % i],
+    }
+
+
+def _document_hit(i):
+    return {
+        '_id': 'document-%d' % i,
+        '_source': {
+            'title': 'Example %d' % i,
+            'cluster': 'cluster-0',
+            'link': [{'href': 'http://example.com/%d' % i},
+                     {'href': 'doi:10.1000/%d' % i, 'type': 'doi'}],
+        },
+    }
+
+
+class FakeElasticsearch(object):
+    """
+    Stands in for an elasticsearch.Elasticsearch client.
+
+    Responses are decoded from JSON on every call, as the real client does, so
+    that callers may modify them freely.
+    """
+
+    def __init__(self, annotations=20, documents=3):
+        self._annotations = json.dumps({
+            'took': 1,
+            'hits': {'total': annotations,
+                     'hits': [_annotation_hit(i) for i in xrange(annotations)]}
+        })
+        self._documents = json.dumps({
+            'took': 1,
+            'hits': {'total': documents,
+                     'hits': [_document_hit(i) for i in xrange(documents)]}
+        })
+        self._annotation = json.dumps(dict(_annotation_hit(0), found=True))
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        if doc_type == document.TYPE:
+            return json.loads(self._documents)
+        return json.loads(self._annotations)
+
+    def get(self, index=None, doc_type=None, id=None, **params):
+        return json.loads(self._annotation)
+
+    def mget(self, index=None, doc_type=None, body=None, **params):
+        return {'docs': [dict(json.loads(self._annotation), _id=docid)
+                         for docid in body['ids']]}
+
+    def count(self, index=None, doc_type=None, body=None, **params):
+        return {'count': json.loads(self._annotations)['hits']['total']}
+
+    def index(self, index=None, doc_type=None, body=None, id=None, **params):
+        return {'_id': id or uuid.uuid4().hex, 'created': id is None}
+
+    def delete(self, index=None, doc_type=None, id=None, **params):
+        return {'found': True}
+
+    def bulk(self, body=None, **params):
+        items = []
+        for item in body:
+            for action in ('index', 'create', 'update', 'delete'):
+                if action in item:
+                    header = item[action]
+                    items.append({action: {
+                        '_id': header.get('_id') or uuid.uuid4().hex,
+                        'status': 200
+                    }})
+        return {'took': 1, 'errors': False, 'items': items}
+
+
+def _bench_build_query():
+    query = {'text': 'foo', 'user': 'alice'}
+    return lambda: elasticsearch._build_query(query, 0, 20, 'updated', 'desc')
+
+
+def _bench_annotation_build_query():
+    query = {'uri': 'http://example.com/1', 'text': 'foo',
+             'after': '2015-01-01'}
+    return lambda: annotation.Annotation._build_query(query=query)
+
+
+def _bench_authorize():
+    ann = _annotation_hit(0)['_source']
+    ann['permissions']['read'] = ['bob', 'group:__consumer__']
+    user = MockUser('charlie')
+    return lambda: authz.authorize(ann, 'read', user)
+
+
+def _bench_permissions_filter():
+    user = MockUser('alice')
+    return lambda: authz.permissions_filter(user)
+
+
+def _bench_permissions_filter_cold():
+    user = MockUser('alice')
+
+    def bench():
+        authz._filter_cache.clear()
+        authz.permissions_filter(user)
+    return bench
+
+
+def _bench_build_query_raw(app):
+    def bench():
+        path = '/api/search_raw?q=text:foo&size=50&from=10&sort=updated'
+        with app.test_request_context(path):
+            store._build_query_raw(store.request)
+    return bench
+
+
+def _bench_jsonify(app):
+    rows = [annotation.Annotation(h['_source'], id=h['_id'])
+            for h in json.loads(es.conn._annotations)['hits']['hits']]
+
+    def bench():
+        with app.test_request_context('/api/search'):
+            store.jsonify({'total': len(rows), 'rows': rows}).get_data()
+    return bench
+
+
+def _bench_document_save():
+    def bench():
+        doc = document.Document({
+            'title': 'Example',
+            'link': [{'href': 'http://example.com/0'},
+                     {'href': 'http://example.com/new'}],
+        })
+        doc.save()
+    return bench
+
+
+def _bench_request_search(app):
+    cli = app.test_client()
+    headers = _auth_headers()
+    return lambda: cli.get('/api/search?uri=http://example.com/1&limit=20',
+                           headers=headers).get_data()
+
+
+def _bench_request_read(app):
+    cli = app.test_client()
+    headers = _auth_headers()
+    return lambda: cli.get('/api/annotations/annotation-0',
+                           headers=headers).get_data()
+
+
+def _bench_request_create(app):
+    cli = app.test_client()
+    headers = _auth_headers()
+    payload = json.dumps(_annotation_hit(0)['_source'])
+    return lambda: cli.post('/api/annotations',
+                            data=payload,
+                            content_type='application/json',
+                            headers=headers).get_data()
+
+
+def _auth_headers():
+    token = auth.encode_token({'consumerKey': 'mockconsumer',
+                               'userId': 'alice'}, 'top-secret')
+    if not isinstance(token, str):
+        token = token.decode('ascii')
+    return {'x-annotator-auth-token': token}
+
+
+# Benchmarks by name. Each is a function which sets the benchmark up and
+# returns the function to time; those taking an argument are passed the app.
+BENCHMARKS = [
+    ('build_query', _bench_build_query),
+    ('annotation_build_query', _bench_annotation_build_query),
+    ('authorize', _bench_authorize),
+    ('permissions_filter', _bench_permissions_filter),
+    ('permissions_filter_cold', _bench_permissions_filter_cold),
+    ('build_query_raw', _bench_build_query_raw),
+    ('jsonify', _bench_jsonify),
+    ('document_save', _bench_document_save),
+    ('request_search', _bench_request_search),
+    ('request_read', _bench_request_read),
+    ('request_create', _bench_request_create),
+]
+_NEEDS_APP = set(['build_query_raw', 'jsonify', 'request_search',
+                  'request_read', 'request_create'])
+
+
+def run(names=None):
+    """
+    Runs the named benchmarks (or all of them) and returns a dict of the
+    seconds taken per call by each.
+    """
+    app = create_app()
+    real_connection = es.__dict__.pop('_connection', None)
+    es._connection = FakeElasticsearch()
+
+    results = {}
+    try:
+        for name, setup in BENCHMARKS:
+            if names and name not in names:
+                continue
+            results[name] = _time(app, name, setup)
+    finally:
+        del es._connection
+        if real_connection is not None:
+            es._connection = real_connection
+
+    return results
+
+
+def _time(app, name, setup):
+    with app.test_request_context():
+        g.user = None
+        func = setup(app) if name in _NEEDS_APP else setup()
+
+        # Calibrate, so that each run lasts at least MIN_RUN_TIME
+        timer = timeit.Timer(func)
+        number = 1
+        while timer.timeit(number) < MIN_RUN_TIME:
+            number *= 2
+
+        best = min(timer.repeat(REPEAT, number))
+        return best / number
+
+
+def compare(baseline, results, max_slowdown):
+    """
+    Returns the names of the benchmarks in results which are more than
+    max_slowdown (a fraction) slower than in the baseline.
+    """
+    slower = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        if results[name] > baseline[name] * (1 + max_slowdown):
+            slower.append(name)
+    return slower
+
+
+def _print_results(results, baseline=None):
+    for name, _ in BENCHMARKS:
+        if name not in results:
+            continue
+        line = '{0:<26} {1:>12.2f} us'.format(name, results[name] * 1e6)
+        if baseline and name in baseline:
+            change = results[name] / baseline[name] - 1
+            line += '  {0:+7.1%}'.format(change)
+        print(line)
+
+
+def main(argv):
+    # optparse rather than argparse, which Python 2.6 lacks
+    parser = optparse.OptionParser(
+        prog='python -m tests.benchmarks',
+        usage=("%prog run [--save FILE] [--bench NAME ...]\n"
+               "       %prog compare BASELINE [--max-slowdown 0.25] "
+               "[--bench NAME ...]"),
+        description="Store benchmarks")
+    parser.add_option('--save', help="'run': save the results to this file")
+    parser.add_option('--bench', action='append', dest='names',
+                      help="Only run this benchmark (repeatable)")
+    parser.add_option('--max-slowdown', type='float', default=0.25,
+                      help="'compare': fail if a benchmark is slower than "
+                           "the baseline by more than this fraction "
+                           "(default: 0.25)")
+
+    opts, args = parser.parse_args(argv)
+    command = args[0] if args else None
+
+    if command == 'run' and len(args) == 1:
+        results = run(opts.names)
+        _print_results(results)
+        if opts.save:
+            with open(opts.save, 'w') as f:
+                json.dump({'python': platform.python_version(),
+                           'results': results}, f, indent=2, sort_keys=True)
+        return 0
+
+    elif command == 'compare' and len(args) == 2:
+        with open(args[1]) as f:
+            baseline = json.load(f)['results']
+        results = run(opts.names)
+        _print_results(results, baseline)
+        slower = compare(baseline, results, opts.max_slowdown)
+        if slower:
+            print("Slower than the baseline by more than {0:.0%}: {1}"
+                  .format(opts.max_slowdown, ', '.join(slower)),
+                  file=sys.stderr)
+            return 1
+        return 0
+
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
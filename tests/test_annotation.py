@@ -1,8 +1,9 @@
 from nose.tools import *
-from mock import MagicMock
+from mock import MagicMock, patch
 from . import TestCase, helpers as h
 
 from annotator.annotation import Annotation
+from annotator.document import Document
 
 uri1 = u'http://xyz.com'
 uri2 = u'urn:uuid:xxxxx'
@@ -46,6 +47,41 @@ class TestAnnotation(TestCase):
         args, kwargs = a.es.conn.index.call_args
         assert_equal(kwargs['refresh'], False)
 
+    def test_save_readers(self):
+        a = Annotation(user='bob', consumer='consumerkey')
+        a.es = MagicMock()
+        a.es.index = 'foo'
+        a.save()
+        body = a.es.conn.index.call_args[1]['body']
+        assert_equal(body['readers'], ['user:["consumerkey","bob"]',
+                                       'consumer:consumerkey',
+                                       'admin:consumerkey'])
+
+    def test_save_document_queue(self):
+        a = Annotation(name='bob', document={
+            'link': [{'href': 'http://example.com/1234'}]
+        })
+        a.es = MagicMock()
+        a.es.index = 'foo'
+        a.document_queue = MagicMock()
+        a.save()
+        doc = a.document_queue.put.call_args[0][0]
+        assert_equal(doc.uris(), ['http://example.com/1234'])
+        assert_true(a.es.conn.index.called)
+
+    def test_bulk_saves_documents_once(self):
+        anns = [
+            Annotation(text='foo', document={'link': [{'href': 'a'}]}),
+            Annotation(text='bar', document={'link': [{'href': 'a'},
+                                                      {'href': 'b'}]}),
+            Annotation(text='baz', document={'link': [{'href': 'c'}]}),
+            Annotation(text='qux'),
+        ]
+        with patch.object(Document, 'save') as save:
+            Annotation.bulk([('create', a) for a in anns])
+        assert_equal(save.call_count, 2)
+        assert_equal(Annotation.count(authorization_enabled=False), 4)
+
     def test_fetch(self):
         a = Annotation(foo='bar')
         a.save()
@@ -102,6 +138,7 @@ class TestAnnotation(TestCase):
 
         res = Annotation.search()
         assert_equal(len(res), 3)
+        assert_equal(res.total, 3)
 
         res = Annotation.count()
         assert_equal(res, 3)
@@ -142,6 +179,7 @@ class TestAnnotation(TestCase):
 
         res = Annotation.search(limit=1)
         assert_equal(len(res), 1)
+        assert_equal(res.total, 3)
 
         res = Annotation.count(limit=1)
         assert_equal(res, 3)
@@ -332,6 +370,67 @@ class TestAnnotation(TestCase):
         assert_equal(len(hits), 1)
 
 
+    def test_stats(self):
+        perms = {'read': ['group:__world__']}
+        Annotation(uri=u'http://example.com/a b', user=u'alice',
+                   tags=['foo', 'bar'], permissions=perms,
+                   created='2015-01-05T12:00:00+00:00').save()
+        Annotation(uri=u'http://example.com/a b', user=u'bob',
+                   tags=['foo'], permissions=perms,
+                   created='2015-02-05T12:00:00+00:00').save()
+        Annotation(uri=u'http://example.com/c', user=u'alice',
+                   permissions={'read': ['alice']},
+                   created='2015-02-06T12:00:00+00:00').save()
+
+        stats = Annotation.stats(authorization_enabled=False)
+        assert_equal(stats['total'], 3)
+        assert_equal(stats['tags'], [{'key': 'foo', 'count': 2},
+                                     {'key': 'bar', 'count': 1}])
+        assert_equal(stats['user'], [{'key': 'alice', 'count': 2},
+                                     {'key': 'bob', 'count': 1}])
+        assert_equal(stats['uri'][0],
+                     {'key': 'http://example.com/a b', 'count': 2})
+        assert_equal(stats['created'], [
+            {'key': '2015-01-01T00:00:00.000Z', 'count': 1},
+            {'key': '2015-02-01T00:00:00.000Z', 'count': 2},
+        ])
+
+        stats = Annotation.stats(query={'user': 'alice'}, limit=1,
+                                 authorization_enabled=False)
+        assert_equal(stats['total'], 2)
+        assert_equal(stats['uri'], [{'key': 'http://example.com/a b',
+                                     'count': 1}])
+
+        # Only the annotations the user may read are counted
+        stats = Annotation.stats(user=h.MockUser('bob'),
+                                 authorization_enabled=True)
+        assert_equal(stats['total'], 2)
+
+    def test_count_by_uri(self):
+        perms = {'read': ['group:__world__']}
+        Document({'link': [{'href': 'http://example.com/a'},
+                           {'href': 'http://example.com/a.pdf'}]}).save()
+        for uri in ['http://example.com/a', 'http://example.com/a.pdf',
+                    'http://example.com/b']:
+            Annotation(uri=uri, permissions=perms).save()
+        Annotation(uri='http://example.com/b',
+                   permissions={'read': ['alice']}).save()
+
+        counts = Annotation.count_by_uri(['http://example.com/a.pdf',
+                                          'http://example.com/b',
+                                          'http://example.com/c'],
+                                         authorization_enabled=False)
+        assert_equal(counts, {'http://example.com/a.pdf': 2,
+                              'http://example.com/b': 2,
+                              'http://example.com/c': 0})
+
+        counts = Annotation.count_by_uri(['http://example.com/b'],
+                                         user=h.MockUser('bob'),
+                                         authorization_enabled=True)
+        assert_equal(counts, {'http://example.com/b': 1})
+
+        assert_equal(Annotation.count_by_uri([]), {})
+
     def test_cross_representations(self):
 
         # create an annotation for an html document which we can
@@ -1,5 +1,9 @@
 import datetime
 import hashlib
+import json
+import os
+import shutil
+import tempfile
 import time
 
 from nose.tools import *
@@ -9,6 +13,7 @@ from six import u
 from werkzeug import Headers
 
 from annotator import auth
+from annotator.cache import LRUCache
 
 class MockRequest():
     def __init__(self, headers):
@@ -95,3 +100,113 @@ class TestAuthenticator(object):
         request = make_request(self.consumer)
         request.headers['x-annotator-auth-token'] += b'LookMaIAmAHacker'
         assert_equal(self.auth.request_user(request), None)
+
+class TestAuthenticatorCache(object):
+    def setup(self):
+        self.consumer = MockConsumer()
+        self.fetcher = Mock(return_value=self.consumer)
+        self.clock = 1000.0
+        self.cache = LRUCache(timer=lambda: self.clock)
+        self.auth = auth.Authenticator(self.fetcher, cache=self.cache)
+
+    def test_request_user_cached(self):
+        request = make_request(self.consumer, {'userId': 'alice'})
+        user = self.auth.request_user(request)
+        assert_equal(user.id, 'alice')
+        assert_is(self.auth.request_user(request), user)
+        assert_equal(self.fetcher.call_count, 1)
+
+    def test_request_user_cache_expires_with_token(self):
+        request = make_request(self.consumer, {'userId': 'alice'})
+        self.auth.request_user(request)
+
+        self.clock += 290
+        self.auth.request_user(request)
+        assert_equal(self.fetcher.call_count, 1)
+
+        # The token's ttl is 300 seconds
+        self.clock += 20
+        self.auth.request_user(request)
+        assert_equal(self.fetcher.call_count, 2)
+
+    def test_request_user_invalid_not_cached(self):
+        request = make_request(self.consumer)
+        request.headers['x-annotator-auth-token'] += b'LookMaIAmAHacker'
+        assert_equal(self.auth.request_user(request), None)
+        assert_equal(len(self.cache), 0)
+
+class TestConsumerRegistry(object):
+    def setup(self):
+        self.consumer = MockConsumer()
+        self.fetcher = Mock(side_effect=lambda key: (self.consumer
+                                                     if key == 'Consumer'
+                                                     else None))
+        self.clock = 1000.0
+        self.registry = auth.ConsumerRegistry(self.fetcher, ttl=300,
+                                              negative_ttl=60,
+                                              timer=lambda: self.clock)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_consumers(self, data):
+        path = os.path.join(self.tmpdir, 'consumers.json')
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    def test_found_cached(self):
+        assert_is(self.registry('Consumer'), self.consumer)
+        assert_is(self.registry('Consumer'), self.consumer)
+        assert_equal(self.fetcher.call_count, 1)
+
+        self.clock += 301
+        assert_is(self.registry('Consumer'), self.consumer)
+        assert_equal(self.fetcher.call_count, 2)
+
+    def test_missing_cached(self):
+        assert_equal(self.registry('bogus'), None)
+        assert_equal(self.registry('bogus'), None)
+        assert_equal(self.fetcher.call_count, 1)
+
+        self.clock += 61
+        assert_equal(self.registry('bogus'), None)
+        assert_equal(self.fetcher.call_count, 2)
+
+    def test_invalidate(self):
+        self.registry('Consumer')
+        self.registry.invalidate('Consumer')
+        self.registry('Consumer')
+        assert_equal(self.fetcher.call_count, 2)
+
+    def test_file(self):
+        path = self.write_consumers({'filekey': {'secret': 's3cr3t'}})
+        registry = auth.ConsumerRegistry(path=path, reload_interval=5,
+                                         timer=lambda: self.clock)
+        consumer = registry('filekey')
+        assert_equal(consumer.secret, 's3cr3t')
+        assert_equal(consumer.ttl, auth.DEFAULT_TTL)
+        assert_equal(registry('Consumer'), None)
+
+        self.write_consumers({'filekey': {'secret': 'new', 'ttl': 60}})
+        os.utime(path, (0, 0))
+        self.clock += 5
+        assert_equal(registry('filekey').secret, 'new')
+
+    def test_file_bad_reload_keeps_consumers(self):
+        path = self.write_consumers({'filekey': {'secret': 's3cr3t'}})
+        registry = auth.ConsumerRegistry(path=path, timer=lambda: self.clock)
+
+        with open(path, 'w') as f:
+            f.write('{junk')
+        os.utime(path, (0, 0))
+        self.clock += 60
+        assert_equal(registry('filekey').secret, 's3cr3t')
+
+    def test_authenticator(self):
+        a = auth.Authenticator(self.registry)
+        request = make_request(self.consumer, {'userId': 'alice'})
+        assert_equal(a.request_user(request).id, 'alice')
+        assert_equal(a.request_user(request).id, 'alice')
+        assert_equal(self.fetcher.call_count, 1)
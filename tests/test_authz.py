@@ -1,5 +1,7 @@
 from . import helpers as h
-from annotator.authz import authorize
+from annotator import authz
+from annotator.authz import annotation_readers, authorize
+from annotator.authz import permissions_filter, user_principals
 
 class TestAuthorization(object):
 
@@ -108,3 +110,101 @@ class TestAuthorization(object):
         assert authorize(ann, 'read', admin)
         assert authorize(ann, 'update', admin)
         assert authorize(ann, 'admin', admin)
+
+
+class TestPermissionsFilter(object):
+
+    def setup(self):
+        authz._filter_cache.clear()
+
+    def test_anonymous(self):
+        assert permissions_filter() == {'terms': {'readers': ['world']}}
+
+    def test_group_user(self):
+        assert permissions_filter(h.MockUser('group:__world__')) is False
+
+    def test_user(self):
+        f = permissions_filter(h.MockUser('bob', 'consumerkey'))
+        assert f == {'terms': {'readers': [
+            'world',
+            'authenticated',
+            'consumer:consumerkey',
+            'user:["consumerkey","bob"]',
+        ]}}
+
+    def test_admin(self):
+        admin = h.MockUser('walter', 'consumerkey')
+        admin.is_admin = True
+        f = permissions_filter(admin)
+        assert 'admin:consumerkey' in f['terms']['readers']
+
+    def test_memoized(self):
+        f = permissions_filter(h.MockUser('bob', 'consumerkey'))
+        assert permissions_filter(h.MockUser('bob', 'consumerkey')) is f
+        assert permissions_filter(h.MockUser('bob', 'otherkey')) is not f
+
+        admin = h.MockUser('bob', 'consumerkey')
+        admin.is_admin = True
+        assert permissions_filter(admin) is not f
+
+
+class TestAnnotationReaders(object):
+
+    def test_readers(self):
+        ann = {
+            'user': 'alice',
+            'consumer': 'consumerkey',
+            'permissions': {'read': ['group:__world__', 'bob']}
+        }
+        assert annotation_readers(ann) == [
+            'world',
+            'user:["consumerkey","alice"]',
+            'user:["consumerkey","bob"]',
+            'admin:consumerkey',
+        ]
+
+    def test_readers_colons(self):
+        # A colon in the consumer key or user id doesn't make the owner's
+        # principal that of another user
+        ann = {'user': 'b', 'consumer': 'a:'}
+        other = {'user': ':b', 'consumer': 'a'}
+        assert not (set(annotation_readers(ann)) &
+                    set(annotation_readers(other)))
+
+    def test_readers_no_consumer(self):
+        ann = {'user': 'alice', 'permissions': {'read': ['alice']}}
+        assert annotation_readers(ann) == []
+
+    def test_readers_match_authorize(self):
+        # The flattened readers must grant read access exactly when
+        # authorize() does
+        anns = [
+            {},
+            {'permissions': {'read': ['group:__world__']}},
+            {'permissions': {'read': ['group:__authenticated__']}},
+            {'permissions': {'read': ['group:__consumer__']}},
+            {'consumer': 'consumerkey',
+             'permissions': {'read': ['group:__consumer__']}},
+            {'consumer': 'consumerkey', 'permissions': {'read': ['bob']}},
+            {'consumer': 'consumerkey', 'user': 'alice'},
+            {'consumer': 'consumerkey', 'user': {'id': 'alice'},
+             'permissions': {'read': []}},
+            {'consumer': 'otherkey', 'user': 'bob',
+             'permissions': {'read': ['bob', 'group:__authenticated__']}},
+        ]
+        admin = h.MockUser('walter', 'consumerkey')
+        admin.is_admin = True
+        users = [
+            None,
+            h.MockUser('alice', 'consumerkey'),
+            h.MockUser('bob', 'consumerkey'),
+            h.MockUser('bob', 'otherkey'),
+            h.MockUser('charlie', 'consumerkey'),
+            admin,
+        ]
+        for ann in anns:
+            readers = set(annotation_readers(ann))
+            for user in users:
+                principals = set(user_principals(user))
+                assert (bool(readers & principals) ==
+                        authorize(ann, 'read', user)), (ann, user and user.id)
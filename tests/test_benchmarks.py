@@ -0,0 +1,21 @@
+from nose.tools import *
+
+from . import benchmarks
+
+
+class TestBenchmarks(object):
+
+    def test_compare(self):
+        baseline = {'a': 1.0, 'b': 1.0, 'c': 1.0}
+        results = {'a': 1.2, 'b': 1.3, 'd': 5.0}
+        assert_equal(benchmarks.compare(baseline, results, 0.25), ['b'])
+        assert_equal(benchmarks.compare(baseline, results, 0.1), ['a', 'b'])
+
+    def test_run(self):
+        benchmarks.MIN_RUN_TIME = 0.001
+        try:
+            results = benchmarks.run(['authorize', 'request_read'])
+        finally:
+            benchmarks.MIN_RUN_TIME = 0.2
+        assert_equal(sorted(results), ['authorize', 'request_read'])
+        assert_true(all(t > 0 for t in results.values()))
@@ -0,0 +1,104 @@
+from nose.tools import *
+
+from annotator.cache import LRUCache, MISSING
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(object):
+    def setup(self):
+        self.timer = FakeTimer()
+        self.cache = LRUCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_get_missing(self):
+        assert_true(self.cache.get('foo') is MISSING)
+        assert_equal(self.cache.get('foo', 'bar'), 'bar')
+        assert_equal(self.cache.misses, 2)
+
+    def test_set_get(self):
+        self.cache.set('foo', 'bar')
+        assert_equal(self.cache.get('foo'), 'bar')
+        assert_equal(self.cache.hits, 1)
+
+    def test_cache_none(self):
+        self.cache.set('foo', None)
+        assert_equal(self.cache.get('foo'), None)
+
+    def test_ttl(self):
+        self.cache.set('foo', 'bar')
+        self.timer.now += 9
+        assert_equal(self.cache.get('foo'), 'bar')
+        self.timer.now += 1
+        assert_true(self.cache.get('foo') is MISSING)
+
+    def test_ttl_override(self):
+        self.cache.set('foo', 'bar', ttl=1)
+        self.timer.now += 1
+        assert_true(self.cache.get('foo') is MISSING)
+
+    def test_no_ttl(self):
+        cache = LRUCache(timer=self.timer)
+        cache.set('foo', 'bar')
+        self.timer.now += 10 ** 6
+        assert_equal(cache.get('foo'), 'bar')
+
+    def test_lru_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        assert_equal(len(self.cache), 2)
+        assert_equal(self.cache.evictions, 1)
+        assert_true(self.cache.get('b') is MISSING)
+        assert_equal(self.cache.get('a'), 1)
+        assert_equal(self.cache.get('c'), 3)
+
+    def test_lru_eviction_after_replace(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.set('a', 3)
+        self.cache.invalidate('b')
+        self.cache.set('c', 4)
+        self.cache.set('d', 5)
+
+        assert_equal(self.cache.evictions, 1)
+        assert_true(self.cache.get('a') is MISSING)
+        assert_equal(self.cache.get('c'), 4)
+        assert_equal(self.cache.get('d'), 5)
+
+    def test_expired_entry_removed(self):
+        self.cache.set('foo', 'bar')
+        self.timer.now += 10
+        assert_true(self.cache.get('foo') is MISSING)
+        assert_equal(len(self.cache), 0)
+
+    def test_invalidate(self):
+        self.cache.set('foo', 'bar')
+        self.cache.invalidate('foo')
+        self.cache.invalidate('baz')
+        assert_true(self.cache.get('foo') is MISSING)
+
+    def test_clear(self):
+        self.cache.set('foo', 'bar')
+        self.cache.clear()
+        assert_equal(len(self.cache), 0)
+
+        self.cache.set('foo', 'baz')
+        assert_equal(self.cache.get('foo'), 'baz')
+
+    def test_stats(self):
+        self.cache.set('foo', 'bar')
+        self.cache.get('foo')
+        self.cache.get('baz')
+        assert_equal(self.cache.stats(), {'hits': 1,
+                                          'misses': 1,
+                                          'evictions': 0,
+                                          'size': 1,
+                                          'maxsize': 2})
@@ -1,8 +1,12 @@
+import threading
+
 from flask import g
 from nose.tools import *
+from mock import patch
 
 from . import TestCase
-from annotator.document import Document
+from annotator.cache import LRUCache
+from annotator.document import Document, MergeQueue, coalesce
 
 
 peerj = {
@@ -139,6 +143,79 @@ class TestDocument(TestCase):
     def test_get_by_uri_not_found(self):
         assert Document.get_by_uri("bogus") is None
 
+    def test_equivalent_uris(self):
+        d = Document({
+            "id": "1",
+            "title": "document1",
+            "link": [peerj["html"], peerj["pdf"]]
+        })
+        d.save()
+
+        uris = Document.equivalent_uris("https://peerj.com/articles/53.pdf")
+        assert_equal(uris, [peerj["html"]["href"], peerj["pdf"]["href"]])
+        assert_equal(Document.equivalent_uris("bogus"), [])
+
+    def test_equivalent_uris_cache(self):
+        Document.uri_cache = LRUCache()
+        try:
+            assert_equal(Document.equivalent_uris(peerj["doc"]["href"]), [])
+
+            d = Document({
+                "id": "1",
+                "title": "document1",
+                "link": [peerj["html"], peerj["pdf"]]
+            })
+            d.save()
+
+            d = Document({
+                "id": "2",
+                "title": "document2",
+                "link": [peerj["pdf"], peerj["doc"]]
+            })
+            d.save()
+
+            # Saving updated the cached entries of every merged URI
+            with patch.object(Document, 'get_by_uri') as get_mock:
+                uris = Document.equivalent_uris(peerj["doc"]["href"])
+                assert_false(get_mock.called)
+            assert_equal(sorted(uris), sorted([peerj["html"]["href"],
+                                               peerj["pdf"]["href"],
+                                               peerj["doc"]["href"]]))
+        finally:
+            Document.uri_cache = None
+
+    def test_equivalent_uris_many(self):
+        Document({"id": "1", "link": [peerj["html"], peerj["pdf"]]}).save()
+        Document({"id": "2", "link": [peerj["doc"]]}).save()
+
+        with patch.object(Document, 'get_by_uri') as get_mock:
+            res = Document.equivalent_uris_many([peerj["pdf"]["href"],
+                                                 peerj["doc"]["href"],
+                                                 peerj["pdf"]["href"],
+                                                 "bogus"])
+            assert_false(get_mock.called)
+        assert_equal(res, {
+            peerj["pdf"]["href"]: [peerj["html"]["href"],
+                                   peerj["pdf"]["href"]],
+            peerj["doc"]["href"]: [peerj["doc"]["href"]],
+            "bogus": [],
+        })
+
+    def test_equivalent_uris_many_cache(self):
+        Document.uri_cache = LRUCache()
+        try:
+            Document({"id": "1", "link": [peerj["html"]]}).save()
+            Document.equivalent_uris_many([peerj["html"]["href"], "bogus"])
+
+            with patch.object(Document, '_get_all_by_uris') as get_mock:
+                res = Document.equivalent_uris_many([peerj["html"]["href"],
+                                                     "bogus"])
+                assert_false(get_mock.called)
+            assert_equal(res, {peerj["html"]["href"]: [peerj["html"]["href"]],
+                               "bogus": []})
+        finally:
+            Document.uri_cache = None
+
     def test_uris(self):
         d = Document({
             "id": "1",
@@ -212,6 +289,92 @@ class TestDocument(TestCase):
         assert d3 is None
         assert d4
 
+    def test_save_clusters(self):
+        d1 = Document({
+            "id": "1",
+            "title": "document1",
+            "link": [peerj["html"]]
+        })
+        d1.save()
+
+        d2 = Document({
+            "id": "2",
+            "title": "document2",
+            "link": [peerj["doc"]]
+        })
+        d2.save()
+
+        d1 = Document.fetch(1)
+        d2 = Document.fetch(2)
+        assert d1['cluster']
+        assert d2['cluster']
+        assert_not_equal(d1['cluster'], d2['cluster'])
+
+        # Linking both documents merges their clusters
+        d3 = Document({
+            "id": "3",
+            "title": "document3",
+            "link": [peerj["html"], peerj["doc"]]
+        })
+        d3.save()
+
+        d3 = Document.fetch(3)
+        assert_equal(d3['cluster'], min(d1['cluster'], d2['cluster']))
+        assert Document.fetch(1) is None
+        assert Document.fetch(2) is None
+
+    def test_save_single_lookup(self):
+        d1 = Document({"id": "1", "link": [peerj["html"], peerj["pdf"]]})
+        d1.save()
+
+        # The merged document of a cluster is found with one query
+        d2 = Document({"id": "2", "link": [peerj["pdf"]]})
+        with patch.object(Document, '_get_all_by_uris',
+                          wraps=Document._get_all_by_uris) as lookup:
+            d2.save()
+        assert_equal(lookup.call_count, 1)
+        assert Document.fetch(1) is None
+        assert_equal(len(Document.fetch(2)['link']), 2)
+
+    def test_save_legacy_documents(self):
+        # Documents saved without a cluster are their own cluster
+        d1 = Document({
+            "id": "1",
+            "title": "document1",
+            "link": [peerj["html"], peerj["pdf"]]
+        })
+        super(Document, d1).save()
+
+        d2 = Document({
+            "id": "2",
+            "title": "document2",
+            "link": [peerj["pdf"]]
+        })
+        d2.save()
+
+        assert Document.fetch(1) is None
+        d2 = Document.fetch(2)
+        assert_equal(d2['cluster'], "1")
+        assert_equal(len(d2['link']), 2)
+
+    def test_save_legacy_chain(self):
+        # Legacy documents which only overlap through one another are merged
+        # as a whole
+        for i, hrefs in enumerate([('a', 'b'), ('b', 'c'), ('c', 'd')]):
+            d = Document({
+                "id": str(i + 1),
+                "link": [{"href": href} for href in hrefs]
+            })
+            super(Document, d).save()
+
+        d4 = Document({"id": "4", "link": [{"href": "a"}]})
+        d4.save()
+
+        for i in range(1, 4):
+            assert Document.fetch(i) is None
+        d4 = Document.fetch(4)
+        assert_equal(sorted(d4.uris()), ['a', 'b', 'c', 'd'])
+
     def test_save_merge_documents(self):
         d1 = Document({
             "id": "1",
@@ -283,3 +446,67 @@ class TestDocument(TestCase):
         assert d3 is None
         assert d4
         assert d5
+
+    def test_coalesce(self):
+        docs = coalesce([
+            Document(title='a', link=[{'href': 'a'}, {'href': 'b'}]),
+            Document(title='c', link=[{'href': 'c'}]),
+            Document(title='d', link=[{'href': 'd'}, {'type': 'junk'}]),
+            Document(title='bc', link=[{'href': 'b'}, {'href': 'c'}]),
+        ])
+        assert_equal(len(docs), 2)
+        assert_equal(docs[0]['title'], 'bc')
+        assert_equal(sorted(docs[0].uris()), ['a', 'b', 'c'])
+        assert_equal(docs[1].uris(), ['d'])
+
+
+class TestMergeQueue(object):
+    def setup(self):
+        self.saved = []
+        self.patcher = patch.object(Document, 'save', autospec=True,
+                                    side_effect=self.saved.append)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def test_put(self):
+        q = MergeQueue(workers=2)
+        q.put(Document({"title": "document1", "link": [peerj["html"]]}))
+        q.put(Document({"title": "document2", "link": [peerj["doc"]]}))
+        q.stop()
+
+        titles = sorted(d['title'] for d in self.saved)
+        assert_equal(titles, ["document1", "document2"])
+
+    def test_coalesce(self):
+        q = MergeQueue(workers=0)
+        q.put(Document({"title": "document1",
+                        "link": [peerj["html"], peerj["pdf"]]}))
+        q.put(Document({"title": "document2",
+                        "link": [peerj["pdf"], peerj["doc"], {}]}))
+        q.put(Document({"title": "document3",
+                        "link": [peerj["docx"]]}))
+
+        # Start a worker only once everything has been queued
+        q._threads.append(threading.Thread(target=q._work))
+        q._threads[0].daemon = True
+        q._threads[0].start()
+        q.stop()
+
+        assert_equal(len(self.saved), 2)
+        merged = self.saved[0]
+        assert_equal(merged['title'], "document2")
+        assert_equal(merged.uris(), [peerj["html"]["href"],
+                                     peerj["pdf"]["href"],
+                                     peerj["doc"]["href"]])
+        assert_equal(self.saved[1]['title'], "document3")
+
+    def test_save_error(self):
+        Document.save.side_effect = ValueError("ES is down")
+        q = MergeQueue(workers=1)
+        q.put(Document({"title": "document1", "link": [peerj["html"]]}))
+        q.put(Document({"title": "document2", "link": [peerj["doc"]]}))
+        q.join()
+        assert_equal(Document.save.call_count, 2)
+        q.stop()
@@ -0,0 +1,63 @@
+import json
+
+from nose.tools import *
+from mock import patch
+
+from annotator import encoder
+from annotator.elasticsearch import SearchResult
+
+
+class TestEncoder(object):
+    def setup(self):
+        self.obj = {
+            'total': 2,
+            'rows': [{'id': '1', 'text': u'Caf\xe9', 'uri': 'http://a/b'},
+                     {'id': '2', 'ranges': [{'start': '/p'}], 'tags': []}],
+        }
+
+    def test_dumps(self):
+        res = encoder.dumps(self.obj)
+        assert_equal(json.loads(res), self.obj)
+        assert_false(' ' in res.replace(u'Caf\xe9', ''))
+
+    def test_dumps_pretty(self):
+        res = encoder.dumps(self.obj, pretty=True)
+        assert_equal(json.loads(res), self.obj)
+        assert_true('\n  ' in res)
+
+    def test_iterencode(self):
+        for obj in (self.obj, self.obj['rows'], [], {}, 'foo', None, 3):
+            res = ''.join(encoder.iterencode(obj))
+            assert_equal(json.loads(res), obj)
+
+    def test_iterencode_pretty(self):
+        res = ''.join(encoder.iterencode(self.obj, pretty=True))
+        assert_equal(json.loads(res), self.obj)
+        assert_true('\n  ' in res)
+
+    def test_iterencode_search_result(self):
+        rows = SearchResult([{'id': '1'}], total=1)
+        res = ''.join(encoder.iterencode({'total': rows.total, 'rows': rows}))
+        assert_equal(json.loads(res), {'total': 1, 'rows': [{'id': '1'}]})
+
+    @patch('annotator.encoder.CHUNK_SIZE', 10)
+    def test_iterencode_chunks(self):
+        rows = [{'id': str(i)} for i in range(100)]
+        chunks = list(encoder.iterencode(rows))
+        assert_true(len(chunks) > 1)
+        assert_equal(json.loads(''.join(chunks)), rows)
+
+    def test_set_backend(self):
+        calls = []
+
+        def dumps(obj):
+            calls.append(obj)
+            return json.dumps(obj)
+
+        old = encoder._dumps
+        encoder.set_backend(dumps)
+        try:
+            assert_equal(json.loads(encoder.dumps([1, 2])), [1, 2])
+            assert_equal(calls, [[1, 2]])
+        finally:
+            encoder.set_backend(old)
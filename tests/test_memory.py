@@ -0,0 +1,203 @@
+from nose.tools import *
+
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from elasticsearch.exceptions import RequestError
+
+from annotator.memory import MemoryElasticsearch
+
+
+def _search(conn, **body):
+    res = conn.search(index='idx', doc_type='annotation', body=body)
+    return [h['_id'] for h in res['hits']['hits']]
+
+
+class TestMemoryElasticsearch(object):
+
+    def setup(self):
+        self.conn = MemoryElasticsearch()
+        self.conn.indices.create('idx')
+        self.conn.indices.put_mapping(index='idx', doc_type='annotation', body={
+            'annotation': {'properties': {
+                'text': {'type': 'string', 'analyzer': 'standard'},
+                'updated': {'type': 'date'},
+            }}
+        })
+        docs = [
+            {'id': '1', 'user': 'alice', 'text': 'Hello World',
+             'tags': ['a', 'b'], 'updated': '2015-01-01T00:00:00+00:00'},
+            {'id': '2', 'user': {'id': 'bob'}, 'text': 'Goodbye world',
+             'tags': ['b'], 'updated': '2015-01-02T00:00:00+00:00'},
+            {'id': '3', 'user': 'alice', 'text': 'Something else',
+             'updated': '2015-01-03T00:00:00+00:00'},
+        ]
+        for doc in docs:
+            self.conn.index(index='idx', doc_type='annotation', body=doc)
+
+    def test_get(self):
+        doc = self.conn.get(index='idx', doc_type='annotation', id='1')
+        assert_equal(doc['_source']['user'], 'alice')
+        assert_false('id' in doc['_source'])
+
+        doc = self.conn.get(index='idx', doc_type='annotation', id=1,
+                            _source_include=['text'])
+        assert_equal(doc['_source'], {'text': 'Hello World'})
+
+        res = self.conn.get(index='idx', doc_type='annotation', id='9',
+                            ignore=404)
+        assert_false(res['found'])
+        assert_raises(NotFoundError, self.conn.get,
+                      index='idx', doc_type='annotation', id='9')
+
+    def test_create_conflict(self):
+        assert_raises(ConflictError, self.conn.index,
+                      index='idx', doc_type='annotation', body={'id': '1'},
+                      op_type='create')
+
+    def test_term_queries(self):
+        assert_equal(sorted(_search(self.conn,
+                                    query={'match': {'user': 'alice'}})),
+                     ['1', '3'])
+        assert_equal(_search(self.conn, query={'term': {'user.id': 'bob'}}),
+                     ['2'])
+        assert_equal(sorted(_search(self.conn,
+                                    query={'terms': {'tags': ['a', 'b']}})),
+                     ['1', '2'])
+
+    def test_analyzed_match(self):
+        assert_equal(sorted(_search(self.conn,
+                                    query={'match': {'text': 'WORLD'}})),
+                     ['1', '2'])
+
+    def test_range_and_sort(self):
+        ids = _search(self.conn,
+                      query={'range': {'updated': {'gt': '2015-01-01'}}},
+                      sort=[{'updated': {'order': 'desc'}}])
+        assert_equal(ids, ['3', '2'])
+
+        ids = _search(self.conn, sort=[{'updated': {'order': 'asc'}}],
+                      size=2)
+        assert_equal(ids, ['1', '2'])
+
+    def test_bool_and_filtered(self):
+        q = {'filtered': {
+            'query': {'bool': {'must': [{'match': {'user': 'alice'}}]}},
+            'filter': {'bool': {'should': [{'term': {'tags': 'a'}},
+                                           {'missing': {'field': 'tags'}}]}}
+        }}
+        assert_equal(sorted(_search(self.conn, query=q)), ['1', '3'])
+
+        q = {'bool': {'must': [{'match_all': {}}],
+                      'must_not': [{'ids': {'values': ['1']}}]}}
+        assert_equal(sorted(_search(self.conn, query=q)), ['2', '3'])
+
+    def test_unsupported_query(self):
+        assert_raises(RequestError, _search, self.conn,
+                      query={'fuzzy': {'text': 'helo'}})
+
+    def test_delete_updates_indexes(self):
+        self.conn.delete(index='idx', doc_type='annotation', id='1')
+        assert_equal(_search(self.conn, query={'term': {'tags': 'a'}}), [])
+        ids = _search(self.conn,
+                      query={'range': {'updated': {'lte': '2015-01-02'}}})
+        assert_equal(ids, ['2'])
+
+    def test_bulk(self):
+        res = self.conn.bulk(body=[
+            {'index': {'_index': 'idx', '_type': 'annotation', '_id': '4'}},
+            {'user': 'carol'},
+            {'create': {'_index': 'idx', '_type': 'annotation', '_id': '1'}},
+            {'user': 'mallory'},
+            {'delete': {'_index': 'idx', '_type': 'annotation', '_id': '2'}},
+        ])
+        assert_true(res['errors'])
+        assert_equal(res['items'][0]['index']['status'], 201)
+        assert_equal(res['items'][1]['create']['status'], 409)
+        assert_equal(res['items'][2]['delete']['status'], 200)
+        assert_equal(sorted(_search(self.conn)), ['1', '3', '4'])
+
+    def test_post_filter(self):
+        res = self.conn.search(index='idx', doc_type='annotation', body={
+            'query': {'match': {'user': 'alice'}},
+            'post_filter': {'term': {'tags': 'a'}},
+            'aggs': {'all': {'filter': {'match_all': {}}}},
+        })
+        # As in Elasticsearch, the post filter narrows the total but not the
+        # aggregations
+        assert_equal(res['hits']['total'], 1)
+        assert_equal([h['_id'] for h in res['hits']['hits']], ['1'])
+        assert_equal(res['aggregations']['all']['doc_count'], 2)
+
+    def test_msearch(self):
+        res = self.conn.msearch(index='idx', doc_type='annotation', body=[
+            {}, {'query': {'match': {'user': 'alice'}}},
+            {'type': 'other'}, {},
+            {}, {'query': {'fuzzy': {'user': 'alice'}}},
+        ])
+        totals = [r.get('hits', {}).get('total') for r in res['responses']]
+        assert_equal(totals, [2, 0, None])
+        assert_equal(res['responses'][2]['status'], 400)
+
+    def test_terms_aggregation(self):
+        res = self.conn.search(index='idx', doc_type='annotation', body={
+            'size': 0,
+            'aggs': {'tags': {'terms': {'field': 'tags', 'size': 1}},
+                     'users': {'terms': {'field': 'user'}}}
+        })
+        assert_equal(res['hits']['hits'], [])
+        tags = res['aggregations']['tags']
+        assert_equal(tags['buckets'], [{'key': 'b', 'doc_count': 2}])
+        assert_equal(tags['sum_other_doc_count'], 1)
+        assert_equal(res['aggregations']['users']['buckets'],
+                     [{'key': 'alice', 'doc_count': 2}])
+
+    def test_date_histogram_aggregation(self):
+        res = self.conn.search(index='idx', doc_type='annotation',
+                               search_type='count', body={
+            'query': {'match': {'user': 'alice'}},
+            'aggs': {'updated': {'date_histogram': {'field': 'updated',
+                                                    'interval': 'day'}}}
+        })
+        assert_equal(res['aggregations']['updated']['buckets'], [
+            {'key': 1420070400000,
+             'key_as_string': '2015-01-01T00:00:00.000Z',
+             'doc_count': 1},
+            {'key': 1420243200000,
+             'key_as_string': '2015-01-03T00:00:00.000Z',
+             'doc_count': 1},
+        ])
+
+    def test_filters_aggregation(self):
+        res = self.conn.search(index='idx', doc_type='annotation', body={
+            'query': {'match': {'user': 'alice'}},
+            'aggs': {'f': {'filters': {'filters': {
+                'a': {'term': {'tags': 'a'}},
+                'b': {'query': {'match': {'text': 'world'}}},
+            }}}}
+        })
+        assert_equal(res['aggregations']['f']['buckets'],
+                     {'a': {'doc_count': 1}, 'b': {'doc_count': 1}})
+
+    def test_unsupported_aggregation(self):
+        assert_raises(RequestError, self.conn.search,
+                      index='idx', doc_type='annotation',
+                      body={'aggs': {'x': {'avg': {'field': 'updated'}}}})
+        assert_raises(RequestError, self.conn.search,
+                      index='idx', doc_type='annotation',
+                      body={'aggs': {'x': {'date_histogram': {
+                          'field': 'updated', 'interval': 'fortnight'}}}})
+
+    def test_count_and_scroll(self):
+        res = self.conn.search(index='idx', doc_type='annotation',
+                               search_type='count')
+        assert_equal(res['hits']['total'], 3)
+
+        res = self.conn.search(index='idx', doc_type='annotation',
+                               search_type='scan', scroll='1m', size=2)
+        assert_equal(res['hits']['hits'], [])
+        ids = []
+        while True:
+            res = self.conn.scroll(res['_scroll_id'], scroll='1m')
+            if not res['hits']['hits']:
+                break
+            ids.extend(h['_id'] for h in res['hits']['hits'])
+        assert_equal(sorted(ids), ['1', '2', '3'])
@@ -0,0 +1,160 @@
+import sys
+
+from nose.tools import *
+from mock import patch
+
+from flask import Flask
+
+from annotator import metrics
+
+
+class TestCounter(object):
+    def test_inc(self):
+        c = metrics.Counter('foo_total', 'Foos.', ('bar',))
+        c.inc(('a',))
+        c.inc(('a',), 2)
+        c.inc(('b',))
+        assert_equal(list(c.samples()), [
+            ('foo_total', (('bar', 'a'),), 3),
+            ('foo_total', (('bar', 'b'),), 1),
+        ])
+
+
+class TestHistogram(object):
+    def test_observe(self):
+        h = metrics.Histogram('foo_seconds', 'Foos.', buckets=(1, 2))
+        h.observe(0.5)
+        h.observe(1.5)
+        h.observe(3)
+        assert_equal(list(h.samples()), [
+            ('foo_seconds_bucket', (('le', '1'),), 1),
+            ('foo_seconds_bucket', (('le', '2'),), 2),
+            ('foo_seconds_bucket', (('le', '+Inf'),), 3),
+            ('foo_seconds_sum', (), 5.0),
+            ('foo_seconds_count', (), 3),
+        ])
+
+
+class TestRegistry(object):
+    def test_render(self):
+        registry = metrics.Registry()
+        c = registry.register(metrics.Counter('foo_total', 'Foos.', ('bar',)))
+        c.inc(('a "b"\n',))
+        assert_equal(registry.render(),
+                     '# HELP foo_total Foos.\n'
+                     '# TYPE foo_total counter\n'
+                     'foo_total{bar="a \\"b\\"\\n"} 1\n')
+
+
+class TestEsCall(object):
+    def setup(self):
+        metrics.enabled = True
+
+    def teardown(self):
+        metrics.enabled = False
+
+    def _samples(self, metric, operation):
+        return dict((name, value) for name, labels, value in metric.samples()
+                    if ('operation', operation) in labels)
+
+    def test_disabled(self):
+        metrics.enabled = False
+        metrics.es_call('test_disabled', lambda: {'took': 5})
+        assert_equal(self._samples(metrics.es_calls_total, 'test_disabled'),
+                     {})
+
+    def test_records_call(self):
+        res = metrics.es_call('test_ok', lambda x: {'took': 5, 'x': x}, x=1)
+        assert_equal(res, {'took': 5, 'x': 1})
+        assert_equal(self._samples(metrics.es_calls_total, 'test_ok'),
+                     {'annotator_es_calls_total': 1})
+        took = self._samples(metrics.es_took, 'test_ok')
+        assert_equal(took['annotator_es_took_seconds_sum'], 0.005)
+
+    def test_records_error(self):
+        def fail():
+            raise ValueError()
+        assert_raises(ValueError, metrics.es_call, 'test_error', fail)
+        samples = list(metrics.es_calls_total.samples())
+        assert_true(('annotator_es_calls_total',
+                     (('operation', 'test_error'), ('outcome', 'error')),
+                     1) in samples)
+
+    def test_counts_calls_per_request(self):
+        metrics.start_request()
+        metrics.es_call('search', lambda: {})
+        metrics.es_call('fetch', lambda: {})
+        metrics.finish_request('test_request', 'GET', 200)
+
+        samples = dict((name, value) for name, labels, value
+                       in metrics.request_es_calls.samples()
+                       if ('endpoint', 'test_request') in labels)
+        assert_equal(samples['annotator_request_es_calls_sum'], 2)
+        assert_equal(samples['annotator_request_es_calls_count'], 1)
+
+    def test_finish_without_start(self):
+        metrics.finish_request('test_unstarted', 'GET', 200)
+        assert_false(any(('endpoint', 'test_unstarted') in labels
+                         for _, labels, _ in metrics.requests_total.samples()))
+
+
+class TestSlowQueryLog(object):
+    def setup(self):
+        metrics.slow_query_threshold = 0
+        self.patcher = patch.object(metrics, 'slow_log')
+        self.log = self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        metrics.slow_query_threshold = None
+        metrics.slow_query_sample_rate = 1.0
+
+    def test_logs_slow_call(self):
+        metrics.es_call('search', lambda **kw: {'took': 12},
+                        index='annotator', body={'query': {'match_all': {}}},
+                        size=20)
+        assert_equal(self.log.warning.call_count, 1)
+        args = self.log.warning.call_args[0]
+        assert_equal(args[1:3], ('search', 'ok'))
+        assert_equal(args[5], 12)
+        assert_equal(args[6], '{"size": 20}')
+        assert_equal(args[7], '{"query": {"match_all": {}}}')
+
+    def test_logs_failed_call(self):
+        def fail(**kwargs):
+            raise ValueError()
+        assert_raises(ValueError, metrics.es_call, 'fetch', fail, id='foo')
+        args = self.log.warning.call_args[0]
+        assert_equal(args[1:3], ('fetch', 'error'))
+
+    def test_fast_call_not_logged(self):
+        metrics.slow_query_threshold = 60
+        metrics.es_call('search', lambda: {'took': 1})
+        assert_false(self.log.warning.called)
+
+    def test_sampling(self):
+        metrics.slow_query_sample_rate = 0
+        metrics.es_call('search', lambda: {'took': 1})
+        assert_false(self.log.warning.called)
+
+    def test_endpoint(self):
+        app = Flask('test')
+        app.add_url_rule('/foo', 'foo')
+        with app.test_request_context('/foo'):
+            metrics.es_call('search', lambda: {'took': 1})
+        args = self.log.warning.call_args[0]
+        assert_equal(args[3], 'foo')
+
+    def test_endpoint_without_flask(self):
+        with patch.dict(sys.modules, {'flask': None}):
+            metrics.es_call('search', lambda: {'took': 1})
+        args = self.log.warning.call_args[0]
+        assert_equal(args[3], None)
+
+    def test_truncates_body(self):
+        body = [{'index': {'_id': i}} for i in range(1000)]
+        text = metrics._truncate(body, 100)
+        assert_equal(len(text), 103)
+        assert_true(text.startswith('[{"index": {"_id": 0}},'))
+        assert_true(text.endswith('...'))
+        assert_equal(metrics._truncate({'a': 1}, 100), '{"a": 1}')
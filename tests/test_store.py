@@ -3,10 +3,11 @@ from .helpers import MockUser
 from nose.tools import *
 from mock import patch
 
+from elasticsearch.exceptions import TransportError
 from flask import json, g
 from six.moves import xrange
 
-from annotator import auth, es
+from annotator import auth, es, metrics, store
 from annotator.annotation import Annotation
 
 
@@ -64,6 +65,15 @@ class TestStore(TestCase):
         response = self.cli.get('/api/annotations', headers=self.headers)
         assert response.data == b"[]", "response should be empty list"
 
+    def test_pretty(self):
+        self._create_annotation(text=u"Foo", id='123')
+        response = self.cli.get('/api/annotations/123', headers=self.headers)
+        assert_false(b'\n' in response.data)
+
+        response = self.cli.get('/api/annotations/123?pretty',
+                                headers=self.headers)
+        assert_true(b'\n  "text": "Foo"' in response.data)
+
     def test_create(self):
         payload = json.dumps({'name': 'Foo'})
 
@@ -146,20 +156,20 @@ class TestStore(TestCase):
         assert ann1['name'] == 'foo', "annotation name should be 'foo'"
         assert ann2['name'] == 'bar', "annotation name should be 'bar'"
 
-    @patch('annotator.store.json')
+    @patch('annotator.store.encoder')
     @patch('annotator.store.Annotation')
-    def test_create_refresh(self, ann_mock, json_mock):
-        json_mock.dumps.return_value = "{}"
+    def test_create_refresh(self, ann_mock, encoder_mock):
+        encoder_mock.iterencode.return_value = iter(["{}"])
         response = self.cli.post('/api/annotations?refresh=true',
                                  data="{}",
                                  content_type='application/json',
                                  headers=self.headers)
         ann_mock.return_value.save.assert_called_once_with(refresh=True)
 
-    @patch('annotator.store.json')
+    @patch('annotator.store.encoder')
     @patch('annotator.store.Annotation')
-    def test_create_disable_refresh(self, ann_mock, json_mock):
-        json_mock.dumps.return_value = "{}"
+    def test_create_disable_refresh(self, ann_mock, encoder_mock):
+        encoder_mock.iterencode.return_value = iter(["{}"])
         response = self.cli.post('/api/annotations?refresh=false',
                                  data="{}",
                                  content_type='application/json',
@@ -174,6 +184,54 @@ class TestStore(TestCase):
         assert data['id'] == '123', "annotation id should be returned in response"
         assert data['text'] == "Foo", "annotation text should be returned in response"
 
+    def test_read_fields(self):
+        self._create_annotation(text=u"Foo", uri=u"http://xyz.com", id='123')
+
+        response = self.cli.get('/api/annotations/123?fields=text',
+                                headers=self.headers)
+        data = json.loads(response.data)
+        assert_equal(data, {'id': '123', 'text': 'Foo'})
+
+        response = self.cli.get('/api/annotations/123?fields=-uri,-user',
+                                headers=self.headers)
+        data = json.loads(response.data)
+        assert_false('uri' in data)
+        assert_false('user' in data)
+        assert_equal(data['text'], 'Foo')
+        assert_equal(data['consumer'], self.user.consumer.key)
+
+    def test_read_many(self):
+        for docid in ['1', '2', '3']:
+            self._create_annotation(text=u"Foo " + docid, id=docid,
+                                    refresh=False)
+
+        response = self.cli.get('/api/annotations?ids=3,missing,1,3',
+                                headers=self.headers)
+        assert_equal(response.status_code, 200)
+        data = json.loads(response.data)
+        assert_equal([a['id'] for a in data], ['3', '1'])
+        assert_equal(data[0]['text'], 'Foo 3')
+
+        response = self.cli.post('/api/annotations/_mget?fields=text',
+                                 data=json.dumps(['2', '1']),
+                                 content_type='application/json',
+                                 headers=self.headers)
+        data = json.loads(response.data)
+        assert_equal(data, [{'id': '2', 'text': 'Foo 2'},
+                            {'id': '1', 'text': 'Foo 1'}])
+
+        response = self.cli.get('/api/annotations?ids=', headers=self.headers)
+        assert_equal(json.loads(response.data), [])
+
+    def test_read_many_bad_payload(self):
+        too_many = ['x%d' % i for i in xrange(1001)]
+        for payload in [{'ids': ['1']}, [1, 2], too_many]:
+            response = self.cli.post('/api/annotations/_mget',
+                                     data=json.dumps(payload),
+                                     content_type='application/json',
+                                     headers=self.headers)
+            assert_equal(response.status_code, 400)
+
     def test_read_notfound(self):
         response = self.cli.get('/api/annotations/123', headers=self.headers)
         assert response.status_code == 404, "response should be 404 NOT FOUND"
@@ -277,6 +335,89 @@ class TestStore(TestCase):
         response = self.cli.delete('/api/annotations/123', headers=self.headers)
         assert response.status_code == 404, "response should be 404 NOT FOUND"
 
+    def test_bulk(self):
+        self._create_annotation(text=u"Foo", id='123')
+        self._create_annotation(text=u"Bar", id='456')
+
+        payload = json.dumps([
+            {'create': {'text': 'Baz', 'user': 'jenny'}},
+            {'update': {'id': '123', 'text': 'Qux'}},
+            {'delete': {'id': '456'}},
+        ])
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=payload,
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert_equal(response.status_code, 200)
+        data = json.loads(response.data)
+
+        assert_equal(data[0]['create']['status'], 201)
+        created = self._get_annotation(data[0]['create']['id'])
+        assert_equal(created['text'], 'Baz')
+        assert_equal(created['user'], self.user.id)
+        assert_equal(created['consumer'], self.user.consumer.key)
+
+        assert_equal(data[1], {'update': {'id': '123', 'status': 200}})
+        assert_equal(self._get_annotation('123')['text'], 'Qux')
+
+        assert_equal(data[2], {'delete': {'id': '456', 'status': 204}})
+        assert_equal(self._get_annotation('456'), None)
+
+    def test_bulk_item_errors(self):
+        payload = json.dumps([
+            {'update': {'id': '123', 'text': 'Qux'}},
+            {'delete': {}},
+            {'frobnicate': {}},
+            'junk',
+        ])
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=payload,
+                                 content_type='application/json',
+                                 headers=self.headers)
+        data = json.loads(response.data)
+        assert_equal(data[0]['update']['status'], 404)
+        assert_equal(data[1]['delete']['status'], 400)
+        assert_equal(data[2]['error']['status'], 400)
+        assert_equal(data[3]['error']['status'], 400)
+
+    def test_bulk_invalid_id(self):
+        payload = json.dumps([
+            {'update': {'id': ['123'], 'text': 'Qux'}},
+            {'delete': {'id': {'a': 1}}},
+        ])
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=payload,
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert_equal(response.status_code, 200)
+        data = json.loads(response.data)
+        assert_equal(data[0]['update']['status'], 400)
+        assert_equal(data[1]['delete']['status'], 400)
+
+    def test_bulk_too_many(self):
+        payload = json.dumps([{'create': {'text': 'Foo'}}] *
+                             (store.BULK_MAX_SIZE + 1))
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=payload,
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+    def test_bulk_no_payload(self):
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=json.dumps({'text': 'Foo'}),
+                                 content_type='application/json',
+                                 headers=self.headers)
+        assert response.status_code == 400, "response should be 400 BAD REQUEST"
+
+    def test_bulk_create_unauthenticated(self):
+        payload = json.dumps([{'create': {'text': 'Foo'}}])
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=payload,
+                                 content_type='application/json')
+        data = json.loads(response.data)
+        assert_equal(data[0]['create']['status'], 401)
+
     def test_search(self):
         uri1 = u'http://xyz.com'
         uri2 = u'urn:uuid:xxxxx'
@@ -299,6 +440,19 @@ class TestStore(TestCase):
         assert_equal(res['rows'][0]['uri'], uri1)
         assert_true(res['rows'][0]['id'] in [anno['id'], anno2['id']])
 
+    def test_search_fields(self):
+        uri1 = u'http://xyz.com'
+        self._create_annotation(uri=uri1, text=uri1, user=u'levin')
+
+        res = self._get_search_results('fields=text,user')
+        assert_equal(res['total'], 1)
+        assert_equal(sorted(res['rows'][0].keys()), ['id', 'text', 'user'])
+
+        res = self.cli.get('/api/annotations?fields=-text', headers=self.headers)
+        rows = json.loads(res.data)
+        assert_false('text' in rows[0])
+        assert_equal(rows[0]['uri'], uri1)
+
     def test_search_sort_and_order(self):
         uri1 = u'http://xyz.com'
         uri2 = u'urn:uuid:xxxxx'
@@ -368,6 +522,197 @@ class TestStore(TestCase):
         assert_equal(len(res['rows']), 20)
         assert_equal(res['rows'][0], first)
 
+    def test_search_cursor(self):
+        for i in xrange(45):
+            self._create_annotation(refresh=False)
+
+        es.conn.indices.refresh(es.index)
+
+        seen = []
+        res = self._get_search_results('cursor=')
+        seen.extend(r['id'] for r in res['rows'])
+        while 'next' in res:
+            res = self._get_search_results('cursor=' + res['next'])
+            seen.extend(r['id'] for r in res['rows'])
+            # the total counts every match, not only those left
+            assert_equal(res['total'], 45)
+
+        assert_equal(len(seen), 45)
+        assert_equal(len(set(seen)), 45)
+
+        # a short page has no next cursor
+        res = self._get_search_results('limit=50&cursor=')
+        assert_false('next' in res)
+
+        # nor does a search which doesn't page with cursors
+        res = self._get_search_results()
+        assert_equal(len(res['rows']), 20)
+        assert_false('next' in res)
+
+    def test_search_bad_cursor(self):
+        response = self.cli.get('/api/search?cursor=foobar',
+                                headers=self.headers)
+        assert_equal(response.status_code, 400)
+
+    def test_search_batch(self):
+        uri1 = u'http://xyz.com'
+        uri2 = u'urn:uuid:xxxxx'
+        for i in xrange(3):
+            self._create_annotation(uri=uri1, refresh=False)
+        self._create_annotation(uri=uri2)
+
+        payload = [{'uri': uri1, 'limit': 2, 'cursor': ''},
+                   {'uri': uri2, 'fields': 'uri'},
+                   {'limit': 0}]
+        res = self.cli.post('/api/search/batch',
+                            data=json.dumps(payload),
+                            content_type='application/json',
+                            headers=self.headers)
+        assert_equal(res.status_code, 200)
+        results = json.loads(res.data)
+        assert_equal([r['total'] for r in results], [3, 1, 4])
+        assert_equal(len(results[0]['rows']), 2)
+        assert_true('next' in results[0])
+        assert_equal(sorted(results[1]['rows'][0]), ['id', 'uri'])
+        assert_equal(results[2]['rows'], [])
+
+        # The cursor continues the search as with /search
+        payload = [{'uri': uri1, 'limit': 2, 'cursor': results[0]['next']}]
+        res = self.cli.post('/api/search/batch',
+                            data=json.dumps(payload),
+                            content_type='application/json',
+                            headers=self.headers)
+        assert_equal(len(json.loads(res.data)[0]['rows']), 1)
+
+    def test_search_batch_bad_payload(self):
+        for payload in [{'uri': 'foo'}, ['foo'], [{}] * 21,
+                        [{'cursor': 'foobar'}], [{'cursor': 5}],
+                        [{'sort': ['x']}], [{'fields': ['text']}],
+                        [{'limit': '10'}], [{'offset': 1.5}],
+                        [{'uri': {'a': 1}}], [{'text': None}],
+                        [{'limit': True}]]:
+            res = self.cli.post('/api/search/batch',
+                                data=json.dumps(payload),
+                                content_type='application/json',
+                                headers=self.headers)
+            assert_equal(res.status_code, 400)
+
+    def test_stats(self):
+        self._create_annotation(uri=u'http://xyz.com', tags=['foo'],
+                                refresh=False)
+        self._create_annotation(uri=u'http://xyz.com', tags=['foo', 'bar'],
+                                refresh=False)
+        self._create_annotation(uri=u'urn:uuid:xxxxx')
+
+        res = self.cli.get('/api/stats?limit=1', headers=self.headers)
+        assert_equal(res.status_code, 200)
+        stats = json.loads(res.data)
+        assert_equal(stats['total'], 3)
+        assert_equal(stats['tags'], [{'key': 'foo', 'count': 2}])
+        assert_equal(stats['uri'], [{'key': 'http://xyz.com', 'count': 2}])
+        assert_equal(stats['user'], [{'key': self.user.id, 'count': 3}])
+        assert_equal(sum(b['count'] for b in stats['created']), 3)
+
+        res = self.cli.get('/api/stats?uri=urn:uuid:xxxxx&interval=day',
+                           headers=self.headers)
+        stats = json.loads(res.data)
+        assert_equal(stats['total'], 1)
+        assert_equal(stats['tags'], [])
+        assert_equal(len(stats['created']), 1)
+
+    def test_counts(self):
+        self._create_annotation(uri=u'http://xyz.com', refresh=False)
+        self._create_annotation(uri=u'http://xyz.com', refresh=False)
+        self._create_annotation(uri=u'urn:uuid:xxxxx')
+
+        res = self.cli.post('/api/counts',
+                            data=json.dumps([u'http://xyz.com',
+                                             u'urn:uuid:xxxxx',
+                                             u'http://abc.com']),
+                            content_type='application/json',
+                            headers=self.headers)
+        assert_equal(res.status_code, 200)
+        assert_equal(json.loads(res.data), {u'http://xyz.com': 2,
+                                            u'urn:uuid:xxxxx': 1,
+                                            u'http://abc.com': 0})
+
+    def test_counts_bad_payload(self):
+        for payload in [{'uris': []}, [1, 2], ['x'] * 1001]:
+            res = self.cli.post('/api/counts',
+                                data=json.dumps(payload),
+                                content_type='application/json',
+                                headers=self.headers)
+            assert_equal(res.status_code, 400)
+
+    def test_stats_bad_interval(self):
+        res = self.cli.get('/api/stats?interval=fortnight',
+                           headers=self.headers)
+        assert_equal(res.status_code, 400)
+
+    def test_export(self):
+        uri1 = u'http://xyz.com'
+        uri2 = u'urn:uuid:xxxxx'
+        for i in xrange(250):
+            self._create_annotation(uri=uri1, refresh=False)
+        self._create_annotation(uri=uri2)
+
+        res = self.cli.get('/api/annotations/export?uri=' + uri1,
+                           headers=self.headers)
+        assert_equal(res.status_code, 200)
+        assert_equal(res.mimetype, 'application/x-ndjson')
+
+        rows = [json.loads(l) for l in res.data.splitlines()]
+        assert_equal(len(rows), 250)
+        assert_true(all(r['uri'] == uri1 for r in rows))
+
+        # Search options which don't apply to exports are ignored
+        res = self.cli.get('/api/annotations/export?fields=text&cursor=&uri=' +
+                           uri2, headers=self.headers)
+        rows = [json.loads(l) for l in res.data.splitlines()]
+        assert_equal(len(rows), 1)
+        assert_equal(rows[0]['uri'], uri2)
+
+    def test_export_error(self):
+        # Errors are reported with their status, not after a 200
+        err = TransportError(503, 'unavailable')
+        with patch.object(es.conn, 'search', side_effect=err):
+            res = self.cli.get('/api/annotations/export',
+                               headers=self.headers)
+        assert_equal(res.status_code, 503)
+
+    def test_export_metrics(self):
+        metrics.enabled = True
+        try:
+            self._create_annotation()
+            self.cli.get('/api/annotations/export', headers=self.headers)
+            samples = [labels for name, labels, _
+                       in metrics.es_calls_total.samples()]
+        finally:
+            metrics.enabled = False
+        assert_true((('operation', 'scroll'), ('outcome', 'ok')) in samples)
+
+    def test_metrics_disabled(self):
+        res = self.cli.get('/api/metrics')
+        assert_equal(res.status_code, 404)
+
+    def test_metrics(self):
+        metrics.enabled = True
+        try:
+            ann = self._create_annotation()
+            self.cli.get('/api/annotations/{0}'.format(ann['id']),
+                         headers=self.headers)
+            res = self.cli.get('/api/metrics')
+        finally:
+            metrics.enabled = False
+
+        assert_equal(res.status_code, 200)
+        assert_true(res.content_type.startswith('text/plain'))
+        body = res.data.decode('utf-8')
+        assert_true('annotator_requests_total{endpoint="store.read_annotation",'
+                    'method="GET",status="200"}' in body)
+        assert_true('annotator_es_calls_total{operation="fetch",'
+                    'outcome="ok"}' in body)
+
     def _get_search_results(self, qs=''):
         res = self.cli.get('/api/search?{qs}'.format(qs=qs), headers=self.headers)
         return json.loads(res.data)
@@ -435,6 +780,33 @@ class TestStoreAuthz(TestCase):
         data = json.loads(response.data)
         assert data['text'] == 'Foobar'
 
+    def test_read_fields(self):
+        response = self.cli.get('/api/annotations/123?fields=text',
+                                headers=self.charlie_headers)
+        assert response.status_code == 403, "response should be 403 FORBIDDEN"
+
+        response = self.cli.get('/api/annotations/123?fields=text',
+                                headers=self.bob_headers)
+        assert response.status_code == 200, "response should be 200 OK"
+        data = json.loads(response.data)
+        assert_equal(data, {'id': self.anno_id, 'text': 'Foobar'})
+
+    def test_read_many(self):
+        Annotation(id='456', user='bob', consumer=self.user.consumer.key,
+                   permissions={'read': ['bob']}).save()
+
+        response = self.cli.get('/api/annotations?ids=123,456')
+        assert_equal(json.loads(response.data), [])
+
+        response = self.cli.get('/api/annotations?ids=123,456',
+                                headers=self.alice_headers)
+        assert_equal([a['id'] for a in json.loads(response.data)], ['123'])
+
+        response = self.cli.get('/api/annotations?ids=123,456&fields=text',
+                                headers=self.bob_headers)
+        assert_equal(json.loads(response.data),
+                     [{'id': '123', 'text': 'Foobar'}, {'id': '456'}])
+
     def test_update(self):
         payload = json.dumps({'id': self.anno_id, 'text': 'Bar'})
 
@@ -497,6 +869,27 @@ class TestStoreAuthz(TestCase):
                                 headers=self.bob_headers)
         assert response.status_code == 200, "response should be 200 OK"
 
+    def test_bulk(self):
+        payload = json.dumps([
+            {'update': {'id': self.anno_id, 'text': 'Bar'}},
+            {'delete': {'id': self.anno_id}},
+        ])
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=payload,
+                                 content_type='application/json',
+                                 headers=self.bob_headers)
+        data = json.loads(response.data)
+        assert_equal(data[0]['update']['status'], 403)
+        assert_equal(data[1]['delete']['status'], 403)
+
+        response = self.cli.post('/api/annotations/_bulk',
+                                 data=payload,
+                                 content_type='application/json',
+                                 headers=self.alice_headers)
+        data = json.loads(response.data)
+        assert_equal(data[0]['update']['status'], 200)
+        assert_equal(data[1]['delete']['status'], 204)
+
     def test_search_public(self):
         # Not logged in: no results
         results = self._get_search_results()
@@ -514,6 +907,63 @@ class TestStoreAuthz(TestCase):
         assert results['total'] == 0
         assert results['rows'] == []
 
+    def test_export(self):
+        res = self.cli.get('/api/annotations/export')
+        assert_equal(res.data, b'')
+
+        res = self.cli.get('/api/annotations/export', headers=self.bob_headers)
+        rows = [json.loads(l) for l in res.data.splitlines()]
+        assert_equal(len(rows), 1)
+        assert_equal(rows[0]['id'], self.anno_id)
+
+        res = self.cli.get('/api/annotations/export',
+                           headers=self.charlie_headers)
+        assert_equal(res.data, b'')
+
+    def test_stats(self):
+        res = self.cli.get('/api/stats')
+        assert_equal(json.loads(res.data)['total'], 0)
+
+        res = self.cli.get('/api/stats', headers=self.bob_headers)
+        stats = json.loads(res.data)
+        assert_equal(stats['total'], 1)
+        assert_equal(stats['user'], [{'key': self.user.id, 'count': 1}])
+
+        res = self.cli.get('/api/stats', headers=self.charlie_headers)
+        assert_equal(json.loads(res.data)['total'], 0)
+
+    def test_counts(self):
+        payload = json.dumps([u'http://example.com'])
+        Annotation(uri=u'http://example.com',
+                   consumer=self.user.consumer.key,
+                   permissions={'read': ['bob']}).save()
+
+        res = self.cli.post('/api/counts', data=payload,
+                            content_type='application/json',
+                            headers=self.bob_headers)
+        assert_equal(json.loads(res.data), {u'http://example.com': 1})
+
+        res = self.cli.post('/api/counts', data=payload,
+                            content_type='application/json',
+                            headers=self.charlie_headers)
+        assert_equal(json.loads(res.data), {u'http://example.com': 0})
+
+    def test_search_batch(self):
+        payload = json.dumps([{'text': 'Foobar'}, {}])
+
+        res = self.cli.post('/api/search/batch', data=payload,
+                            content_type='application/json',
+                            headers=self.bob_headers)
+        results = json.loads(res.data)
+        assert_equal([r['total'] for r in results], [1, 1])
+        assert_equal(results[0]['rows'][0]['id'], self.anno_id)
+
+        res = self.cli.post('/api/search/batch', data=payload,
+                            content_type='application/json',
+                            headers=self.charlie_headers)
+        results = json.loads(res.data)
+        assert_equal([r['total'] for r in results], [0, 0])
+
     def test_search_raw_public(self):
         # Not logged in: no results
         results = self._get_search_raw_results()